@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from cnsparser import CNSParser
+
+# Directory of the scripts to benchmark.
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+def prepare_job(template_path, job_dir):
+    """\
+    Creates a job directory with the template and form data with the values
+    of the template itself, for the last (most complex) access level.
+    """
+    with open(template_path) as fp:
+        lines = fp.readlines()
+
+    shutil.copyfile(template_path, os.path.join(job_dir, 'template.cns'))
+
+    form_data, missing = CNSParser(source=lines).extract_form_data(lines)
+
+    with open(os.path.join(job_dir, 'formdata.json'), 'w') as fp:
+        json.dump(form_data, fp)
+
+def commands(python, job_dir):
+    """\
+    Returns (name, command) pairs for the commands to benchmark, with the
+    plain interpreter first.
+    """
+    def script(name, *arguments):
+        return [python, os.path.join(script_dir, name)] + list(arguments)
+
+    template  = os.path.join(job_dir, 'template.cns')
+    form_data = os.path.join(job_dir, 'formdata.json')
+    model     = os.path.join(job_dir, 'model.json')
+    bytecode  = os.path.join(job_dir, 'bytecode')
+
+    return [
+        ('python -c pass',      [python, '-c', 'pass']),
+        ('cnstojson.py',        script('cnstojson.py', '-o', model, template)),
+        ('cns.py tojson',       script('cns.py', 'tojson', '-o', model, template)),
+        ('jsontocns.py',        script('jsontocns.py', job_dir)),
+        ('jsontocns.py cached', script('jsontocns.py', '-c', '--bytecode-cache', bytecode, job_dir)),
+        ('cns.py render',       script('cns.py', 'render', '-c', '--bytecode-cache', bytecode, job_dir)),
+        ('dumpmodel.py',        script('dumpmodel.py', '--counts', model)),
+        ('cns.py dump',         script('cns.py', 'dump', '--counts', model)),
+        ('validateformdata.py', script('validateformdata.py', '-t', template, form_data)),
+        ('cns.py validate',     script('cns.py', 'validate', '-t', template, form_data)),
+    ]
+
+def measure(command, runs):
+    """\
+    Runs a command the given amount of times, after a warm-up run.
+    Returns the wall times in seconds.
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for run in range(runs + 1):
+            start = time.time()
+            status = subprocess.call(command, stdout=devnull)
+            if status != 0:
+                raise RuntimeError('Command failed with status ' + str(status) + ': ' + ' '.join(command))
+            times.append(time.time() - start)
+    return times[1:]
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Measure the startup and run time of the command line tools',
+        epilog=
+            'Every command is run once to warm up (which also saves the bytecode '
+            'file of the template in the bytecode cache) and then RUNS times. The mean and the minimum '
+            'wall time are reported in milliseconds. Note that Python only caches '
+            'the bytecode of imported modules if PYTHONDONTWRITEBYTECODE is not set.'
+    )
+
+    parser.add_argument(
+        '-V', '--version',
+        action  = 'version',
+        version = '%(prog)s 0.1'
+    )
+    parser.add_argument(
+        '-n', '--runs', metavar='RUNS',
+        dest    = 'runs',
+        type    = int,
+        default = 10,
+        help    = 'the amount of timed runs per command'
+    )
+    parser.add_argument(
+        '-t', '--template', metavar='TEMPLATE',
+        dest    = 'template',
+        default = os.path.join(script_dir, 'examples', 'run.cns'),
+        help    = 'the CNS template to use, defaults to examples/run.cns'
+    )
+    parser.add_argument(
+        '-p', '--python', metavar='PYTHON',
+        dest    = 'python',
+        default = sys.executable,
+        help    = 'the Python interpreter to run the commands with, defaults to this one'
+    )
+
+    args = parser.parse_args(argv)
+
+    job_dir = tempfile.mkdtemp(prefix='benchstartup')
+    try:
+        prepare_job(args.template, job_dir)
+
+        print('%-22s %10s %10s' % ('command', 'mean (ms)', 'min (ms)'))
+        for name, command in commands(args.python, job_dir):
+            times = measure(command, args.runs)
+            print('%-22s %10.1f %10.1f' % (name, 1000 * sum(times) / len(times), 1000 * min(times)))
+    finally:
+        shutil.rmtree(job_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
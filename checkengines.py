@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+
+import cnsharness
+from cnsmodel import ComponentTable
+
+parser = argparse.ArgumentParser(
+    description='Compare parse and write engines with CNSParser on random templates',
+    epilog=
+        'Every case is a random template with random form data, determined by '
+        'its seed. Differences are shrunk to a minimal template and form data, '
+        'which are saved as template.cns and formdata.json in a directory per '
+        'difference. Speeds are relative to CNSParser, higher is faster.'
+)
+
+parser.add_argument(
+    '-n', '--cases', metavar='CASES',
+    dest    = 'cases',
+    type    = int,
+    default = 100,
+    help    = 'the amount of random cases to check'
+)
+parser.add_argument(
+    '-s', '--seed', metavar='SEED',
+    dest    = 'seed',
+    type    = int,
+    default = 0,
+    help    = 'the seed of the first case, following cases use the next seeds'
+)
+parser.add_argument(
+    '-e', '--engine', metavar='ENGINE',
+    dest    = 'engines',
+    action  = 'append',
+    choices = list(cnsharness.engines),
+    default = None,
+    help    = 'an engine to check, can be given multiple times, defaults to all engines'
+)
+parser.add_argument(
+    '-c', '--components', metavar='COMPONENTS',
+    dest    = 'components',
+    type    = int,
+    default = 30,
+    help    = 'the approximate amount of components in each template'
+)
+parser.add_argument(
+    '-r', '--repeat', metavar='REPEAT',
+    dest    = 'repeat',
+    type    = int,
+    default = 3,
+    help    = 'the amount of timing rounds per case, 0 disables timing'
+)
+parser.add_argument(
+    '-o', '--output', metavar='DIRECTORY',
+    dest    = 'output',
+    default = 'mismatches',
+    help    = 'the directory to save shrunk cases in'
+)
+parser.add_argument(
+    '-q', '--quiet',
+    dest    = 'quiet',
+    action  = 'store_true',
+    default = False,
+    help    = 'only report differences and the summary'
+)
+
+args = parser.parse_args()
+
+names      = args.engines or list(cnsharness.engines)
+mismatches = 0
+speeds     = dict() # (engine name, operation) => list of speedups
+
+def save(mismatch):
+    """\
+    Saves the case of a mismatch and returns the directory it was saved in.
+    """
+    case      = mismatch.case
+    directory = os.path.join(
+        args.output, mismatch.engine + '-' + mismatch.operation + '-' + str(case.seed)
+    )
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    with open(os.path.join(directory, 'template.cns'), 'w') as fp:
+        fp.write(''.join(case.lines))
+
+    form_data = case.generated_form_data(case.model())
+    if form_data is not None:
+        with open(os.path.join(directory, 'formdata.json'), 'w') as fp:
+            json.dump(form_data, fp)
+
+    return directory
+
+for seed in range(args.seed, args.seed + args.cases):
+    case  = cnsharness.Case.generate(seed, args.components)
+    model = case.model()
+
+    if model[0] != 'ok':
+        # This is a bug in the template generator.
+        print('seed ' + str(seed) + ': invalid template: ' + model[2], file=sys.stderr)
+        mismatches += 1
+        continue
+
+    found = []
+    for name in names:
+        mismatch = cnsharness.check(case, name, cnsharness.engines[name])
+        if mismatch is not None:
+            found.append(mismatch)
+
+    for mismatch in found:
+        mismatches += 1
+        print('seed ' + str(seed) + ': ' + mismatch.engine + ' ' + mismatch.operation + ' differs, shrinking...')
+        mismatch = cnsharness.shrink(mismatch, cnsharness.engines[mismatch.engine])
+        print(mismatch.describe())
+        print('Saved as ' + save(mismatch))
+
+    if args.repeat == 0 or len(found):
+        continue
+
+    result = cnsharness.speedups(case, names, args.repeat)
+    for key, speed in result.items():
+        speeds.setdefault(key, []).append(speed)
+
+    if not args.quiet:
+        print(
+              'seed ' + str(seed) + ': '
+            + str(len(case.lines)) + ' lines, '
+            + str(len(ComponentTable(model[1][1]))) + ' components: '
+            + ', '.join(
+                name + ' ' + ' '.join(
+                    operation + ' ' + '%.2fx' % result[name, operation]
+                        for operation in ('parse', 'write') if (name, operation) in result
+                ) for name in names
+            )
+        )
+
+print(str(args.cases) + ' cases, ' + str(mismatches) + ' differences')
+
+for name in names:
+    for operation in ('parse', 'write'):
+        if (name, operation) in speeds:
+            values = speeds[name, operation]
+            print(
+                  name + ' ' + operation + ': '
+                + '%.2fx' % cnsharness.geometric_mean(values) + ' (geometric mean), '
+                + '%.2fx' % min(values) + ' - ' + '%.2fx' % max(values)
+            )
+
+if mismatches:
+    sys.exit(1)
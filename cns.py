@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import argparse
+import importlib
+
+# Subcommands and the scripts that implement them, see their main() functions.
+# Scripts are imported only when their subcommand is run, so every command
+# only pays for the modules it uses. Unlike a script that is run directly,
+# an imported script is also compiled to bytecode only once.
+commands = [
+    ('tojson',   'cnstojson',         'convert a run.cns file to a JSON model description'),
+    ('render',   'jsontocns',         'save filled in model data back to a run.cns file'),
+    ('dump',     'dumpmodel',         'dump a CNS model structure'),
+    ('validate', 'validateformdata',  'check form data against a CNS template'),
+    ('resolve',  'resolveformdata',   'print the values of all instantiated parameters'),
+    ('diff',     'diffmodel',         'compare two versions of a CNS model'),
+    ('migrate',  'migrateformdata',   'migrate form data to a new version of its template'),
+]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run one of the CNSParser tools',
+        epilog=
+            'Commands: '
+            + ', '.join(name + ' (' + help + ')' for name, module, help in commands) + '. '
+            'Use "%(prog)s COMMAND --help" for the arguments of a command.'
+    )
+
+    parser.add_argument(
+        '-V', '--version',
+        action  = 'version',
+        version = '%(prog)s 0.1'
+    )
+    parser.add_argument(
+        'command', metavar='COMMAND',
+        choices = [name for name, module, help in commands],
+        help    = 'the command to run'
+    )
+    parser.add_argument(
+        'arguments', metavar='ARGUMENTS',
+        nargs   = argparse.REMAINDER,
+        help    = 'the arguments of the command'
+    )
+
+    args = parser.parse_args(argv)
+
+    module = importlib.import_module(dict((name, module) for name, module, help in commands)[args.command])
+
+    return module.main(args.arguments, parser.prog + ' ' + args.command)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import re
+
+from cnsrender import TEXT, SUBST, HIDDEN_PARAM, PARAM, SECTION
+from cnsruntime import escape
+
+# Code generator {{{
+
+def literal_placeholder(repeat_index):
+    """\
+    Checks whether substituting a placeholder is the same as replacing it as
+    a literal string, also in text in which other placeholders were filled
+    in already.
+    """
+    return (
+            len(repeat_index) > 0
+        and re.escape(repeat_index) == repeat_index
+        and re.search('[0-9]', repeat_index) is None
+    )
+
+def number_variable(index):
+    """\
+    Returns the name of the variable that holds the current repetition
+    number of a section or parameter, as a string starting at 1.
+    """
+    return 'n' + str(index)
+
+class Expression(object):
+    """\
+    A string expression in generated code: a concatenation of constant
+    strings and repetition numbers.
+    """
+
+    def __init__(self, items=()):
+        # Constant strings, and the code of variables and runtime expressions
+        # wrapped in a 1-tuple.
+        self.items = list(items)
+
+    def add(self, item):
+        if isinstance(item, Expression):
+            for child in item.items:
+                self.add(child)
+        elif isinstance(item, RuntimeExpression):
+            self.items.append(('(' + item.code() + ')',))
+        elif isinstance(item, tuple):
+            self.items.append(item)
+        elif len(item):
+            if len(self.items) and not isinstance(self.items[-1], tuple):
+                self.items[-1] += item
+            else:
+                self.items.append(item)
+        return self
+
+    def constant(self):
+        """\
+        Returns the value of the expression if it does not contain numbers,
+        and None otherwise.
+        """
+        if not len(self.items):
+            return ''
+        if len(self.items) == 1 and not isinstance(self.items[0], tuple):
+            return self.items[0]
+        return None
+
+    def map_constants(self, function):
+        """\
+        Returns an expression with function applied to all constant strings.
+        """
+        return Expression(
+            item if isinstance(item, tuple) else function(item) for item in self.items
+        )
+
+    def code(self):
+        if not len(self.items):
+            return "''"
+        return ' + '.join(
+            item[0] if isinstance(item, tuple) else repr(item) for item in self.items
+        )
+
+class RuntimeExpression(object):
+    """\
+    A string expression that is computed by generated code at runtime.
+    """
+
+    def __init__(self, code):
+        self.code_ = code
+
+    def code(self):
+        return self.code_
+
+def placeholder_expression(text, chain):
+    """\
+    Returns an expression for text with the placeholders of a chain of
+    (repeat_index, component_index) pairs filled in, see replace_placeholders().
+    """
+    if not len(chain):
+        return Expression([text])
+
+    if not all(literal_placeholder(repeat_index) for repeat_index, index in chain):
+        return RuntimeExpression(
+            'replace_placeholders(' + repr(text) + ', ['
+                + ', '.join(
+                    '(' + repr(repeat_index) + ', int(' + number_variable(index) + ') - 1)'
+                        for repeat_index, index in chain
+                )
+                + '])'
+        )
+
+    items = [text]
+    for repeat_index, index in chain:
+        split = []
+        for item in items:
+            if isinstance(item, tuple):
+                split.append(item)
+                continue
+            parts = item.split(repeat_index)
+            for part in parts[:-1]:
+                split.extend([part, (number_variable(index),)])
+            split.append(parts[-1])
+        items = split
+
+    expression = Expression()
+    for item in items:
+        expression.add(item)
+    return expression
+
+def marker_split(text):
+    """\
+    Splits text with markers, which are enclosed in NUL characters, into
+    constant strings and markers. Markers are returned as 1-tuples.
+    """
+    parts = text.split('\0')
+    return [part if i % 2 == 0 else (part,) for i, part in enumerate(parts)]
+
+class Generator(object):
+    """\
+    Generates the Python source of a render function for a render program.
+
+    Every section gets a function that renders all of its repetitions,
+    every parameter gets a function that renders all of its repetitions.
+    The generated code checks form data exactly like the Renderer does, and
+    raises Fallback where the Renderer does. Sections without access are
+    rendered by their functions instead of from prerendered output.
+
+    A second set of functions renders columnar form data (see cnscolumnar),
+    reading repetition counts and values from the columns of the components.
+    """
+
+    def __init__(self, program):
+        self.program   = program
+        self.table     = program.table
+        self.parser    = program.parser
+        self.output    = []
+        self.indent    = 0
+        self.constants = []
+        self.columnar  = False # Whether functions for columnar form data are generated
+
+    def line(self, code):
+        self.output.append('    ' * self.indent + code)
+
+    def source(self):
+        for node in self.sorted_nodes():
+            self.constants.append('L' + str(node.index) + ' = frozenset(' + repr(sorted(node.levels)) + ')')
+        for op in self.parameter_ops(self.program.root):
+            self.constants.append('L' + str(op[3]) + ' = ' + repr(tuple(self.table[op[3]]['accesslevels'])))
+        self.constants.append('multiline = ' + repr(self.program.multiline))
+
+        for self.columnar in (False, True):
+            if self.columnar:
+                self.function('render_columnar_root', ['cns', 'state'])
+                self.line('present = True')
+            else:
+                self.function('render_root', ['cns', 'state', 'instances'])
+            self.line('has_access = True')
+            self.ops(self.program.root)
+
+            for node in self.sorted_nodes():
+                self.section(node)
+
+            for op in self.parameter_ops(self.program.root):
+                self.parameter(op)
+
+        return '\n'.join(self.constants + [''] + self.output) + '\n'
+
+    def sorted_nodes(self):
+        return [self.program.nodes[index] for index in sorted(self.program.nodes)]
+
+    def parameter_ops(self, node):
+        for op in node.ops:
+            if op[0] == PARAM:
+                yield op
+            elif op[0] == SECTION:
+                for child_op in self.parameter_ops(op[1]):
+                    yield child_op
+
+    def function(self, name, arguments):
+        self.indent = 0
+        self.line('')
+        self.line('def ' + name + '(' + ', '.join(arguments) + '):')
+        self.indent = 1
+        self.line('append = cns.append')
+        self.line('extend = cns.extend')
+
+    def chain_arguments(self, chain):
+        return [number_variable(index) for repeat_index, index in chain]
+
+    def outer_chain(self, node):
+        return node.chain[:-1] if node.component['repeat'] else node.chain
+
+    def function_name(self, kind, index):
+        """\
+        Returns the name of the function of a section (kind 's') or a parameter (kind 'p').
+        """
+        return ('c' if self.columnar else '') + kind + str(index)
+
+    def count(self):
+        """\
+        Returns the code for the amount of repetitions of the current instance.
+        """
+        return 'repetitions' if self.columnar else 'len(repetitions)'
+
+    def read_repetitions(self, index):
+        """\
+        Generates the code that reads the repetitions of the current instance.
+        """
+        if self.columnar:
+            self.line('repetitions = next(state.repetitions[' + str(index) + '])')
+        else:
+            self.line("repetitions = instance['repetitions']")
+
+    def check_repetitions(self, component):
+        """\
+        Generates the repetition count checks of repetitions_allowed().
+        """
+        count = self.count()
+        if component['repeat']:
+            if component['repeat_min'] is not None:
+                self.line('if ' + count + ' < ' + str(component['repeat_min']) + ': raise Fallback()')
+            if component['repeat_max'] is not None:
+                self.line('if ' + count + ' > ' + str(component['repeat_max']) + ': raise Fallback()')
+        else:
+            self.line('if ' + count + ' != 1: raise Fallback()')
+
+    def emit(self, expression):
+        self.line('append(' + expression.code() + ')')
+
+    def text_expression(self, op):
+        if op[0] == TEXT:
+            return Expression([op[1]])
+        return placeholder_expression(op[1], op[2])
+
+    def name_expression(self, text, chain, value=False):
+        """\
+        Returns an expression for a parameter line with the placeholders in
+        its parameter names filled in, see CNSParser.substitute_parameter_name().
+        If value is True, the value in the line is replaced by the variable
+        value, see CNSParser.substitute_parameter_value().
+        Returns None if the line can not be handled.
+        """
+        if '\0' in text:
+            return None
+
+        if value:
+            text = self.parser.substitute_parameter_value(text, '\0value\0')
+
+        names = []
+        def mark(name):
+            names.append(name)
+            return '\0' + str(len(names) - 1) + '\0'
+
+        expression = Expression()
+        for part in marker_split(self.parser.substitute_parameter_name(text, mark)):
+            if part == ('value',):
+                expression.add(part)
+            elif isinstance(part, tuple):
+                expression.add(placeholder_expression(names[int(part[0])], chain))
+            else:
+                expression.add(part)
+        return expression
+
+    def ops(self, node):
+        """\
+        Generates the code for a single repetition of a section, with the
+        child instances in the variable instances, which may be None.
+        For columnar form data, the variable present tells whether the child
+        instances exist.
+        """
+        ops      = node.ops
+        children = [op for op in ops if op[0] in (PARAM, SECTION)]
+        chain    = self.chain_arguments(node.chain)
+
+        if len(children) and not self.columnar:
+            self.line('if instances is not None and len(instances) < ' + str(len(children)) + ': raise Fallback()')
+
+        child_index = 0
+        text        = []
+
+        def flush():
+            if len(text) == 1:
+                self.line('append(' + repr(text[0]) + ')')
+            elif len(text):
+                self.line('extend((' + ', '.join(repr(line) for line in text) + '))')
+            del text[:]
+
+        for op in ops:
+            kind = op[0]
+
+            if kind == TEXT:
+                text.append(op[1])
+                continue
+            flush()
+
+            if kind == SUBST:
+                self.emit(self.text_expression(op))
+
+            elif kind == HIDDEN_PARAM:
+                for prefix_op in op[1]:
+                    self.emit(self.text_expression(prefix_op))
+                expression = self.name_expression(op[2], op[3])
+                if expression is None:
+                    self.line('raise Fallback()')
+                else:
+                    self.emit(expression)
+
+            elif kind == PARAM and self.columnar:
+                self.line('if present:')
+                self.line(
+                    '    ' + self.function_name('p', op[3]) + '('
+                        + ', '.join(['cns', 'state', 'has_access'] + chain) + ')'
+                )
+
+            elif kind == PARAM:
+                self.line('if instances is not None:')
+                self.line(
+                    '    ' + self.function_name('p', op[3]) + '(' + ', '.join(
+                        ['cns', 'state', 'instances[' + str(child_index) + ']', 'has_access'] + chain
+                    ) + ')'
+                )
+                child_index += 1
+
+            elif kind == SECTION and self.columnar:
+                self.line(
+                    self.function_name('s', op[1].index) + '('
+                        + ', '.join(['cns', 'state', 'present', 'has_access'] + chain) + ')'
+                )
+
+            elif kind == SECTION:
+                child = op[1]
+                name  = str(child.index)
+                call  = lambda instance: (
+                    self.function_name('s', name) + '('
+                        + ', '.join(['cns', 'state', instance, 'has_access'] + chain) + ')'
+                )
+                self.line('if instances is not None:')
+                self.line('    instance = instances[' + str(child_index) + ']')
+                self.line("    if instance['component_index'] != " + name + ': raise Fallback()')
+                self.line('    ' + call('instance'))
+                self.line('else:')
+                self.line('    ' + call('None'))
+                child_index += 1
+
+        flush()
+
+    def section(self, node):
+        component = node.component
+        name      = str(node.index)
+
+        self.function(
+            self.function_name('s', name),
+            ['cns', 'state', 'present' if self.columnar else 'instance', 'has_access']
+                + self.chain_arguments(self.outer_chain(node))
+        )
+        self.line('if present:' if self.columnar else 'if instance is not None:')
+        self.indent += 1
+        self.read_repetitions(node.index)
+        self.check_repetitions(component)
+        self.indent -= 1
+        self.line('else:')
+        self.line('    repetitions = ' + ('0' if self.columnar else '[]'))
+        if node.carry:
+            self.line('if ' + self.count() + ' > 1: raise Fallback()')
+        self.line('has_access = has_access and state.level in L' + name)
+
+        # Without repetitions, the section is rendered once without its header.
+        if self.columnar:
+            self.line('present = repetitions > 0')
+            self.line('for repetition in (range(repetitions) if repetitions else (0,)):')
+        else:
+            self.line('for repetition, instances in (enumerate(repetitions) if len(repetitions) else ((0, None),)):')
+        self.indent += 1
+        if component['repeat']:
+            self.line(number_variable(node.index) + ' = str(repetition + 1)')
+        self.line('if ' + self.count() + ':')
+        self.line('    append(' + placeholder_expression(node.header, node.chain).code() + ')')
+        self.ops(node)
+
+    def parameter(self, op):
+        prefix, line, component_index, chain = op[1], op[2], op[3], op[4]
+        component = self.table[component_index]
+        name      = str(component_index)
+        own_chain = chain + ((component['repeat_index'], component_index),) if component['repeat'] else chain
+        is_file   = component['datatype'] == 'file'
+
+        if self.columnar:
+            self.function(self.function_name('p', name), ['cns', 'state', 'has_access'] + self.chain_arguments(chain))
+        else:
+            self.function(
+                self.function_name('p', name), ['cns', 'state', 'instance', 'has_access'] + self.chain_arguments(chain)
+            )
+            self.line("if instance['component_index'] != " + name + ': raise Fallback()')
+        self.read_repetitions(component_index)
+        self.check_repetitions(component)
+        self.line('has_access = has_access and state.level in L' + name)
+
+        if is_file:
+            self.line('local_instance_index = state.file_instance_counts.get(' + name + ', 0)')
+            self.line('state.file_instance_counts[' + name + '] = local_instance_index + 1')
+
+        expression = self.name_expression(line, own_chain, value=True)
+        if expression is None:
+            self.line('raise Fallback()')
+            return
+
+        default = placeholder_expression(component['default'], own_chain)
+
+        def repetition(submitted):
+            if component['repeat']:
+                self.line(number_variable(component_index) + ' = str(repetition + 1)')
+            for prefix_op in prefix:
+                self.emit(self.text_expression(prefix_op))
+
+            if submitted and is_file:
+                # Grab the desired extension from the component's default value.
+                match     = re.search(r'\.(.*)$', component['default'])
+                extension = '.' + match.group(1) if match is not None else ''
+                if self.columnar:
+                    self.line('file_name = state.file_names.get((' + name + ', local_instance_index, repetition))')
+                    self.line('if file_name is not None:')
+                else:
+                    self.line(
+                        "files = state.form_data['files'].get(" + repr(name)
+                            + ', {}).get(str(local_instance_index), {})'
+                    )
+                    self.line('if str(repetition) in files:')
+                    self.line("    file_name = files[str(repetition)]['name']")
+                self.line(
+                    '    filename_new = '
+                        + placeholder_expression(component['name'], own_chain).code()
+                        + (' + ' + repr(extension) if len(extension) else '')
+                )
+                self.line('    state.aux_file_map[file_name] = filename_new')
+                self.line('    if not len(value): raise Fallback()')
+                self.line('    value = filename_new')
+
+            # Escape the default value now if it is known to be valid.
+            if isinstance(default, Expression) and not any(
+                    not isinstance(item, tuple) and '{===>}' in escape(item) for item in default.items
+                ):
+                default_code = default.map_constants(escape).code()
+            else:
+                default_code = 'escape_value(' + default.code() + ')'
+
+            if submitted:
+                self.line('value = ' + default_code + ' if value is None else escape_value(value)')
+            else:
+                self.line('value = ' + default_code)
+            self.emit(expression)
+
+        if self.columnar:
+            self.line('values = state.values[' + name + ']')
+
+        self.line('if has_access:')
+        self.indent += 1
+        if self.columnar:
+            self.line('for repetition in range(repetitions):')
+            self.line('    value = next(values)')
+        else:
+            self.line('for repetition, value in enumerate(repetitions):')
+        self.indent += 1
+        repetition(True)
+        self.indent -= 2
+        self.line('else:')
+        self.indent += 1
+        if self.columnar:
+            # Skip the submitted values.
+            self.line('for repetition in range(repetitions):')
+            self.line('    next(values)')
+        self.line(
+            'for repetition in range('
+                + str(component['repeat_min'] if component['repeat'] else 1) + '):'
+        )
+        self.indent += 1
+        repetition(False)
+
+def generate_source(program):
+    """\
+    Returns the Python source of the render function for a render program.
+    """
+    return Generator(program).source()
+
+def generate_code(program, digest):
+    """\
+    Returns the compiled render function module for a render program.
+    """
+    return compile(generate_source(program), '<cns template ' + digest + '>', 'exec')
+
+# }}}
+
+
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+try:
+    integer_types = (int, long)
+except NameError:
+    integer_types = (int,)
+
+# Columnar form data {{{
+#
+# Form data as read by CNSParser.write() is a tree of instances:
+#
+#     {"level": "easy", "instances": [{"component_index": 1, "repetitions": [...]}, ...],
+#      "files": {"12": {"0": {"0": {"name": "upload.pdb"}}}}}
+#
+# Columnar form data describes the same tree with one column per component,
+# so component indexes are array positions:
+#
+#     {"format": "columnar", "level": "easy",
+#      "repetitions": [[1], [2, 1], [], ...],
+#      "values":      [[], [], ["a", "b", "c"], ...],
+#      "files":       [[12, 0, 0, {"name": "upload.pdb"}]]}
+#
+# - repetitions[i] holds the amount of repetitions of every instance of
+#   component i, in the order the instances appear in the instance tree.
+# - values[i] holds the values of all repetitions of all instances of
+#   parameter i, in the same order.
+# - files holds [component index, local instance index, repetition index,
+#   file] lists for the entries of form_data['files'].
+#
+# The instance tree follows from the template: the instances of a section
+# repetition are those of its sections and parameters that are not hidden,
+# in template order. Other keys of the form data are kept as they are.
+
+def is_columnar(form_data):
+    """\
+    Checks whether form data is in the columnar format.
+    """
+    return isinstance(form_data, dict) and form_data.get('format') == 'columnar'
+
+def instantiated_children(table, index=None):
+    """\
+    Returns the indices of the children of a section (or of the top-level
+    components if index is None) that have an instance in form data.
+    """
+    return [
+        child for child in table.children(index)
+            if table.types[child] != 'paragraph' and not table[child]['hidden']
+    ]
+
+def file_index(key):
+    """\
+    Converts a key of form_data['files'] to an integer.
+    Raises a ValueError for keys that would not be restored exactly.
+    """
+    if not isinstance(key, (str, type(u''))) or not key.isdigit() or str(int(key)) != key:
+        raise ValueError('Invalid file key "' + str(key) + '"')
+    return int(key)
+
+def to_columnar(table, form_data):
+    """\
+    Converts form data to columnar form data, for the template described by
+    a ComponentTable. The conversion is lossless, see from_columnar().
+    Raises a ValueError if the form data does not match the template.
+    """
+    repetitions = [[] for index in range(len(table))]
+    values      = [[] for index in range(len(table))]
+    children    = dict() # Section index => instantiated children
+
+    # Stack of (section index, instances) pairs to convert, in reverse order.
+    pending = [(None, form_data['instances'])]
+
+    while pending:
+        section, instances = pending.pop()
+
+        if section not in children:
+            children[section] = instantiated_children(table, section)
+
+        if not isinstance(instances, list) or len(instances) != len(children[section]):
+            raise ValueError(
+                'Expected ' + str(len(children[section])) + ' instances for '
+                    + ('section ' + str(section) if section is not None else 'the template')
+            )
+
+        sections = []
+        for index, instance in zip(children[section], instances):
+            if (
+                       not isinstance(instance, dict)
+                    or sorted(instance) != ['component_index', 'repetitions']
+                    or instance['component_index'] != index
+                    or not isinstance(instance['repetitions'], list)
+                ):
+                raise ValueError('Invalid instance, expected component index ' + str(index))
+
+            repetitions[index].append(len(instance['repetitions']))
+
+            if table.types[index] == 'section':
+                sections.extend((index, repetition) for repetition in instance['repetitions'])
+            else:
+                values[index].extend(instance['repetitions'])
+
+        pending.extend(reversed(sections))
+
+    columnar = dict(
+        (key, value) for key, value in form_data.items() if key not in ('instances', 'files')
+    )
+    columnar['format']      = 'columnar'
+    columnar['repetitions'] = repetitions
+    columnar['values']      = values
+
+    if 'files' in form_data:
+        columnar['files'] = [
+            [file_index(component_key), file_index(instance_key), file_index(repetition_key), file]
+                for component_key, instances in sorted(form_data['files'].items())
+                for instance_key, repetitions_ in sorted(instances.items())
+                for repetition_key, file in sorted(repetitions_.items())
+        ]
+
+    return columnar
+
+def from_columnar(table, columnar):
+    """\
+    Converts columnar form data back to form data, for the template
+    described by a ComponentTable.
+    Raises a ValueError if the columnar form data does not match the template.
+    """
+    repetitions = columnar['repetitions']
+    values      = columnar['values']
+
+    if len(repetitions) != len(table) or len(values) != len(table):
+        raise ValueError('Expected ' + str(len(table)) + ' columns')
+
+    # The next unread position in every column.
+    repetition_positions = [0] * len(table)
+    value_positions      = [0] * len(table)
+
+    children = dict()
+
+    def read_count(index):
+        position = repetition_positions[index]
+        if position >= len(repetitions[index]):
+            raise ValueError('Missing repetitions for component ' + str(index))
+        count = repetitions[index][position]
+        if not isinstance(count, integer_types) or isinstance(count, bool) or count < 0:
+            raise ValueError('Invalid amount of repetitions for component ' + str(index))
+        repetition_positions[index] = position + 1
+        return count
+
+    def read_section(section):
+        if section not in children:
+            children[section] = instantiated_children(table, section)
+
+        instances = []
+        for index in children[section]:
+            count = read_count(index)
+            if table.types[index] == 'section':
+                instance_repetitions = [read_section(index) for repetition in range(count)]
+            else:
+                position = value_positions[index]
+                if position + count > len(values[index]):
+                    raise ValueError('Missing values for component ' + str(index))
+                instance_repetitions = values[index][position:position + count]
+                value_positions[index] = position + count
+            instances.append({'component_index': index, 'repetitions': instance_repetitions})
+        return instances
+
+    form_data = dict(
+        (key, value) for key, value in columnar.items()
+            if key not in ('format', 'repetitions', 'values', 'files')
+    )
+    form_data['instances'] = read_section(None)
+
+    for index in range(len(table)):
+        if (
+                   repetition_positions[index] != len(repetitions[index])
+                or value_positions[index] != len(values[index])
+            ):
+            raise ValueError('Unused repetitions or values for component ' + str(index))
+
+    if 'files' in columnar:
+        files = dict()
+        for component_index, instance_index, repetition_index, file in columnar['files']:
+            files.setdefault(str(component_index), dict()).setdefault(str(instance_index), dict())[
+                str(repetition_index)
+            ] = file
+        form_data['files'] = files
+
+    return form_data
+
+def iter_files(form_data):
+    """\
+    Iterates over the uploaded files in form data, in either format.
+    """
+    if is_columnar(form_data):
+        for component_index, instance_index, repetition_index, file in form_data.get('files', ()):
+            yield file
+    else:
+        for instances in form_data.get('files', {}).values():
+            for repetitions in instances.values():
+                for file in repetitions.values():
+                    yield file
+
+# }}}
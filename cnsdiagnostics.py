@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import json
+import threading
+
+class Diagnostic(object):
+    """\
+    A warning of the parser.
+
+    - code:      A short name for the kind of warning, such as
+                 'unlabeled-parameter', or None
+    - line_no:   The line number in the template
+    - component: The name of the component the warning is about, or None
+    - count:     The amount of times the warning was given
+
+    The message is only formatted when it is needed: text is a format
+    string for the arguments, like the arguments of the % operator.
+    """
+
+    def __init__(self, code, line_no, component, text, args=()):
+        self.code      = code
+        self.line_no   = line_no
+        self.component = component
+        self.text      = text
+        self.args      = args
+        self.count     = 1
+
+    @property
+    def message(self):
+        return self.text % self.args if len(self.args) else self.text
+
+    def key(self):
+        """\
+        Returns the key that identifies repeated warnings, for example the
+        warnings for a line in every repetition of a section.
+        """
+        return (self.code, self.line_no, self.component, self.text, self.args)
+
+    def to_dict(self):
+        return {
+            'code':      self.code,
+            'line':      self.line_no,
+            'component': self.component,
+            'message':   self.message,
+            'count':     self.count,
+        }
+
+    def __str__(self):
+        return 'Warning on line ' + str(self.line_no) + ': ' + self.message
+
+class Diagnostics(object):
+    """\
+    Collects the warnings of one or more CNSParser calls, see the
+    diagnostics argument of CNSParser.
+
+    Repeated warnings are recorded once, with a count. With a limit, at
+    most that amount of different warnings is recorded for each code, the
+    others are only counted as suppressed. Recorded warnings are printed to
+    the stream as they come in, if one is given.
+
+    The collector can be shared by parsers in multiple threads.
+    """
+
+    def __init__(self, limit=None, stream=None):
+        self.limit      = limit
+        self.stream     = stream
+        self.entries    = []     # Recorded Diagnostics, in order
+        self.index      = dict() # Maps keys to recorded Diagnostics
+        self.code_count = dict() # Maps codes to the amount of recorded Diagnostics
+        self.suppressed = dict() # Maps codes to keys of suppressed Diagnostics
+        self.lock       = threading.Lock()
+
+    def add(self, diagnostic):
+        """\
+        Records a Diagnostic, unless it is a repeated or suppressed warning.
+        Returns True if the warning was recorded.
+        """
+        key = diagnostic.key()
+        with self.lock:
+            if key in self.index:
+                self.index[key].count += diagnostic.count
+                return False
+
+            code_count = self.code_count.get(diagnostic.code, 0)
+            if self.limit is not None and code_count >= self.limit:
+                self.suppressed.setdefault(diagnostic.code, set()).add(key)
+                return False
+
+            self.entries.append(diagnostic)
+            self.index[key] = diagnostic
+            self.code_count[diagnostic.code] = code_count + 1
+
+            if self.stream is not None:
+                print(str(diagnostic), file=self.stream)
+                if self.limit is not None and code_count + 1 == self.limit and diagnostic.code is not None:
+                    print('Further "' + diagnostic.code + '" warnings are not shown', file=self.stream)
+            return True
+
+    def extend(self, diagnostics):
+        """\
+        Adds Diagnostics in order, for example those of a parser in another
+        process.
+        """
+        for diagnostic in diagnostics:
+            self.add(diagnostic)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def to_list(self):
+        """\
+        Returns the recorded warnings as a list of dictionaries, see
+        Diagnostic.to_dict().
+        """
+        return [diagnostic.to_dict() for diagnostic in self.entries]
+
+    def to_dict(self):
+        """\
+        Returns the recorded warnings and the amount of suppressed warnings
+        by code.
+        """
+        return {
+            'diagnostics': self.to_list(),
+            'suppressed':  dict((code, len(keys)) for code, keys in self.suppressed.items()),
+        }
+
+    def save(self, path):
+        """\
+        Writes the recorded warnings to a JSON file, see to_dict().
+        """
+        with open(path, 'w') as fp:
+            json.dump(self.to_dict(), fp, sort_keys=True)
+            fp.write('\n')
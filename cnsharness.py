@@ -0,0 +1,1118 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import collections
+import copy
+import difflib
+import io
+import itertools
+import math
+import random
+import re
+import timeit
+
+from cnscolumnar import from_columnar, to_columnar
+from cnsmigrate import FormDataMigration
+from cnsmodeldiff import diff_models
+from cnsparser import CNSParser, LineMemo
+from cnsmodel import BinaryModel, ComponentTable, dump_binary
+from cnstemplate import TemplateCache, TemplateStore
+
+# Engines {{{
+
+class Engine(object):
+    """\
+    An implementation of CNSParser.parse() and/or CNSParser.write().
+
+    Engines implement parse(lines), write(lines, form_data, aux_file_root)
+    or both, with the same return values as the CNSParser methods. Lines
+    is a list of template lines, including line endings.
+
+    prepare(lines, form_data) is called before write() is timed, for work
+    that an application would do only once.
+    """
+
+    def prepare(self, lines, form_data):
+        pass
+
+class ParserEngine(Engine):
+    """\
+    The reference implementation: a new CNSParser for every call.
+    """
+
+    def parse(self, lines):
+        return CNSParser(source=lines).parse()
+
+    def write(self, lines, form_data, aux_file_root):
+        return CNSParser(source=lines).write(form_data, aux_file_root)
+
+class ParallelEngine(Engine):
+    """\
+    Parses with worker processes, see CNSParser.parse_parallel(). Templates
+    are split even if there is a single CPU, and however small they are.
+    """
+
+    def parse(self, lines):
+        parser = CNSParser(source=lines)
+        parser.parallel_min_lines = 0
+        return parser.parse(processes=2)
+
+class TemplateEngine(Engine):
+    """\
+    Parses and renders through cached Templates, see cnstemplate.
+    Templates are loaded from a private cache, so repeated calls measure
+    the cached case.
+    """
+
+    def __init__(self):
+        self.cache = TemplateCache()
+
+    def parse(self, lines):
+        return self.cache.load(''.join(lines)).model()
+
+    def write(self, lines, form_data, aux_file_root):
+        return self.cache.load(''.join(lines)).write(form_data, aux_file_root)
+
+class CompiledEngine(Engine):
+    """\
+    Renders with the compiled render program of cached Templates only, see
+    cnsrender. Unlike the template engine, it does not fall back to
+    CNSParser.write().
+    """
+
+    def __init__(self):
+        self.cache = TemplateCache()
+
+    def write(self, lines, form_data, aux_file_root):
+        return self.cache.load(''.join(lines)).compiled().render(form_data)
+
+class GeneratedEngine(Engine):
+    """\
+    Renders with the generated render function of cached Templates only, see
+    cnscodegen. It does not fall back to CNSParser.write().
+    """
+
+    def __init__(self):
+        self.cache = TemplateCache()
+
+    def write(self, lines, form_data, aux_file_root):
+        return self.cache.load(''.join(lines)).generated().render(form_data)
+
+class ColumnarEngine(Engine):
+    """\
+    Converts form data to the columnar format (see cnscolumnar), checks that
+    it converts back to the same form data, and renders it with the
+    generated render function of cached Templates only.
+    """
+
+    def __init__(self):
+        self.cache = TemplateCache()
+
+    def write(self, lines, form_data, aux_file_root):
+        template = self.cache.load(''.join(lines))
+        columnar = to_columnar(template.table, form_data)
+        if from_columnar(template.table, columnar) != form_data:
+            raise AssertionError('Columnar form data does not convert back to the same form data')
+        return template.generated().render(columnar)
+
+class RewriteEngine(Engine):
+    """\
+    Renders with CNSParser.rewrite(), starting from the rendering of the same
+    form data with every other parameter value changed, so that both changed
+    and unchanged instances are compared.
+    """
+
+    def __init__(self):
+        self.previous = None
+
+    def prepare(self, lines, form_data):
+        previous_form_data = copy.deepcopy(form_data)
+        values             = itertools.count()
+
+        def change(instances):
+            for instance in instances:
+                for index, repetition in enumerate(instance['repetitions']):
+                    if isinstance(repetition, list):
+                        change(repetition)
+                    elif next(values) % 2:
+                        instance['repetitions'][index] = repetition + '_previous'
+
+        change(previous_form_data['instances'])
+
+        try:
+            cns, aux_file_map = CNSParser(source=lines).write(previous_form_data, '')
+        except Exception:
+            # Let rewrite() fall back to write() with the same error.
+            cns = []
+
+        self.previous = (cns, previous_form_data)
+
+    def write(self, lines, form_data, aux_file_root):
+        cns, previous_form_data = self.previous
+        cns, aux_file_map, changed = CNSParser(source=lines).rewrite(
+            cns, previous_form_data, form_data, aux_file_root
+        )
+        return cns, aux_file_map
+
+class BinaryEngine(Engine):
+    """\
+    Parses with CNSParser, and checks that the model reads back the same from
+    the binary model format (see cnsmodel.dump_binary()).
+    """
+
+    def parse(self, lines):
+        accesslevels, components = CNSParser(source=lines).parse()
+
+        fp = io.BytesIO()
+        dump_binary(accesslevels, components, fp)
+        if textual(BinaryModel(fp.getvalue()).materialise()) != textual((accesslevels, components)):
+            raise AssertionError('The binary model does not read back the same model')
+
+        return accesslevels, components
+
+class MigrationEngine(Engine):
+    """\
+    Migrates form data, in both formats, to an identical template (see
+    cnsmigrate), checks that nothing changed or was dropped, and renders the
+    migrated form data with CNSParser.write().
+    """
+
+    def __init__(self):
+        self.cache = TemplateCache()
+
+    def write(self, lines, form_data, aux_file_root):
+        template  = self.cache.load(''.join(lines))
+        migration = FormDataMigration(template, template)
+
+        migrated, dropped = migration.migrate(form_data)
+        if migrated != form_data or dropped:
+            raise AssertionError('Migrating to an identical template changed the form data')
+
+        columnar = to_columnar(template.table, form_data)
+        if migration.migrate(columnar) != (columnar, []):
+            raise AssertionError('Migrating to an identical template changed the columnar form data')
+
+        return CNSParser(source=lines).write(migrated, aux_file_root)
+
+class ExtractionEngine(Engine):
+    """\
+    Renders with CNSParser.write(), reconstructs the form data from the
+    output with CNSParser.extract_form_data(), and renders the reconstructed
+    form data again. Form data is reconstructed with the access level it was
+    rendered with, and every parameter instance must be found.
+    """
+
+    def write(self, lines, form_data, aux_file_root):
+        parser = CNSParser(source=lines)
+        cns, aux_file_map = parser.write(form_data, aux_file_root)
+
+        extracted, missing = parser.extract_form_data(cns, level=form_data['level'])
+        if len(missing):
+            raise AssertionError('Parameter instances not found in the rendered file: ' + ', '.join(missing))
+
+        cns, extracted_aux_file_map = parser.write(extracted, aux_file_root)
+        return cns, aux_file_map
+
+# The value of a parameter definition in a rendered CNS file, quoted or not.
+rendered_value = re.compile(r'\{===>\}\s*[a-zA-Z0-9_]+\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;]*?))\s*;')
+
+class ResolveEngine(Engine):
+    """\
+    Renders with CNSParser.write(), and checks that Template.resolve_items()
+    returns the values of the rendered parameter definitions in order,
+    converted to their datatypes, and that Template.resolve() returns the
+    same values by name.
+    """
+
+    def __init__(self):
+        self.cache = TemplateCache()
+
+    def write(self, lines, form_data, aux_file_root):
+        cns, aux_file_map = CNSParser(source=lines).write(form_data, aux_file_root)
+        template = self.cache.load(''.join(lines))
+
+        rendered = []
+        for line in cns:
+            match = rendered_value.search(line)
+            if match is not None:
+                value = match.group(1) if match.group(1) is not None else match.group(2)
+                rendered.append(re.sub(r'\\(["\\])', r'\1', value))
+
+        entries = template.compiled().resolve(form_data)
+        if len(entries) != len(rendered):
+            raise AssertionError('Resolved ' + str(len(entries)) + ' values, but ' + str(len(rendered)) + ' were rendered')
+
+        expected = []
+        for (name, index, resolved, submitted), value in zip(entries, rendered):
+            try:
+                expected.append((name, template.validators[index](value)))
+            except ValueError:
+                expected.append((name, value))
+
+        items = template.resolve_items(form_data)
+        if items != expected:
+            raise AssertionError('resolve_items() differs from the rendered values')
+        if template.resolve(form_data) != dict(items):
+            raise AssertionError('resolve() differs from resolve_items()')
+
+        return cns, aux_file_map
+
+class CheckValuesEngine(Engine):
+    """\
+    Renders with CNSParser.write(), and checks that Template.check_values()
+    reports no problems only for form data that write() accepts: the form
+    data itself, whose values are all valid, and variants with a
+    repetition less or a value cleared (see form_data_reductions()).
+    """
+
+    # The amount of variants checked per case.
+    variants = 8
+
+    def __init__(self):
+        self.cache = TemplateCache()
+
+    def write(self, lines, form_data, aux_file_root):
+        template = self.cache.load(''.join(lines))
+
+        variants = itertools.islice(form_data_reductions(form_data), self.variants)
+        for variant in itertools.chain([form_data], variants):
+            values, errors = template.check_values(variant)
+            accepted = outcome(CNSParser(source=lines).write, variant, aux_file_root)[0] == 'ok'
+            if not len(errors) and not accepted:
+                raise AssertionError('check_values() reports no problems for form data that write() rejects')
+            if len(errors) and variant is form_data:
+                raise AssertionError('check_values() reports problems for valid form data: ' + repr(errors))
+
+        return CNSParser(source=lines).write(form_data, aux_file_root)
+
+class LineMemoEngine(Engine):
+    """\
+    Parses and renders without a LineMemo, and checks that parsing with a
+    small memo that is cleared every few lines gives the same model twice.
+    The reference engine uses the memo shared by all parsers.
+    """
+
+    def __init__(self):
+        self.memo = LineMemo(max_entries=8)
+
+    def parse(self, lines):
+        model = CNSParser(source=lines, memo=None).parse()
+        for _ in range(2):
+            if textual(CNSParser(source=lines, memo=self.memo).parse()) != textual(model):
+                raise AssertionError('Parsing with a small memo gives a different model')
+        return model
+
+    def write(self, lines, form_data, aux_file_root):
+        return CNSParser(source=lines, memo=None).write(form_data, aux_file_root)
+
+class TemplateStoreEngine(Engine):
+    """\
+    Parses and renders through Templates that share a TemplateStore (see
+    cnstemplate) with a variant of the same template. The variant has an
+    extra comment line at the end, so it has another digest, but shares
+    all other lines.
+    """
+
+    def __init__(self):
+        self.cache = TemplateCache(store=TemplateStore())
+
+    def template(self, lines):
+        variant  = self.cache.load(''.join(lines) + '! A variant\n')
+        template = self.cache.load(''.join(lines))
+        if not all(line is variant_line for line, variant_line in zip(template.lines, variant.lines)):
+            raise AssertionError('The template does not share its lines with the variant')
+        return template
+
+    def parse(self, lines):
+        return self.template(lines).model()
+
+    def write(self, lines, form_data, aux_file_root):
+        return self.template(lines).write(form_data, aux_file_root)
+
+class ModelDiffEngine(Engine):
+    """\
+    Checks that the ModelDiff (see cnsmodeldiff) of a model with itself is
+    empty, and that inserting a paragraph before all other components
+    shifts every component index by one. The form data is shifted through
+    the index map and rendered with CNSParser.write() on the shifted
+    template, and the inserted paragraph is removed from the output.
+    """
+
+    # The lines inserted in the template.
+    paragraph = ['', '{* An inserted paragraph *}', '']
+
+    def write(self, lines, form_data, aux_file_root):
+        accesslevels, components = CNSParser(source=lines).parse()
+        if not diff_models(components, components, accesslevels, accesslevels).is_empty():
+            raise AssertionError('The diff of a model with itself is not empty')
+
+        # Insert the paragraph after the access levels, where lines are
+        # still rendered one to one.
+        position = 0
+        while 'begin block parameter definition' not in lines[position]:
+            position += 1
+        position += 1
+        while position < len(lines) and (not lines[position].strip() or lines[position].startswith('{!accesslevel')):
+            position += 1
+
+        shifted_lines = lines[:position] + [line + '\n' for line in self.paragraph] + lines[position:]
+        shifted_accesslevels, shifted_components = CNSParser(source=shifted_lines).parse()
+
+        diff  = diff_models(components, shifted_components, accesslevels, shifted_accesslevels)
+        table = ComponentTable(components)
+        if (
+                len(diff.removed) or len(diff.added) or len(diff.moved) or len(diff.changed)
+                or diff.index_map != dict(
+                    (index, index + 1) for index in range(len(table)) if table.types[index] != 'paragraph'
+                )
+            ):
+            raise AssertionError('Inserting a paragraph does not shift all component indices by one')
+
+        def shift(instances):
+            return [
+                {
+                    'component_index': diff.index_map[instance['component_index']],
+                    'repetitions':     [
+                        shift(repetition) if isinstance(repetition, list) else repetition
+                            for repetition in instance['repetitions']
+                    ],
+                }
+                    for instance in instances
+            ]
+
+        shifted = {
+            'level':     form_data['level'],
+            'instances': shift(form_data['instances']),
+            'files':     dict(
+                (str(diff.index_map[int(index)]), files) for index, files in form_data['files'].items()
+            ),
+        }
+
+        cns, aux_file_map = CNSParser(source=shifted_lines).write(shifted, aux_file_root)
+        del cns[position:position + len(self.paragraph)]
+        return cns, aux_file_map
+
+# The engine that all other engines are compared with.
+reference_engine = ParserEngine()
+
+# Engines by name, in the order they are reported.
+engines = collections.OrderedDict()
+
+def register_engine(name, engine):
+    """\
+    Adds an engine to the registry. An existing engine with the same name
+    is replaced.
+    """
+    engines[name] = engine
+
+register_engine('parallel', ParallelEngine())
+register_engine('template', TemplateEngine())
+register_engine('compiled', CompiledEngine())
+register_engine('codegen',  GeneratedEngine())
+register_engine('columnar', ColumnarEngine())
+register_engine('rewrite',  RewriteEngine())
+register_engine('binary',   BinaryEngine())
+register_engine('migrate',  MigrationEngine())
+register_engine('extract',  ExtractionEngine())
+register_engine('resolve',  ResolveEngine())
+register_engine('check',    CheckValuesEngine())
+register_engine('memo',     LineMemoEngine())
+register_engine('store',    TemplateStoreEngine())
+register_engine('diff',     ModelDiffEngine())
+
+# }}}
+
+# Random templates and form data {{{
+
+accesslevel_pool = ['easy', 'normal', 'expert', 'guru']
+placeholder_pool = ['AA', 'BB', 'NN', 'MM', 'XX']
+word_pool        = ['alpha', 'beta', 'gamma', 'delta', 'omega', 'sigma']
+string_pool      = ['', 'text', 'two words', 'say "hi"', 'dots.and-dashes', 'back\\slash', "it's"]
+option_pool      = ['one', 'two', 'three', '"quoted"', 'four.4']
+
+# Non-ASCII text, a UTF-8 byte string on Python 2 like the template lines read
+# from a file. It is used in labels, paragraphs, defaults and submitted
+# values, but not in names.
+non_ascii_word = u'r\u00e9pertoire'
+if str is bytes:
+    non_ascii_word = non_ascii_word.encode('utf-8')
+
+text_pool    = word_pool + [non_ascii_word]
+string_pool += [non_ascii_word]
+
+class TemplateGenerator(object):
+    """\
+    Generates random, valid CNS templates.
+
+    The templates contain nested and repeated sections and parameters, hidden
+    components, access level restrictions, all datatypes including files,
+    labels and paragraphs that span one or more lines, quoted and unquoted
+    values, comments, tables and lines CNSParser does not recognize.
+    """
+
+    def __init__(self, rnd, max_components=30, max_depth=3):
+        self.rnd            = rnd
+        self.max_components = max_components
+        self.max_depth      = max_depth
+
+    def generate(self):
+        """\
+        Returns a template as a list of lines, including line endings.
+        """
+        rnd = self.rnd
+
+        self.lines      = []
+        self.components = 0
+        self.names      = 0
+
+        self.emit('! Generated template')
+        self.emit('{+ table: rows=2 "a" "b"')
+        self.emit('          cols=2 "c" "d" +}')
+        self.emit('{- begin block parameter definition -} define(')
+        self.emit('')
+
+        self.accesslevels = accesslevel_pool[:rnd.randint(1, len(accesslevel_pool))]
+        for name in self.accesslevels:
+            self.emit('{!accesslevel ' + name + ' "' + name.capitalize() + ' level"}')
+        self.emit('')
+
+        levels = list(self.accesslevels)
+
+        # Top-level components before the first section.
+        self.body(levels, [], False, rnd.randint(0, 2))
+
+        while self.components < self.max_components:
+            self.section(0, levels, [], False)
+
+        self.emit('')
+        self.emit('{- end block parameter definition -}')
+        self.emit('evaluate ($data.ncomponents=&ncomponents)')
+
+        return self.lines
+
+    def emit(self, text):
+        for line in text.split('\n'):
+            self.lines.append(line + '\n')
+
+    def name(self):
+        self.names += 1
+        return self.rnd.choice(word_pool) + str(self.names)
+
+    def access_attributes(self, inherited):
+        """\
+        Returns a list of access level attributes, and the access levels they
+        result in, given the (ordered) inherited access levels.
+        """
+        rnd   = self.rnd
+        names = self.accesslevels
+        kind  = rnd.choice(['none', 'none', 'none', 'exclude', 'min', 'max'])
+
+        if kind == 'exclude':
+            excluded = rnd.choice(names)
+            return ['#level-exclude=' + excluded], [name for name in inherited if name != excluded]
+
+        if kind in ('min', 'max') and len(inherited):
+            bound = rnd.choice(inherited)
+            if kind == 'min':
+                levels = [name for name in inherited if names.index(name) >= names.index(bound)]
+            else:
+                levels = [name for name in inherited if names.index(name) <= names.index(bound)]
+            attributes = ['#level-' + kind + '=' + bound]
+
+            others = [name for name in inherited if name not in levels]
+            if len(others) and rnd.random() < 0.5:
+                included = rnd.choice(others)
+                attributes.append('#level-include=' + included)
+                levels = [name for name in inherited if name in levels or name == included]
+
+            return attributes, levels
+
+        return [], list(inherited)
+
+    def repeat_attributes(self, placeholders):
+        """\
+        Returns a list of repeat attributes and the new placeholder, or an
+        empty list and None.
+        """
+        rnd       = self.rnd
+        available = [placeholder for placeholder in placeholder_pool if placeholder not in placeholders]
+
+        if not len(available) or rnd.random() < 0.7:
+            return [], None
+
+        placeholder = rnd.choice(available)
+        attributes  = ['#multi-index=' + placeholder]
+
+        minimum = None
+        if rnd.random() < 0.5:
+            minimum = rnd.randint(0, 2)
+            attributes.append('#multi-min=' + str(minimum))
+        if rnd.random() < 0.3:
+            attributes.append('#multi-max=' + str(rnd.randint(max(1, minimum or 1), 3)))
+
+        return attributes, placeholder
+
+    def emit_attributes(self, attributes):
+        """\
+        Emits hash attributes on one or more lines.
+        """
+        rnd = self.rnd
+        if not len(attributes):
+            return
+        if rnd.random() < 0.5:
+            self.emit('! ' + ' '.join(attributes))
+        else:
+            for attribute in attributes:
+                self.emit(rnd.choice(['! ', '!', '  ! note ']) + attribute)
+
+    def emit_paragraph(self, text):
+        if self.rnd.random() < 0.2:
+            self.emit('{* ' + text)
+            self.emit('   continued *}')
+        else:
+            self.emit('{* ' + text + ' *}')
+
+    def value(self, datatype, placeholders):
+        """\
+        Returns a default value for a parameter definition, quoted or unquoted.
+        """
+        rnd = self.rnd
+        if datatype == 'integer':
+            value = str(rnd.randint(0, 100))
+        elif datatype == 'float':
+            value = str(rnd.randint(0, 100)) + '.' + str(rnd.randint(0, 9))
+        elif datatype == 'file':
+            value = 'input' + ''.join(placeholders) + '.pdb'
+        elif datatype == 'choice':
+            value = 'one'
+        else:
+            value = rnd.choice(text_pool + [''] + placeholders)
+
+        # Unquoted values are limited to ASCII.
+        if datatype == 'string' or value == non_ascii_word or rnd.random() < 0.3:
+            return '"' + value + '"'
+        return value
+
+    def parameter(self, levels, placeholders, hidden):
+        rnd = self.rnd
+        self.components += 1
+
+        attributes, levels = self.access_attributes(levels)
+        repeat, placeholder = self.repeat_attributes(placeholders)
+        attributes += repeat
+        if rnd.random() < 0.1:
+            attributes.append('#hidden')
+
+        name_placeholders = placeholders + ([placeholder] if placeholder is not None else [])
+
+        datatype = rnd.choice(['integer', 'float', 'string', 'file', 'choice', None])
+        if datatype == 'choice':
+            choice = '{+ choice: ' + ' '.join(rnd.sample(option_pool, rnd.randint(1, 4))) + ' one +}'
+        elif datatype is not None:
+            attributes.append('#type=' + datatype)
+
+        lines = []
+        if rnd.random() < 0.8:
+            text = 'Label for ' + ' '.join(name_placeholders) + ' ' + rnd.choice(text_pool)
+            lines.append(lambda: self.emit_paragraph(text))
+        lines.append(lambda: self.emit_attributes(attributes))
+        if datatype == 'choice':
+            lines.append(lambda: self.emit(choice))
+        rnd.shuffle(lines)
+        for line in lines:
+            line()
+
+        name = '_'.join([self.name()] + name_placeholders)
+        self.emit('{===>} ' + name + rnd.choice(['=', ' = ', '=']) + self.value(datatype, name_placeholders) + ';')
+
+    def filler(self):
+        """\
+        Emits lines that are not part of any component.
+        """
+        self.emit(self.rnd.choice([
+            '! A comment with {braces}',
+            '{ A block comment }',
+            'numhis=5;',
+            'evaluate ($unparsed=1)',
+            '{+ table: rows=1 "r"\n           cols=1 "c" +}',
+        ]))
+
+    def body(self, levels, placeholders, hidden, count):
+        """\
+        Emits count parameters, paragraphs and other lines.
+        """
+        rnd = self.rnd
+        for _ in range(count):
+            kind = rnd.random()
+            if kind < 0.65:
+                self.parameter(levels, placeholders, hidden)
+            elif kind < 0.8:
+                self.components += 1
+                self.emit_paragraph('A paragraph about ' + ' '.join(placeholders + [rnd.choice(text_pool)]))
+                self.emit('')
+            else:
+                self.filler()
+            if rnd.random() < 0.3:
+                self.emit('')
+
+    def section(self, depth, levels, placeholders, hidden):
+        rnd = self.rnd
+        self.components += 1
+
+        attributes, levels = self.access_attributes(levels)
+        repeat, placeholder = self.repeat_attributes(placeholders)
+        attributes += repeat
+        if rnd.random() < 0.1:
+            attributes.append('#hidden')
+        if placeholder is not None:
+            placeholders = placeholders + [placeholder]
+
+        self.emit('')
+        self.emit_attributes(attributes)
+        equals = '=' * (4 + 2 * depth)
+        self.emit('{' + equals + ' Section ' + ' '.join(placeholders + [self.name()]) + ' ' + equals + '}')
+
+        self.body(levels, placeholders, hidden, rnd.randint(0, 4))
+
+        if depth < self.max_depth:
+            for _ in range(rnd.randint(0, 2)):
+                if self.components >= self.max_components:
+                    break
+                self.section(depth + 1, levels, placeholders, hidden)
+
+def random_template(rnd, max_components=30, max_depth=3):
+    """\
+    Returns a random template as a list of lines, see TemplateGenerator.
+    """
+    return TemplateGenerator(rnd, max_components, max_depth).generate()
+
+def random_value(rnd, component):
+    """\
+    Returns a random submitted value for a parameter component.
+    """
+    datatype = component['datatype']
+    if datatype == 'integer':
+        return str(rnd.randint(-5, 1000))
+    if datatype == 'float':
+        return str(rnd.randint(0, 99)) + '.' + str(rnd.randint(0, 99))
+    if datatype == 'choice':
+        return rnd.choice(component['options'])
+    if datatype == 'file':
+        return 'C:\\fakepath\\upload.pdb'
+    return rnd.choice(string_pool)
+
+def random_form_data(rnd, accesslevels, components, level=None, max_extra=2):
+    """\
+    Returns random, valid form data for a parsed template.
+
+    Repeatable components get between their minimum and up to max_extra more
+    repetitions, within their maximum. Level defaults to a random access
+    level. About half of all file parameter instances get an uploaded file.
+    """
+    if level is None:
+        level = rnd.choice(accesslevels)['name'] if len(accesslevels) else ''
+
+    table = ComponentTable(components)
+    files = dict()
+
+    # The amount of instances seen per file parameter, see CNSParser.write().
+    file_instance_counts = dict()
+
+    def repetition_count(component):
+        if not component['repeat']:
+            return 1
+        count = component['repeat_min'] + rnd.randint(0, max_extra)
+        if component['repeat_max'] is not None:
+            count = min(count, component['repeat_max'])
+        return count
+
+    def instances(parent):
+        result = []
+        for index in table.children(parent):
+            component = table[index]
+            if table.types[index] == 'paragraph' or component['hidden']:
+                continue
+
+            count = repetition_count(component)
+
+            if table.types[index] == 'section':
+                result.append({
+                    'component_index': index,
+                    'repetitions':     [instances(index) for _ in range(count)],
+                })
+                continue
+
+            result.append({
+                'component_index': index,
+                'repetitions':     [random_value(rnd, component) for _ in range(count)],
+            })
+
+            if component['datatype'] == 'file':
+                local_instance_index = file_instance_counts.get(index, 0)
+                file_instance_counts[index] = local_instance_index + 1
+                for repetition in range(count):
+                    if rnd.random() < 0.5:
+                        files.setdefault(str(index), {}).setdefault(str(local_instance_index), {})[str(repetition)] = {
+                            'name': 'upload' + str(index) + '_' + str(local_instance_index) + '_' + str(repetition) + '.pdb',
+                        }
+        return result
+
+    return {
+        'level':     level,
+        'instances': instances(None),
+        'files':     files,
+    }
+
+# }}}
+
+# Comparison {{{
+
+def canonical(value):
+    """\
+    Converts tuples to lists and dict subclasses to dicts, so that results of
+    different engines can be compared.
+    """
+    if isinstance(value, dict):
+        return dict((key, canonical(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [canonical(item) for item in value]
+    return value
+
+def textual(value):
+    """\
+    Like canonical(), but also decodes byte strings as UTF-8 and sorts the
+    access levels of components, which the binary model format neither
+    keeps apart from text nor keeps in order.
+    """
+    if isinstance(value, dict):
+        return dict(
+            (textual(key), sorted(textual(item)) if key == 'accesslevels' and isinstance(item, list) else textual(item))
+                for key, item in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return [textual(item) for item in value]
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+def outcome(function, *args):
+    """\
+    Calls function and returns ('ok', canonical result), or ('error', exception
+    type name, message) if it raised an exception.
+    """
+    try:
+        return ('ok', canonical(function(*args)))
+    except Exception as e:
+        return ('error', type(e).__name__, str(e))
+
+def first_difference(expected, actual, path=''):
+    """\
+    Returns a description of the first difference between two canonical
+    values, or None if they are equal.
+    """
+    if type(expected) != type(actual):
+        return path + ': ' + repr(expected) + ' != ' + repr(actual)
+
+    if isinstance(expected, dict):
+        for key in sorted(set(expected) | set(actual)):
+            if key not in actual:
+                return path + '[' + repr(key) + ']: missing'
+            if key not in expected:
+                return path + '[' + repr(key) + ']: unexpected'
+            difference = first_difference(expected[key], actual[key], path + '[' + repr(key) + ']')
+            if difference is not None:
+                return difference
+        return None
+
+    if isinstance(expected, list):
+        for index, (expected_item, actual_item) in enumerate(zip(expected, actual)):
+            difference = first_difference(expected_item, actual_item, path + '[' + str(index) + ']')
+            if difference is not None:
+                return difference
+        if len(expected) != len(actual):
+            return path + ': length ' + str(len(expected)) + ' != ' + str(len(actual))
+        return None
+
+    if expected != actual:
+        return path + ': ' + repr(expected) + ' != ' + repr(actual)
+    return None
+
+class Mismatch(object):
+    """\
+    A difference between the reference engine and another engine.
+
+    - engine:    The engine name
+    - operation: 'parse' or 'write'
+    - expected:  The outcome of the reference engine, see outcome()
+    - actual:    The outcome of the engine
+    - case:      The Case that produced the difference
+    """
+
+    def __init__(self, engine, operation, expected, actual, case):
+        self.engine    = engine
+        self.operation = operation
+        self.expected  = expected
+        self.actual    = actual
+        self.case      = case
+
+    def describe(self):
+        """\
+        Returns a readable description of the difference.
+        """
+        text = self.engine + ' ' + self.operation + ' differs from the reference'
+
+        if self.expected[0] != 'ok' or self.actual[0] != 'ok':
+            def show(result):
+                if result[0] == 'ok':
+                    return 'a result'
+                return result[1] + ': ' + result[2]
+            return text + ':\n  reference: ' + show(self.expected) + '\n  ' + self.engine + ': ' + show(self.actual)
+
+        if self.operation == 'write' and self.expected[1][0] != self.actual[1][0]:
+            diff = difflib.unified_diff(
+                self.expected[1][0], self.actual[1][0],
+                'reference', self.engine, n=2, lineterm=''
+            )
+            return text + ':\n' + '\n'.join(list(diff)[:40])
+
+        return text + ':\n  ' + first_difference(self.expected[1], self.actual[1], 'result')
+
+# }}}
+
+# Cases {{{
+
+class Case(object):
+    """\
+    A template with form data. Form data is generated from form_seed for the
+    model of the template, unless it is given.
+    """
+
+    def __init__(self, seed, lines, form_seed, level=None, form_data=None):
+        self.seed      = seed
+        self.lines     = lines
+        self.form_seed = form_seed
+        self.level     = level
+        self.form_data = form_data
+
+    @classmethod
+    def generate(cls, seed, max_components=30):
+        """\
+        Returns a random case, which is fully determined by seed.
+        """
+        rnd   = random.Random(seed)
+        lines = random_template(rnd, max_components)
+        return cls(seed, lines, rnd.randint(0, 1 << 30))
+
+    def model(self):
+        """\
+        Returns the reference outcome of parsing the template.
+        """
+        return outcome(reference_engine.parse, self.lines)
+
+    def generated_form_data(self, model):
+        """\
+        Returns the form data for this case, given the reference outcome of
+        parsing the template. Returns None if the template is invalid.
+        """
+        if self.form_data is not None:
+            return self.form_data
+        if model[0] != 'ok':
+            return None
+        accesslevels, components = model[1]
+        rnd   = random.Random(self.form_seed)
+        level = self.level
+        if level is None:
+            level = rnd.choice(accesslevels)['name'] if len(accesslevels) else ''
+        return random_form_data(rnd, accesslevels, components, level)
+
+def check(case, name, engine, operations=('parse', 'write')):
+    """\
+    Compares an engine with the reference engine for a case.
+    Returns a Mismatch, or None if the engine produced the same outcomes.
+    """
+    model = case.model()
+
+    if 'parse' in operations and hasattr(engine, 'parse'):
+        actual = outcome(engine.parse, case.lines)
+        if actual != model:
+            return Mismatch(name, 'parse', model, actual, case)
+
+    form_data = case.generated_form_data(model)
+
+    if 'write' in operations and hasattr(engine, 'write') and form_data is not None:
+        expected = outcome(reference_engine.write, case.lines, form_data, '')
+        engine.prepare(case.lines, form_data)
+        actual = outcome(engine.write, case.lines, form_data, '')
+        if actual != expected:
+            return Mismatch(name, 'write', expected, actual, case)
+
+    return None
+
+# }}}
+
+# Shrinking {{{
+
+def same_failure(mismatch, engine):
+    """\
+    Returns a predicate that checks whether a case still produces a mismatch
+    of the same kind: same operation, and a reference outcome of the same kind.
+    """
+    def predicate(case):
+        found = check(case, mismatch.engine, engine, [mismatch.operation])
+        return (
+            found is not None
+            and found.operation   == mismatch.operation
+            and found.expected[0] == mismatch.expected[0]
+        )
+    return predicate
+
+def shrink_lines(lines, predicate):
+    """\
+    Removes chunks of lines, from large to small, as long as predicate holds
+    for the remaining lines.
+    """
+    chunk = max(1, len(lines) // 2)
+    while True:
+        start   = 0
+        removed = False
+        while start < len(lines):
+            candidate = lines[:start] + lines[start+chunk:]
+            if predicate(candidate):
+                lines   = candidate
+                removed = True
+            else:
+                start += chunk
+        if chunk == 1 and not removed:
+            return lines
+        chunk = max(1, chunk // 2)
+
+def form_data_reductions(form_data):
+    """\
+    Yields copies of form data that each have one repetition or uploaded
+    file less, or one value replaced by an empty string.
+    """
+    def paths(instances, path):
+        for position, instance in enumerate(instances):
+            repetitions = instance['repetitions']
+            for index, repetition in enumerate(repetitions):
+                if isinstance(repetition, list):
+                    for found in paths(repetition, path + [position, 'repetitions', index]):
+                        yield found
+            for index in reversed(range(len(repetitions))):
+                yield 'remove', path + [position, 'repetitions'], index
+            for index, repetition in enumerate(repetitions):
+                if not isinstance(repetition, list) and repetition != '':
+                    yield 'clear', path + [position, 'repetitions'], index
+
+    def resolve(data, path):
+        for key in path:
+            data = data[key]
+        return data
+
+    for component_index in sorted(form_data['files']):
+        reduced = copy.deepcopy(form_data)
+        del reduced['files'][component_index]
+        yield reduced
+
+    for action, path, index in paths(form_data['instances'], ['instances']):
+        reduced     = copy.deepcopy(form_data)
+        repetitions = resolve(reduced, path)
+        if action == 'remove':
+            del repetitions[index]
+        else:
+            repetitions[index] = ''
+        yield reduced
+
+def shrink(mismatch, engine):
+    """\
+    Shrinks the case of a mismatch to a smaller case that still produces the
+    same kind of mismatch. The template is shrunk first, then the form data.
+    Returns the Mismatch for the shrunk case.
+    """
+    predicate = same_failure(mismatch, engine)
+    case      = mismatch.case
+
+    # Keep the access level, so that the generated form data stays comparable.
+    level = None
+    if case.form_data is None:
+        form_data = case.generated_form_data(case.model())
+        if form_data is not None:
+            level = form_data['level']
+
+    def with_lines(lines):
+        return Case(case.seed, lines, case.form_seed, level, case.form_data)
+
+    lines = shrink_lines(list(case.lines), lambda lines: predicate(with_lines(lines)))
+    case  = with_lines(lines)
+
+    form_data = case.generated_form_data(case.model())
+    if form_data is not None and mismatch.operation == 'write':
+        case = Case(case.seed, lines, case.form_seed, level, form_data)
+        reduced = True
+        while reduced:
+            reduced = False
+            for form_data in form_data_reductions(case.form_data):
+                candidate = Case(case.seed, lines, case.form_seed, level, form_data)
+                if predicate(candidate):
+                    case    = candidate
+                    reduced = True
+                    break
+
+    return check(case, mismatch.engine, engine, [mismatch.operation])
+
+# }}}
+
+# Timing {{{
+
+def measure(function, args, repeat=3, min_time=0.002):
+    """\
+    Returns the best time per call of function(*args) over repeat rounds.
+    Every round calls the function for at least min_time seconds.
+    """
+    best = None
+    for _ in range(repeat):
+        calls = 0
+        start = timeit.default_timer()
+        while True:
+            function(*args)
+            calls  += 1
+            elapsed = timeit.default_timer() - start
+            if elapsed >= min_time:
+                break
+        if best is None or elapsed / calls < best:
+            best = elapsed / calls
+    return best
+
+def speedups(case, names, repeat=3):
+    """\
+    Returns a dict that maps (engine name, operation) pairs to the speed of
+    the engine relative to the reference engine, for a case on which they
+    agree. Values above 1 mean the engine is faster.
+    """
+    model     = case.model()
+    form_data = case.generated_form_data(model)
+    result    = dict()
+
+    if model[0] != 'ok':
+        return result
+
+    reference_times = {
+        'parse': measure(reference_engine.parse, (case.lines,), repeat),
+    }
+    if outcome(reference_engine.write, case.lines, form_data, '')[0] == 'ok':
+        reference_times['write'] = measure(reference_engine.write, (case.lines, form_data, ''), repeat)
+
+    for name in names:
+        engine = engines[name]
+        if hasattr(engine, 'parse'):
+            result[name, 'parse'] = reference_times['parse'] / measure(engine.parse, (case.lines,), repeat)
+        if hasattr(engine, 'write') and 'write' in reference_times:
+            engine.prepare(case.lines, form_data)
+            result[name, 'write'] = reference_times['write'] / measure(engine.write, (case.lines, form_data, ''), repeat)
+
+    return result
+
+def geometric_mean(values):
+    return math.exp(sum(math.log(value) for value in values) / len(values))
+
+# }}}
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import json
+import os
+
+from cnscolumnar import from_columnar, is_columnar, to_columnar
+from cnsmodeldiff import ModelDiff, ModelIndex
+from cnsruntime import replace_placeholders
+
+class FormDataMigration(object):
+    """\
+    Migrates form data from one version of a template to another.
+
+    Sections and parameters of both templates are matched once, by the
+    labels of their sections and their own label or name (see
+    cnsmodeldiff), so any number of form data objects can be migrated with
+    the same FormDataMigration.
+
+    Values and repetition counts are carried over to the matched components,
+    and uploaded files to their new component and instance indices. An
+    instance is found by the repetitions of the repeatable sections it is
+    in, so components that move into or out of a repeatable section start
+    over with their default values. New components get their default
+    values and repeat_min repetitions.
+    """
+
+    def __init__(self, old_template, new_template):
+        """\
+        Both templates are Template objects, see cnstemplate.
+        """
+        self.old_template = old_template
+        self.new_template = new_template
+        self.diff         = ModelDiff(
+            ModelIndex(old_template.table, old_template.accesslevels),
+            ModelIndex(new_template.table, new_template.accesslevels),
+        )
+
+        # Maps the new component indices of matched components to their old indices.
+        self.sources = dict((new_index, old_index) for old_index, new_index in self.diff.index_map.items())
+
+        # New indices of matched parameters whose values must be checked again.
+        self.revalidated = set(
+            self.diff.new.indices[new_key]
+                for old_key, new_key, changes in self.diff.changed
+                    if any(key in ('datatype', 'options') for key, old_value, new_value in changes)
+        )
+
+        # The instantiated children of every new section (and of the root
+        # block, None), as (index, source index, component, whether it is a
+        # section, minimum and maximum amount of repetitions) tuples.
+        self.children = dict()
+        for section, children in new_template.instantiated_children.items():
+            plan = []
+            for index in children:
+                component = new_template.table[index]
+                if component['repeat']:
+                    minimum, maximum = component['repeat_min'] or 0, component['repeat_max']
+                else:
+                    minimum, maximum = 1, 1
+                plan.append((
+                    index,
+                    self.sources.get(index),
+                    component,
+                    component['type'] == 'section',
+                    minimum,
+                    maximum,
+                ))
+            self.children[section] = tuple(plan)
+
+        # The instantiated children of every old section, as (index, whether
+        # it is a section, repeat_index or None) tuples.
+        self.old_children = dict(
+            (section, tuple(
+                (
+                    index,
+                    old_template.table.types[index] == 'section',
+                    old_template.table[index].get('repeat_index') if old_template.table[index]['repeat'] else None,
+                )
+                    for index in children
+            ))
+                for section, children in old_template.instantiated_children.items()
+        )
+
+    def instances(self, form_data):
+        """\
+        Reads the instances of form data for the old template.
+
+        Returns a dict that maps (component index, coordinates) pairs to
+        (repetitions, local instance index, placeholders) triples, and the
+        keys of the dict in instance order. Coordinates are the repetition
+        indices of the repeatable sections the instance is in, outermost
+        first.
+        Raises a ValueError if the form data does not match the template.
+        """
+        instances = dict()
+        order     = []
+        counts    = [0] * len(self.old_template.table) # Amount of instances read per component
+
+        # Stack of (section index, instances, coordinates, placeholders) to read, in reverse order.
+        pending = [(None, form_data.get('instances'), (), ())]
+
+        while pending:
+            section, section_instances, coordinates, placeholders = pending.pop()
+            children = self.old_children[section]
+
+            if not isinstance(section_instances, list) or len(section_instances) != len(children):
+                raise ValueError(
+                    'Expected ' + str(len(children)) + ' instances for '
+                        + ('section ' + str(section) if section is not None else 'the template')
+                )
+
+            sections = []
+            for (index, is_section, repeat_index), instance in zip(children, section_instances):
+                if (
+                           not isinstance(instance, dict)
+                        or instance.get('component_index') != index
+                        or not isinstance(instance.get('repetitions'), list)
+                    ):
+                    raise ValueError('Invalid instance, expected component index ' + str(index))
+
+                key = (index, coordinates)
+                instances[key] = (instance['repetitions'], counts[index], placeholders)
+                counts[index] += 1
+                order.append(key)
+
+                if is_section:
+                    for repetition, repetition_instances in enumerate(instance['repetitions']):
+                        if repeat_index is not None:
+                            sections.append((
+                                index,
+                                repetition_instances,
+                                coordinates + (repetition,),
+                                placeholders + ((repeat_index, repetition),),
+                            ))
+                        else:
+                            sections.append((index, repetition_instances, coordinates, placeholders))
+
+            pending.extend(reversed(sections))
+
+        return instances, order
+
+    def migrate(self, form_data):
+        """\
+        Migrates form data of either format (see cnscolumnar) for the old
+        template to form data of the same format for the new template.
+        The form data is not modified.
+
+        Returns the migrated form data and a list of (name, message) pairs
+        describing everything that was dropped: values and files of removed
+        components, values that are not valid for the new datatype of a
+        parameter, and repetitions beyond the new repeat_max. Name is the
+        instantiated parameter name or section label in the old template, or
+        None for problems with the form data as a whole.
+
+        Raises a ValueError if the form data does not match the old template.
+        """
+        old_table = self.old_template.table
+        new_table = self.new_template.table
+        columnar  = is_columnar(form_data)
+
+        if columnar:
+            form_data = from_columnar(old_table, form_data)
+
+        instances, order = self.instances(form_data)
+        consumed         = set()
+        dropped          = []
+
+        files     = form_data.get('files', {})
+        new_files = dict()
+        counts    = dict() # New file parameter index => amount of instances written
+
+        def old_name(index, placeholders):
+            component = old_table[index]
+            return replace_placeholders(
+                component['name'] if component['type'] == 'parameter' else component['label'],
+                placeholders
+            )
+
+        def parameter_name(index, placeholders, repetition):
+            component = old_table[index]
+            if component['repeat']:
+                placeholders = placeholders + ((component['repeat_index'], repetition),)
+            return old_name(index, placeholders)
+
+        def old_files(index, local_instance_index):
+            return files.get(str(index), {}).get(str(local_instance_index), {})
+
+        migrated = dict((key, value) for key, value in form_data.items() if key not in ('instances', 'files'))
+        migrated['instances'] = []
+        if 'files' in form_data:
+            migrated['files'] = new_files
+
+        level = form_data.get('level')
+        if level not in self.new_template.accesslevel_names:
+            dropped.append((None, 'Unknown access level "' + str(level) + '" in the new template'))
+
+        # Stack of (section index, coordinates, instance list to fill) to write, in reverse order.
+        pending = [(None, (), migrated['instances'])]
+
+        while pending:
+            section, coordinates, target = pending.pop()
+
+            sections = []
+            for index, source, component, is_section, minimum, maximum in self.children[section]:
+                key = (source, coordinates)
+                old = instances.get(key) if source is not None else None
+
+                if old is None:
+                    repetitions, local_instance_index, placeholders = (), None, ()
+                else:
+                    consumed.add(key)
+                    repetitions, local_instance_index, placeholders = old
+
+                count = len(repetitions)
+                if count < minimum:
+                    count = minimum
+                elif maximum is not None and count > maximum:
+                    count = maximum
+
+                if is_section:
+                    if len(repetitions) > count:
+                        dropped.append((
+                            old_name(source, placeholders),
+                            '%d repetitions dropped, at most %d allowed' % (len(repetitions) - count, count)
+                        ))
+                    instance = {'component_index': index, 'repetitions': [[] for repetition in range(count)]}
+                    for repetition in range(count):
+                        sections.append((
+                            index,
+                            coordinates + (repetition,) if component['repeat'] else coordinates,
+                            instance['repetitions'][repetition],
+                        ))
+                    target.append(instance)
+                    continue
+
+                values = list(repetitions[:count])
+                if len(values) < count:
+                    values.extend([component['default']] * (count - len(values)))
+
+                if index in self.revalidated:
+                    validate = self.new_template.validators[index]
+                    for repetition in range(min(count, len(repetitions))):
+                        try:
+                            validate(values[repetition])
+                        except ValueError as e:
+                            dropped.append((
+                                parameter_name(source, placeholders, repetition),
+                                'Value "%s" dropped: %s' % (values[repetition], e)
+                            ))
+                            values[repetition] = component['default']
+
+                if component['datatype'] == 'file':
+                    new_local_instance_index = counts.get(index, 0)
+                    counts[index] = new_local_instance_index + 1
+                    if old is not None:
+                        instance_files = old_files(source, local_instance_index)
+                        for repetition in range(min(count, len(repetitions))):
+                            file = instance_files.get(str(repetition))
+                            if file is not None:
+                                new_files.setdefault(str(index), {}).setdefault(str(new_local_instance_index), {})[str(repetition)] = file
+
+                for repetition in range(count, len(repetitions)):
+                    dropped.append((
+                        parameter_name(source, placeholders, repetition),
+                        'Value "%s" dropped, at most %d repetitions allowed' % (repetitions[repetition], count)
+                    ))
+                    if old_files(source, local_instance_index).get(str(repetition)) is not None:
+                        dropped.append((parameter_name(source, placeholders, repetition), 'File dropped'))
+
+                target.append({'component_index': index, 'repetitions': values})
+
+            pending.extend(reversed(sections))
+
+        for key in order:
+            if key in consumed or old_table.types[key[0]] != 'parameter':
+                continue
+            index = key[0]
+            repetitions, local_instance_index, placeholders = instances[key]
+            for repetition, value in enumerate(repetitions):
+                name = parameter_name(index, placeholders, repetition)
+                dropped.append((name, 'Value "%s" dropped' % (value,)))
+                if old_files(index, local_instance_index).get(str(repetition)) is not None:
+                    dropped.append((name, 'File dropped'))
+
+        if columnar:
+            migrated = to_columnar(new_table, migrated)
+
+        return migrated, dropped
+
+# Parallel migration {{{
+
+# The FormDataMigration of a worker process, see migrate_files().
+worker_migration = None
+
+def start_worker(migration):
+    global worker_migration
+    worker_migration = migration
+
+def migrate_file(job):
+    """\
+    Migrates a form data file in a worker process, see migrate_files().
+    """
+    source, destination = job
+    return (source, destination) + migrate_path(worker_migration, source, destination)
+
+def migrate_path(migration, source, destination):
+    """\
+    Migrates the form data file at source and writes the result to
+    destination, which may be the same path. The file is replaced
+    atomically, and gets the mode of the source file. Returns the dropped items (see FormDataMigration.migrate())
+    and an error message, which is None if the file was migrated.
+    """
+    # Imported here, it is only needed when files are written.
+    import tempfile
+
+    try:
+        with open(source) as fp:
+            form_data = json.load(fp)
+            mode      = os.fstat(fp.fileno()).st_mode & 0o7777
+        migrated, dropped = migration.migrate(form_data)
+    except (IOError, OSError, ValueError) as e:
+        return [], str(e)
+
+    try:
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(destination) or '.', prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                # json.dumps() encodes in C, json.dump() does not.
+                fp.write(json.dumps(migrated))
+            # Files created by mkstemp() are only accessible by their owner.
+            os.chmod(temp_path, mode)
+            os.rename(temp_path, destination)
+        except (IOError, OSError):
+            os.remove(temp_path)
+            raise
+    except (IOError, OSError) as e:
+        return dropped, str(e)
+
+    return dropped, None
+
+def migrate_files(migration, jobs, processes=None, chunk_size=16):
+    """\
+    Migrates form data files with a FormDataMigration, in parallel.
+    Jobs is an iterable of (source, destination) path pairs, see
+    migrate_path().
+
+    Yields (source, destination, dropped, error) tuples in the order of the
+    jobs. The migration, and the model index it holds, is built once and
+    shared with the worker processes.
+    """
+    # Imported here, as it takes a noticeable part of the startup time.
+    import multiprocessing
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    if processes < 2:
+        for source, destination in jobs:
+            yield (source, destination) + migrate_path(migration, source, destination)
+        return
+
+    pool = multiprocessing.Pool(processes, start_worker, (migration,))
+    try:
+        for result in pool.imap(migrate_file, jobs, chunk_size):
+            yield result
+    finally:
+        pool.terminate()
+
+# }}}
@@ -0,0 +1,922 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import array
+import codecs
+import io
+import json
+import mmap
+import re
+import struct
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+try:
+    # simplejson has C speedups for more of its encoder than older standard
+    # library versions and accepts the same options. Since we always pass
+    # explicit separators (see json_options()), it produces the same text.
+    import simplejson as json_backend
+except ImportError:
+    json_backend = json
+
+# Encoder options for each supported output style.
+# 'default' and 'tidy' match the output cnstojson.py has always written.
+# 'compact' leaves out all optional whitespace and is meant for machine consumers.
+json_styles = {
+    'default': dict(),
+    'tidy':    dict(sort_keys=True, indent=4),
+    'compact': dict(separators=(',', ':')),
+}
+
+# Indented output is written in blocks of at least this many characters.
+json_block_size = 1 << 16
+
+
+def json_options(style):
+    """\
+    Returns the JSON encoder keyword arguments for the given output style.
+
+    Separators are always specified explicitly, using the standard library's
+    defaults when the style does not override them. This makes sure the
+    output does not depend on which backend is installed.
+    """
+    if style not in json_styles:
+        raise ValueError('Unknown JSON style "' + style + '"')
+
+    options = dict(json_styles[style])
+
+    if 'separators' not in options:
+        encoder = json.JSONEncoder(indent=options.get('indent'))
+        options['separators'] = (encoder.item_separator, encoder.key_separator)
+
+    return options
+
+def dump_json(data, fp, style='default'):
+    """\
+    Writes data to the file object fp as a JSON document in the given style,
+    followed by a newline.
+
+    Unindented output is encoded in one go, as only the one-shot encoder runs
+    in C. Indented output is always encoded in Python, and is streamed to fp
+    in large blocks instead of being built in memory first.
+    """
+    options = json_options(style)
+    encoder = json_backend.JSONEncoder(**options)
+
+    if options.get('indent') is None:
+        fp.write(encoder.encode(data))
+    else:
+        block      = []
+        block_size = 0
+        for chunk in encoder.iterencode(data):
+            block.append(chunk)
+            block_size += len(chunk)
+            if block_size >= json_block_size:
+                fp.write(''.join(block))
+                block      = []
+                block_size = 0
+        fp.write(''.join(block))
+
+    fp.write('\n')
+
+
+
+# Component tables {{{
+
+class ComponentTable(object):
+    """\
+    A flat, array-backed view of a component tree.
+
+    Components are stored in preorder, so a component's index in the table
+    is its component index, as used in form data. The children of a section
+    directly follow it, and its whole subtree occupies the index range
+    [index, ends[index]). Parallel arrays describe the tree structure:
+
+    - types:   The component type of each component
+    - parents: The index of each component's parent section, or -1 for top-level components
+    - ends:    The index of the first component after each component's subtree
+    - depths:  The nesting depth of each component, 0 for top-level components
+
+    The component dicts themselves are shared with the tree, the table does
+    not copy them. Building and walking a table never recurses, so there
+    is no limit on the nesting depth.
+    """
+
+    def __init__(self, components):
+        """\
+        Components is a list of top-level components, as returned by
+        CNSParser.parse().
+        """
+        self.components = []
+        self.types      = []
+        self.parents    = array.array('i')
+        self.ends       = array.array('i')
+        self.depths     = array.array('i')
+        self.indices    = None # Maps the ids of component dicts to their indices, see index_of().
+
+        # Stack of (parent index, iterator over the remaining children).
+        stack = [(-1, iter(components))]
+
+        while stack:
+            parent, children = stack[-1]
+            component = next(children, None)
+
+            if component is None:
+                stack.pop()
+                if parent >= 0:
+                    self.ends[parent] = len(self.components)
+                continue
+
+            index = len(self.components)
+            self.components.append(component)
+            self.types.append(component['type'])
+            self.parents.append(parent)
+            self.ends.append(index + 1)
+            self.depths.append(len(stack) - 1)
+
+            if component['type'] == 'section':
+                stack.append((index, iter(component['children'])))
+
+    def __len__(self):
+        return len(self.components)
+
+    def __getitem__(self, index):
+        return self.components[index]
+
+    def __iter__(self):
+        return iter(self.components)
+
+    def children(self, index=None):
+        """\
+        Iterates over the indices of the children of the section at index,
+        or over the indices of the top-level components if index is None.
+        """
+        if index is None:
+            child, end = 0, len(self.components)
+        else:
+            child, end = index + 1, self.ends[index]
+
+        while child < end:
+            yield child
+            child = self.ends[child]
+
+    def ancestors(self, index):
+        """\
+        Iterates over the indices of the sections containing the component at
+        index, from the innermost to the outermost section.
+        """
+        index = self.parents[index]
+        while index >= 0:
+            yield index
+            index = self.parents[index]
+
+    def subtree(self, index):
+        """\
+        Returns the range of indices of the component at index and all its
+        descendants.
+        """
+        return range(index, self.ends[index])
+
+    def skip(self, index):
+        """\
+        Returns the index of the first component after the subtree of the
+        component at index.
+        """
+        return self.ends[index]
+
+    def walk(self, include=None):
+        """\
+        Iterates over all component indices in preorder.
+
+        If include is given, it is called with each component. When it
+        returns False, the component and its whole subtree are skipped.
+        """
+        index = 0
+        while index < len(self.components):
+            if include is not None and not include(self.components[index]):
+                index = self.ends[index]
+            else:
+                yield index
+                index += 1
+
+    def visible(self, level=None):
+        """\
+        Iterates over the indices of components that are not hidden and, if
+        level is given, that are accessible at that access level.
+        Subtrees of hidden or inaccessible sections are skipped.
+        """
+        return self.walk(
+            lambda component: (
+                not component.get('hidden', False)
+                and (level is None or level in component.get('accesslevels', [level]))
+            )
+        )
+
+    def index_of(self, component):
+        """\
+        Returns the index of a component dict that is part of this table.
+        """
+        if self.indices is None:
+            self.indices = dict((id(component), index) for index, component in enumerate(self.components))
+        return self.indices[id(component)]
+
+# }}}
+
+# Binary model format {{{
+#
+# A binary model file contains both the access levels and the component tree.
+# All integers are little-endian. The file consists of the following parts:
+#
+# 1. A header (binary_header).
+# 2. String offsets: (string count + 1) unsigned 32-bit offsets into the string data.
+# 3. String data: All names, labels, defaults etc. used in the model, UTF-8 encoded.
+#    Every distinct string is stored once and referred to by its index (string id).
+# 4. Access levels: A pair of string ids (name, label) for each access level.
+# 5. Components: One binary_component record per component, in preorder.
+#    The children of a section directly follow it, subtree_end is the index of
+#    the first component after the section's subtree.
+#    Access levels are stored as a bitmask of access level indices.
+# 6. Extras: String ids of choice options and custom attribute (key, value) pairs,
+#    referred to by start index and count from component records.
+#
+# String id binary_none stands for None or a missing string.
+
+binary_magic     = b'CNSB'
+binary_version   = 1
+binary_none      = 0xffffffff
+
+# magic, version, string count, access level count, component count, extra count, string data size
+binary_header    = struct.Struct('<4sHxxIIIII')
+
+# type, flags, string ids for text, label, default, datatype and repeat_index,
+# access level mask, repeat_min, repeat_max, subtree_end, options start, options count,
+# custom attributes start, custom attributes count
+binary_component = struct.Struct('<BxHIIIIIQiiIIIII')
+
+# Position of the subtree_end field in a component record.
+binary_subtree_end = 10
+
+binary_types = ['section', 'parameter', 'paragraph']
+
+# Component record flags, mostly used to tell whether optional keys exist.
+binary_flag_repeat       = 1 << 0
+binary_flag_hidden       = 1 << 1
+binary_flag_has_hidden   = 1 << 2
+binary_flag_repeat_index = 1 << 3
+binary_flag_repeat_min   = 1 << 4
+binary_flag_repeat_max   = 1 << 5
+binary_flag_label        = 1 << 6
+binary_flag_options      = 1 << 7
+
+# Component keys that have their own record field. Other keys are custom attributes.
+binary_known_keys = set([
+    'type', 'name', 'label', 'text', 'default', 'datatype', 'options', 'children',
+    'accesslevels', 'repeat', 'repeat_index', 'repeat_min', 'repeat_max', 'hidden',
+])
+
+
+def dump_binary(accesslevels, components, fp):
+    """\
+    Writes access levels and a component tree to the binary file object fp
+    in the binary model format.
+    """
+    if len(accesslevels) > 64:
+        raise ValueError('The binary model format supports at most 64 access levels')
+
+    strings    = []
+    string_ids = dict()
+
+    def intern(string):
+        if string is None:
+            return binary_none
+        if string not in string_ids:
+            string_ids[string] = len(strings)
+            strings.append(string)
+        return string_ids[string]
+
+    level_records = [(intern(level['name']), intern(level['label'])) for level in accesslevels]
+    level_masks   = dict((level['name'], 1 << i) for i, level in enumerate(accesslevels))
+
+    records = []
+    extras  = []
+
+    # Walk the tree in preorder without recursion.
+    # Each stack entry holds a list of siblings and the position of the next one.
+    stack = [[components, 0]]
+    # Records of the sections whose subtree we are in.
+    open_sections = []
+
+    while len(stack):
+        siblings, position = stack[-1]
+        if position == len(siblings):
+            stack.pop()
+            if len(open_sections):
+                open_sections.pop()[binary_subtree_end] = len(records)
+            continue
+        stack[-1][1] += 1
+
+        component = siblings[position]
+
+        flags = 0
+        if component.get('repeat'):  flags |= binary_flag_repeat
+        if component.get('hidden'):  flags |= binary_flag_hidden
+        if 'hidden'       in component: flags |= binary_flag_has_hidden
+        if 'repeat_index' in component: flags |= binary_flag_repeat_index
+        if 'repeat_min'   in component: flags |= binary_flag_repeat_min
+        if 'repeat_max'   in component: flags |= binary_flag_repeat_max
+        if 'options'      in component: flags |= binary_flag_options
+
+        if component['type'] == 'section':
+            text, label = component['label'], None
+        elif component['type'] == 'parameter':
+            text, label = component['name'], component.get('label')
+            if 'label' in component:
+                flags |= binary_flag_label
+        else:
+            text, label = component['text'], None
+
+        mask = 0
+        for name in component.get('accesslevels', []):
+            mask |= level_masks[name]
+
+        options       = component.get('options', [])
+        options_start = len(extras)
+        extras.extend(intern(option) for option in options)
+
+        custom       = [(key, value) for key, value in component.items() if key not in binary_known_keys]
+        custom_start = len(extras)
+        for key, value in custom:
+            extras.append(intern(key))
+            extras.append(intern(value))
+
+        record = [
+            binary_types.index(component['type']),
+            flags,
+            intern(text),
+            intern(label),
+            intern(component.get('default')),
+            intern(component.get('datatype')),
+            intern(component.get('repeat_index')),
+            mask,
+            component['repeat_min'] if component.get('repeat_min') is not None else -1,
+            component['repeat_max'] if component.get('repeat_max') is not None else -1,
+            None, # The subtree end is filled in when the subtree is complete.
+            options_start,
+            len(options),
+            custom_start,
+            len(custom),
+        ]
+        records.append(record)
+
+        if component['type'] == 'section':
+            open_sections.append(record)
+            stack.append([component['children'], 0])
+        else:
+            record[binary_subtree_end] = len(records)
+
+    # Strings read from a template are byte strings on Python 2, and are
+    # assumed to be UTF-8 already.
+    encoded = [string if isinstance(string, bytes) else string.encode('utf-8') for string in strings]
+    offsets = [0]
+    for data in encoded:
+        offsets.append(offsets[-1] + len(data))
+
+    fp.write(binary_header.pack(
+        binary_magic, binary_version,
+        len(strings), len(level_records), len(records), len(extras), offsets[-1],
+    ))
+    fp.write(struct.pack('<' + str(len(offsets)) + 'I', *offsets))
+    fp.write(b''.join(encoded))
+    for name, label in level_records:
+        fp.write(struct.pack('<II', name, label))
+    for record in records:
+        fp.write(binary_component.pack(*record))
+    fp.write(struct.pack('<' + str(len(extras)) + 'I', *extras))
+
+class BinaryModel(object):
+    """\
+    A read-only view of a binary model.
+
+    Components are only decoded when they are accessed, so opening a model
+    costs next to nothing regardless of its size.
+    Use materialise() to convert the whole model to plain dicts and lists.
+    """
+
+    def __init__(self, data):
+        """\
+        Data must be a buffer containing a binary model, such as an mmap or a
+        byte string.
+        """
+        if len(data) < binary_header.size:
+            raise ValueError('Not a binary model: file is too short')
+
+        magic, version, string_count, level_count, component_count, extra_count, string_size = \
+            binary_header.unpack_from(data, 0)
+
+        if magic != binary_magic:
+            raise ValueError('Not a binary model: bad magic number')
+        if version != binary_version:
+            raise ValueError('Unsupported binary model version ' + str(version))
+
+        self.data = data
+
+        offset = binary_header.size
+        self.string_offsets = struct.unpack_from('<' + str(string_count + 1) + 'I', data, offset)
+        offset += 4 * (string_count + 1)
+        self.string_start = offset
+        offset += string_size
+        levels = struct.unpack_from('<' + str(2 * level_count) + 'I', data, offset)
+        offset += 4 * 2 * level_count
+        self.component_start = offset
+        offset += binary_component.size * component_count
+        self.extras = struct.unpack_from('<' + str(extra_count) + 'I', data, offset)
+
+        self.strings         = [None] * string_count
+        self.level_lists     = dict() # Maps access level masks to lists of access level names.
+        self.nodes           = [None] * component_count
+        self.component_count = component_count
+
+        self.accesslevels = [
+            { 'name': self.string(levels[i]), 'label': self.string(levels[i+1]) }
+                for i in range(0, len(levels), 2)
+        ]
+        self.accesslevel_names = [level['name'] for level in self.accesslevels]
+
+        self.components = BinaryComponentList(self, self.sibling_indices(0, component_count))
+
+    def string(self, string_id):
+        if string_id == binary_none:
+            return None
+        string = self.strings[string_id]
+        if string is None:
+            start  = self.string_start + self.string_offsets[string_id]
+            end    = self.string_start + self.string_offsets[string_id + 1]
+            string = self.data[start:end].decode('utf-8')
+            self.strings[string_id] = string
+        return string
+
+    def record(self, index):
+        return binary_component.unpack_from(self.data, self.component_start + index * binary_component.size)
+
+    def sibling_indices(self, start, end):
+        """\
+        Returns the indices of the components in the range [start, end) that
+        share the same parent, by jumping over subtrees.
+        """
+        indices = []
+        while start < end:
+            indices.append(start)
+            start = self.record(start)[binary_subtree_end]
+        return indices
+
+    def node(self, index):
+        node = self.nodes[index]
+        if node is None:
+            node = BinaryComponent(self, index)
+            self.nodes[index] = node
+        return node
+
+    def decode(self, index, materialise_children):
+        """\
+        Decodes a component record into a dict.
+        Children are returned as a lazy list, or as an empty list that the
+        caller is expected to fill in if materialise_children is set.
+        """
+        (type_id, flags, text, label, default, datatype, repeat_index, mask,
+            repeat_min, repeat_max, subtree_end, options_start, option_count,
+            custom_start, custom_count) = self.record(index)
+
+        component = { 'type': binary_types[type_id] }
+
+        if component['type'] == 'section':
+            component['label'] = self.string(text)
+            component['children'] = (
+                [] if materialise_children
+                   else BinaryComponentList(self, self.sibling_indices(index + 1, subtree_end))
+            )
+        elif component['type'] == 'parameter':
+            component['name']     = self.string(text)
+            component['default']  = self.string(default)
+            component['datatype'] = self.string(datatype)
+            if flags & binary_flag_label:
+                component['label'] = self.string(label)
+            if flags & binary_flag_options:
+                component['options'] = [
+                    self.string(string_id) for string_id in self.extras[options_start:options_start + option_count]
+                ]
+        else:
+            component['text'] = self.string(text)
+
+        if mask not in self.level_lists:
+            self.level_lists[mask] = [
+                name for i, name in enumerate(self.accesslevel_names) if mask & (1 << i)
+            ]
+        component['accesslevels'] = list(self.level_lists[mask])
+
+        if component['type'] != 'paragraph':
+            component['repeat'] = bool(flags & binary_flag_repeat)
+        if flags & binary_flag_has_hidden:
+            component['hidden'] = bool(flags & binary_flag_hidden)
+        if flags & binary_flag_repeat_index:
+            component['repeat_index'] = self.string(repeat_index)
+        if flags & binary_flag_repeat_min:
+            component['repeat_min'] = repeat_min if repeat_min != -1 else None
+        if flags & binary_flag_repeat_max:
+            component['repeat_max'] = repeat_max if repeat_max != -1 else None
+
+        for i in range(custom_start, custom_start + 2 * custom_count, 2):
+            component[self.string(self.extras[i])] = self.string(self.extras[i+1])
+
+        return component
+
+    def materialise(self):
+        """\
+        Returns the access levels and the component tree as plain dicts and
+        lists, like the JSON model.
+        """
+        components = []
+        # Pairs of (subtree end, children list) for the sections we are in.
+        open_sections = []
+
+        for index in range(self.component_count):
+            while len(open_sections) and open_sections[-1][0] == index:
+                open_sections.pop()
+
+            component = self.decode(index, True)
+            (open_sections[-1][1] if len(open_sections) else components).append(component)
+
+            if component['type'] == 'section':
+                open_sections.append((self.record(index)[binary_subtree_end], component['children']))
+
+        return [dict(level) for level in self.accesslevels], components
+
+    def events(self):
+        """\
+        Iterates over the components in preorder, see iter_model().
+        """
+        # Tuples of (subtree end, index, component) for the sections we are in.
+        open_sections = []
+
+        for index in range(self.component_count):
+            while len(open_sections) and open_sections[-1][0] == index:
+                end, section_index, section = open_sections.pop()
+                yield 'end', section_index, len(open_sections), section
+
+            component = self.decode(index, True)
+            component.pop('children', None)
+
+            if component['type'] == 'section':
+                yield 'start', index, len(open_sections), component
+                open_sections.append((self.record(index)[binary_subtree_end], index, component))
+            else:
+                yield 'leaf', index, len(open_sections), component
+
+        while len(open_sections):
+            end, section_index, section = open_sections.pop()
+            yield 'end', section_index, len(open_sections), section
+
+class BinaryComponentList(object):
+    """\
+    A read-only list of components that are decoded on access.
+    """
+
+    def __init__(self, model, indices):
+        self.model   = model
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.model.node(index) for index in self.indices[i]]
+        return self.model.node(self.indices[i])
+
+    def __iter__(self):
+        for index in self.indices:
+            yield self.model.node(index)
+
+class BinaryComponent(Mapping):
+    """\
+    A read-only component dict that is decoded on first access.
+    """
+
+    def __init__(self, model, index):
+        self.model     = model
+        self.index     = index
+        self.component = None
+
+    def decoded(self):
+        if self.component is None:
+            self.component = self.model.decode(self.index, False)
+        return self.component
+
+    def __getitem__(self, key):
+        return self.decoded()[key]
+
+    def __iter__(self):
+        return iter(self.decoded())
+
+    def __len__(self):
+        return len(self.decoded())
+
+def open_binary(fp):
+    """\
+    Opens a binary model from a binary file object.
+    The file is memory-mapped if possible, otherwise it is read into memory.
+    """
+    try:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError, io.UnsupportedOperation):
+        data = fp.read()
+    return BinaryModel(data)
+
+# }}}
+
+# Streaming model reader {{{
+
+class JSONModelStream(object):
+    """\
+    Reads a JSON model incrementally, without loading the whole document.
+
+    The document structure is scanned in Python; every value other than the
+    component lists and component objects is decoded by the standard
+    library decoder.
+    """
+
+    whitespace = re.compile(r'[ \t\n\r]*')
+
+    # Used to read '"key": ' and the separator after a value in one go.
+    member_key       = re.compile(r'[ \t\n\r]*"([a-zA-Z0-9_\-]*)"[ \t\n\r]*:[ \t\n\r]*')
+    member_separator = re.compile(r'[ \t\n\r]*([,}])')
+
+    # Members are only read with the patterns above when at least this many
+    # characters are buffered, otherwise a member may be cut off at the end of the buffer.
+    margin = 1 << 12
+
+    def __init__(self, fp, prefix='', block_size=json_block_size):
+        self.fp         = fp
+        self.block_size = block_size
+        self.buffer     = ''
+        self.pos        = 0
+        self.eof        = False
+        self.decoder    = json.JSONDecoder()
+        self.utf8       = codecs.getincrementaldecoder('utf-8')()
+        self.append(prefix)
+
+    def append(self, chunk):
+        if not isinstance(chunk, str):
+            # Byte strings on Python 3.
+            chunk = self.utf8.decode(chunk, final=not len(chunk))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos    = 0
+
+    def fill(self):
+        """\
+        Reads the next block from the file. Returns False at end-of-file.
+        """
+        if self.eof:
+            return False
+        chunk = self.fp.read(self.block_size)
+        if not len(chunk):
+            self.eof = True
+        self.append(chunk)
+        return not self.eof
+
+    def peek(self):
+        """\
+        Skips whitespace and returns the next character, or None at end-of-file.
+        """
+        while True:
+            self.pos = self.whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return None
+
+    def expect(self, characters):
+        """\
+        Consumes and returns the next character, which must be one of characters.
+        """
+        character = self.peek()
+        if character is None or character not in characters:
+            raise ValueError(
+                'Malformed JSON model: expected one of "' + characters + '"'
+                + ' but found ' + (repr(character) if character is not None else 'end of file')
+            )
+        self.pos += 1
+        return character
+
+    def value(self):
+        """\
+        Decodes the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # The value may continue in the next block.
+                if self.fill():
+                    continue
+                raise
+
+            # A number at the end of the buffer may continue in the next block as well.
+            if end == len(self.buffer) and self.fill():
+                continue
+
+            self.pos = end
+            return value
+
+    def members(self, component):
+        """\
+        Reads the members of an object into component, for as long as that
+        can be done without crossing the end of the buffer.
+
+        Returns the next state for events(): 'key' to continue with the next
+        member in the regular way (this is also used for the 'children' key),
+        or 'component_end' at the end of the object.
+        """
+        scan_once = self.decoder.scan_once
+
+        while True:
+            if len(self.buffer) - self.pos < self.margin:
+                self.fill()
+
+            buffer = self.buffer
+            key    = self.member_key.match(buffer, self.pos)
+            if key is None or key.group(1) == 'children':
+                return 'key'
+
+            try:
+                value, end = scan_once(buffer, key.end())
+            except (StopIteration, ValueError):
+                return 'key'
+
+            separator = self.member_separator.match(buffer, end)
+            if separator is None or separator.end() >= len(buffer):
+                return 'key'
+
+            component[key.group(1)] = value
+            self.pos = separator.end()
+
+            if separator.group(1) == '}':
+                return 'component_end'
+
+    def events(self, opened=False):
+        """\
+        Iterates over the components in a JSON component list, see iter_model().
+        If opened is True, the opening bracket of the list was already consumed.
+        """
+        if not opened:
+            self.expect('[')
+
+        index = 0
+        depth = 0
+
+        # Tuples of (index, component) for the sections whose children we are reading.
+        open_sections = []
+
+        # The component that is currently being read.
+        current = None
+
+        state = 'list'
+        while True:
+            if state == 'list':
+                # Start of a component list.
+                if self.peek() == ']':
+                    self.pos += 1
+                    state = 'list_end'
+                else:
+                    state = 'component'
+
+            elif state == 'component':
+                self.expect('{')
+                current = (index, dict(), [False]) # The flag is set when the component's children are read.
+                index  += 1
+                if self.peek() == '}':
+                    self.pos += 1
+                    state = 'component_end'
+                else:
+                    state = 'key'
+
+            elif state == 'key':
+                state = self.members(current[1])
+                if state != 'key':
+                    continue
+
+                key = self.value()
+                self.expect(':')
+                if key == 'children':
+                    current[2][0] = True
+                    yield 'start', current[0], depth, current[1]
+                    open_sections.append(current)
+                    depth += 1
+                    self.expect('[')
+                    state = 'list'
+                else:
+                    current[1][key] = self.value()
+                    state = 'next_key'
+
+            elif state == 'next_key':
+                state = 'key' if self.expect(',}') == ',' else 'component_end'
+
+            elif state == 'component_end':
+                component_index, component, has_children = current
+                yield ('end' if has_children[0] else 'leaf'), component_index, depth, component
+                state = 'component' if self.expect(',]') == ',' else 'list_end'
+
+            elif state == 'list_end':
+                if not len(open_sections):
+                    return
+                # Continue reading the keys of the section that owns this list.
+                current = open_sections.pop()
+                depth  -= 1
+                state   = 'next_key'
+
+def iter_model(fp):
+    """\
+    Reads a JSON or binary model incrementally.
+
+    Returns the access levels (None for JSON files that only contain a model
+    description) and an iterator over (event, component index, depth,
+    component) tuples, in preorder:
+
+    - 'start': A section is entered, its children follow
+    - 'end':   A section and all of its children have been read
+    - 'leaf':  A component without children
+
+    Component dicts do not contain children. For JSON models, the dict
+    passed with a 'start' event only contains the keys that precede
+    'children' in the file. The rest is filled in by the time of the
+    'end' event, which passes the same dict.
+
+    Binary models are memory-mapped. JSON models are read block by block,
+    so memory use does not depend on the size of the model.
+    """
+    fp     = getattr(fp, 'buffer', fp) # Python 3 text files: Use the underlying binary file.
+    prefix = fp.read(len(binary_magic))
+
+    if prefix == binary_magic:
+        try:
+            fp.seek(-len(prefix), io.SEEK_CUR)
+            model = open_binary(fp)
+        except (EnvironmentError, io.UnsupportedOperation):
+            # Pipes can not seek.
+            model = BinaryModel(prefix + fp.read())
+        return model.accesslevels, model.events()
+
+    stream = JSONModelStream(fp, prefix)
+    stream.expect('[')
+
+    if stream.peek() != '[':
+        return None, stream.events(opened=True)
+
+    # Files containing both access levels and the model are written as a
+    # nested array, access levels first.
+    accesslevels = stream.value()
+    stream.expect(',')
+
+    def events():
+        for event in stream.events():
+            yield event
+        stream.expect(']')
+
+    return accesslevels, events()
+
+# }}}
+
+def load_model(fp):
+    """\
+    Loads a model from a file object containing either a JSON model or a
+    binary model.
+    Returns the access levels and the component list. Access levels are None
+    for JSON files that only contain a model description.
+    """
+    fp = getattr(fp, 'buffer', fp) # Python 3 text files: Use the underlying binary file.
+
+    try:
+        position = fp.tell()
+        magic    = fp.read(len(binary_magic))
+        fp.seek(position)
+        data     = None
+    except (EnvironmentError, io.UnsupportedOperation):
+        # Pipes can not seek.
+        data  = fp.read()
+        magic = data[:len(binary_magic)]
+
+    if magic == binary_magic:
+        model = open_binary(fp) if data is None else BinaryModel(data)
+        return model.accesslevels, model.components
+
+    model = json.loads((fp.read() if data is None else data).decode('utf-8'))
+
+    # Files containing both access levels and the model are written as a
+    # nested array, access levels first.
+    if len(model) == 2 and isinstance(model[0], list) and isinstance(model[1], list):
+        return model[0], model[1]
+    else:
+        return None, model
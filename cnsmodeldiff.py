@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+from cnsmodel import ComponentTable
+
+# Component keys that are compared between the two versions of a section or
+# parameter. Labels are not compared, the label of a section is part of the
+# key of its components.
+compared_keys = (
+    'datatype', 'options', 'default', 'accesslevels', 'hidden',
+    'repeat', 'repeat_min', 'repeat_max', 'repeat_index',
+)
+
+def format_key(key):
+    """\
+    Returns a readable form of a component key, see ModelIndex.
+    """
+    component_type, path, occurrence = key
+    text = component_type + ' ' + ' / '.join(path)
+    if occurrence > 1:
+        text += ' (' + str(occurrence) + ')'
+    return text
+
+def comparable(component, key):
+    value = component.get(key)
+    if key == 'accesslevels' and value is not None:
+        # The binary format does not preserve the order of access levels.
+        return sorted(value)
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return value
+
+class ModelIndex(object):
+    """\
+    Indexes the sections and parameters of a model by their key: the
+    component type, the labels of the enclosing sections and the label of
+    the section or the name of the parameter itself, and an occurrence
+    number that tells apart components that would otherwise have the same
+    key. Paragraphs have no key.
+
+    Keys are (type, path, occurrence) tuples, for example
+    ('parameter', ('Molecule Definition (NN)', 'moltype_NN'), 1).
+
+    The index is built in a single pass over the model, and can be used for
+    any number of diffs (see ModelDiff).
+    """
+
+    def __init__(self, components, accesslevels=None):
+        """\
+        Components is a list of top-level components or a ComponentTable.
+        Accesslevels is the access level list of the model, or None if it
+        is not known.
+        """
+        self.table        = components if isinstance(components, ComponentTable) else ComponentTable(components)
+        self.accesslevels = accesslevels
+        self.keys         = [None] * len(self.table) # The key of each component index
+        self.indices      = dict()                   # Maps keys to component indices
+
+        table       = self.table
+        paths       = [None] * len(table) # Label paths of sections
+        occurrences = dict()
+
+        for index in range(len(table)):
+            component_type = table.types[index]
+            if component_type == 'paragraph':
+                continue
+
+            component = table[index]
+            parent    = table.parents[index]
+            prefix    = paths[parent] if parent >= 0 else ()
+
+            if component_type == 'section':
+                path = paths[index] = prefix + (component.get('label', ''),)
+            else:
+                path = prefix + (component['name'],)
+
+            occurrence = occurrences[component_type, path] = occurrences.get((component_type, path), 0) + 1
+
+            key = (component_type, path, occurrence)
+            self.keys[index]  = key
+            self.indices[key] = index
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __contains__(self, key):
+        return key in self.indices
+
+    def component(self, key):
+        return self.table[self.indices[key]]
+
+class ModelDiff(object):
+    """\
+    The differences between two versions of a model, given as ModelIndex
+    objects:
+
+    - removed:   Keys of the components that are only in the old model
+    - added:     Keys of the components that are only in the new model
+    - moved:     (old key, new key) pairs of components that moved to
+                 another section. A component is considered moved if its
+                 name (or label, for sections) is unique among both the
+                 removed and the added components of its type.
+    - changed:   (old key, new key, changes) triples of matched components
+                 of which a compared key (see compared_keys) differs.
+                 Changes is a list of (key, old value, new value) triples.
+    - index_map: Maps the old component indices of all matched components
+                 to their new component indices
+
+    Lists are in the order of the old model, except for added, which is in
+    the order of the new model. Every component is looked up only once, so
+    the diff takes linear time.
+    """
+
+    def __init__(self, old, new):
+        self.old       = old
+        self.new       = new
+        self.removed   = []
+        self.added     = []
+        self.moved     = []
+        self.changed   = []
+        self.index_map = dict()
+
+        for key in old.keys:
+            if key is not None and key not in new.indices:
+                self.removed.append(key)
+
+        for key in new.keys:
+            if key is not None and key not in old.indices:
+                self.added.append(key)
+
+        # Match removed and added components with a unique name.
+        def by_name(keys):
+            names = dict()
+            for key in keys:
+                names.setdefault((key[0], key[1][-1]), []).append(key)
+            return names
+
+        removed_names = by_name(self.removed)
+        added_names   = by_name(self.added)
+        moved_to      = dict()
+
+        for key in self.removed:
+            name = (key[0], key[1][-1])
+            if len(removed_names[name]) == 1 and len(added_names.get(name, ())) == 1:
+                moved_to[key] = added_names[name][0]
+                self.moved.append((key, moved_to[key]))
+
+        if moved_to:
+            moved_from   = set(moved_to.values())
+            self.removed = [key for key in self.removed if key not in moved_to]
+            self.added   = [key for key in self.added if key not in moved_from]
+
+        pairs = []
+        for key in old.keys:
+            if key is None:
+                continue
+            if key in new.indices:
+                pairs.append((key, key))
+            elif key in moved_to:
+                pairs.append((key, moved_to[key]))
+
+        for old_key, new_key in pairs:
+            old_index = old.indices[old_key]
+            new_index = new.indices[new_key]
+            self.index_map[old_index] = new_index
+
+            old_component = old.table[old_index]
+            new_component = new.table[new_index]
+            changes = []
+            for key in compared_keys:
+                old_value = comparable(old_component, key)
+                new_value = comparable(new_component, key)
+                if old_value != new_value:
+                    changes.append((key, old_value, new_value))
+            if changes:
+                self.changed.append((old_key, new_key, changes))
+
+        if old.accesslevels is not None and new.accesslevels is not None:
+            old_levels = [level['name'] for level in old.accesslevels]
+            new_levels = [level['name'] for level in new.accesslevels]
+            self.accesslevels_removed = [level for level in old_levels if level not in new_levels]
+            self.accesslevels_added   = [level for level in new_levels if level not in old_levels]
+        else:
+            self.accesslevels_removed = None
+            self.accesslevels_added   = None
+
+    def shifts(self):
+        """\
+        Returns how the component indices of matched components shift, as
+        (old first, old last, delta) triples for runs of consecutive matched
+        components in the old model that shift by the same amount. A run
+        ends at every component that is not matched. Paragraphs are not part
+        of any run, but do not end runs either.
+        Runs with a delta of 0 are included.
+        """
+        runs = []
+        run  = None
+        for index, key in enumerate(self.old.keys):
+            if key is None:
+                continue
+            new_index = self.index_map.get(index)
+            if new_index is None:
+                run = None
+                continue
+            delta = new_index - index
+            if run is not None and run[2] == delta:
+                run[1] = index
+            else:
+                run = [index, index, delta]
+                runs.append(run)
+        return [tuple(run) for run in runs]
+
+    def is_empty(self):
+        """\
+        Whether the models have the same sections and parameters at the same
+        component indices, with the same compared keys (see compared_keys).
+        """
+        return (
+            not len(self.removed) and not len(self.added) and not len(self.moved)
+            and not len(self.changed) and not self.accesslevels_removed and not self.accesslevels_added
+            and len(self.old.table) == len(self.new.table)
+            and all(delta == 0 for first, last, delta in self.shifts())
+        )
+
+    def to_dict(self):
+        """\
+        Returns the diff as a dictionary that can be saved as JSON. Keys are
+        written as {"type", "path", "occurrence", "index"} dictionaries,
+        where index is the component index in the model the key belongs to.
+        Access level changes are None if the access levels of a model are
+        not known.
+        """
+        def entry(index, key):
+            return {
+                'type':       key[0],
+                'path':       list(key[1]),
+                'occurrence': key[2],
+                'index':      index.indices[key],
+            }
+
+        return {
+            'removed': [entry(self.old, key) for key in self.removed],
+            'added':   [entry(self.new, key) for key in self.added],
+            'moved':   [
+                {'old': entry(self.old, old_key), 'new': entry(self.new, new_key)}
+                    for old_key, new_key in self.moved
+            ],
+            'changed': [
+                {
+                    'old':     entry(self.old, old_key),
+                    'new':     entry(self.new, new_key),
+                    'changes': dict((key, [old_value, new_value]) for key, old_value, new_value in changes),
+                }
+                    for old_key, new_key, changes in self.changed
+            ],
+            'shifts': [
+                {'old_first': first, 'old_last': last, 'new_first': first + delta, 'delta': delta}
+                    for first, last, delta in self.shifts()
+            ],
+            'accesslevels': {
+                'removed': self.accesslevels_removed,
+                'added':   self.accesslevels_added,
+            },
+        }
+
+    def format(self):
+        """\
+        Returns the diff as a list of readable lines. Only runs of components
+        that shift are listed.
+        """
+        def located(index, key):
+            return '#' + str(index.indices[key]) + ' ' + format_key(key)
+
+        def value(value):
+            if isinstance(value, list):
+                return '[' + ', '.join('%s' % (item,) for item in value) + ']'
+            return 'none' if value is None else '"%s"' % (value,)
+
+        lines = []
+
+        for level in self.accesslevels_removed or ():
+            lines.append('Removed access level ' + level)
+        for level in self.accesslevels_added or ():
+            lines.append('Added access level ' + level)
+
+        for key in self.removed:
+            lines.append('Removed ' + located(self.old, key))
+        for key in self.added:
+            lines.append('Added ' + located(self.new, key))
+        for old_key, new_key in self.moved:
+            lines.append('Moved ' + located(self.old, old_key) + ' to #' + str(self.new.indices[new_key]) + ' ' + ' / '.join(new_key[1]))
+
+        for old_key, new_key, changes in self.changed:
+            lines.append('Changed ' + located(self.new, new_key) + ': ' + ', '.join(
+                key + ' ' + value(old_value) + ' -> ' + value(new_value) for key, old_value, new_value in changes
+            ))
+
+        for first, last, delta in self.shifts():
+            if delta != 0:
+                lines.append(
+                    'Shifted #' + str(first) + (('-#' + str(last)) if last != first else '')
+                    + ' to #' + str(first + delta) + (('-#' + str(last + delta)) if last != first else '')
+                    + ' (' + ('+' if delta > 0 else '') + str(delta) + ')'
+                )
+
+        return lines
+
+def diff_models(old_components, new_components, old_accesslevels=None, new_accesslevels=None):
+    """\
+    Returns the ModelDiff of two models, given as lists of top-level
+    components or as ComponentTables.
+    """
+    return ModelDiff(
+        ModelIndex(old_components, old_accesslevels),
+        ModelIndex(new_components, new_accesslevels),
+    )
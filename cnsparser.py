@@ -4,6 +4,18 @@ from __future__ import print_function
 import sys
 import re
 import copy
+import functools
+import itertools
+import threading
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from cnsdiagnostics import Diagnostic, Diagnostics
+from cnsmodel import ComponentTable
+from cnsruntime import replace_placeholders
 
 
 def re_string(name="", quote_id=[0]):
@@ -62,24 +74,359 @@ parser_patterns = {
     'linecomment': r'^\s*!\s*(?P<text>.*?)\s*$',
 
     # Match '{ This is a comment }'
-    # Note: This parser does not support multiline block comments.
-    #       Also, block comments may not contain closing braces.
+    # Note: Block comments may not contain closing braces.
     'blockcomment': r'\{\s*(?P<text>[^}]*?)\s*\}',
 }
 
+# Compiled versions of the patterns in parser_patterns and pattern handler lists.
+# Brace blocks that span multiple lines are matched as a single line with
+# embedded newlines (see logical_lines()), so '.' must match newlines as well.
+compiled_patterns = {}
+
+def compile_pattern(pattern):
+    """\
+    Returns a compiled regular expression for a pattern string.
+    Already compiled patterns are returned as-is.
+    """
+    if hasattr(pattern, 'search'):
+        return pattern
+    compiled = compiled_patterns.get(pattern)
+    if compiled is None:
+        compiled = re.compile(pattern, re.DOTALL)
+        compiled_patterns[pattern] = compiled
+    return compiled
+
 class ParserException(Exception):
     pass
 
+# Setting strings in hash attribute lines, see decode_hash_attributes().
+hash_attribute_setting = r'#(?P<key>[a-zA-Z0-9_-]+)(?:\s*[=:]\s*' + re_string('value') + ')?'
+
+def decode_hash_attributes(attributes):
+    """\
+    Returns the (key, value) pairs in the attributes of a hash_attributes
+    line. Value is None for attributes without a value.
+    """
+    return tuple(
+        (setting.group('key'), setting.group('value'))
+            for setting in compile_pattern(hash_attribute_setting).finditer(attributes)
+    )
+
+class LineMemo(object):
+    """\
+    A bounded, thread-safe memo of the pattern handler arguments of lines
+    that occur many times in templates, such as attribute lines, comments
+    and paragraphs, see CNSParser.call_handlers(). The arguments of
+    hash_attributes lines include their decoded settings.
+
+    A memo can be shared by any amount of parsers, also of different
+    classes: entries are keyed on the pattern handlers of the parser as
+    well. When the memo holds max_entries lines, it is cleared.
+    """
+
+    # Names of the patterns whose lines are memoised. Other lines, such as
+    # parameter definitions, rarely occur twice.
+    patterns = frozenset([
+        'static_parameter', 'paragraph', 'hash_attributes', 'plus_attributes', 'linecomment', 'blockcomment'
+    ])
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.entries     = dict() # (Handlers key, line) => (pattern name, handler arguments)
+        self.lock        = threading.Lock()
+
+        self.hits   = 0
+        self.misses = 0
+        self.clears = 0
+
+    def get(self, handlers_key, line):
+        """\
+        Returns the (pattern name, handler arguments) pair of a line, or None.
+        The arguments must not be modified.
+        """
+        with self.lock:
+            entry = self.entries.get((handlers_key, line))
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, handlers_key, line, name, args):
+        with self.lock:
+            if len(self.entries) >= self.max_entries:
+                self.entries.clear()
+                self.clears += 1
+            self.entries[(handlers_key, line)] = (name, args)
+
+    def stats(self):
+        """\
+        Returns a dictionary with memo statistics. The hit rate is None if
+        no lines were looked up yet.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries':     len(self.entries),
+                'max_entries': self.max_entries,
+                'hits':        self.hits,
+                'misses':      self.misses,
+                'hit_rate':    float(self.hits) / lookups if lookups else None,
+                'clears':      self.clears,
+            }
+
+# The memo used by parsers that are not given one.
+line_memo = LineMemo()
+
+# Maps the (name, pattern) pairs of pattern handler lists to small integers,
+# which identify the handlers in LineMemo keys.
+handlers_keys      = {}
+handlers_keys_lock = threading.Lock()
+
+# Worker pools of parse_parallel() by amount of processes. Pools are kept
+# for later calls, as starting the workers takes longer than parsing most
+# templates.
+worker_pools      = {}
+worker_pools_lock = threading.Lock()
+
+def worker_pool(processes):
+    """\
+    Returns the shared pool with the given amount of worker processes for
+    parse_parallel(), starting it if needed.
+    """
+    # Imported here, as it takes a noticeable part of the startup time
+    # of the command line tools, which do not parse in parallel.
+    import multiprocessing
+
+    with worker_pools_lock:
+        pool = worker_pools.get(processes)
+        if pool is None:
+            pool = multiprocessing.Pool(processes)
+            worker_pools[processes] = pool
+        return pool
+
+class BraceScanner(object):
+    """\
+    Tracks brace block nesting over a sequence of lines.
+
+    Recognized blocks are '{ }', '{* *}', '{+ +}' and '{- -}'. Plain brace
+    blocks may be nested. The other blocks end at their closing sequence and
+    can contain any other text. Outside of blocks, a '!' starts a line
+    comment, which may contain unbalanced braces.
+
+    The scanner jumps from one brace or comment character to the next, so
+    every character is visited once.
+    """
+
+    # Characters that need attention outside of blocks and within plain brace blocks.
+    outside = re.compile(r'[{}!]')
+    inside  = re.compile(r'[{}]')
+
+    def __init__(self):
+        # Closing sequences of the blocks we are in, innermost last.
+        self.closers = []
+
+    def scan(self, line):
+        """\
+        Scans the next line. Returns True if no blocks are open at the end of it.
+        """
+        closers = self.closers
+        position = 0
+
+        while True:
+            if len(closers) and closers[-1] != '}':
+                # Only the end of this block matters.
+                position = line.find(closers[-1], position)
+                if position == -1:
+                    return False
+                closers.pop()
+                position += 2
+                continue
+
+            match = (self.inside if len(closers) else self.outside).search(line, position)
+            if match is None:
+                return not len(closers)
+
+            character = match.group()
+            position  = match.end()
+
+            if character == '!':
+                # Line comment.
+                return True
+            elif character == '{':
+                if line[position:position+1] in ('*', '+', '-') and position < len(line):
+                    closers.append(line[position] + '}')
+                    position += 1
+                else:
+                    closers.append('}')
+            elif len(closers):
+                closers.pop()
+            # Closing braces outside of blocks are ignored.
+
+def logical_lines(lines, line_no=1):
+    """\
+    Joins brace blocks that span multiple lines into single lines.
+
+    Iterates over (first line number, last line number, line) tuples, where
+    line contains the right-stripped physical lines, separated by newlines.
+    Line_no is the line number of the first line in lines.
+
+    If a block is not closed at the end of the input, its first line is
+    returned by itself and scanning restarts at the line after it.
+    """
+    source  = iter(lines)
+    pending = [] # Physical lines of the current block.
+    start   = line_no
+
+    while True:
+        scanner = BraceScanner()
+
+        for line in source:
+            line = line.rstrip()
+            pending.append(line)
+
+            if scanner.scan(line):
+                yield start, start + len(pending) - 1, '\n'.join(pending)
+                start  += len(pending)
+                pending = []
+
+        if not len(pending):
+            return
+
+        # Unclosed block at end-of-file.
+        yield start, start, pending[0]
+        start  += 1
+        source  = iter(pending[1:])
+        pending = []
+
+def physical_lines(lines, line_no=1):
+    """\
+    Iterates over (line number, line number, line) tuples for lines that are
+    read one at a time, like logical_lines() does for lines without brace
+    blocks that span multiple lines. Lines are right-stripped.
+    """
+    for line_no, line in enumerate(lines, line_no):
+        yield line_no, line_no, line.rstrip()
+
+class ParseContext(object):
+    """\
+    Holds the mutable state of a single parse() or write() call.
+
+    Every call gets its own context, so a single CNSParser can be used by
+    multiple threads at the same time. Pattern handler functions keep
+    accessing this state as parser attributes (self.current_sections, etc.),
+    which are forwarded to the context of the current call.
+    """
+
+    # Names of the state variables that are forwarded by CNSParser.
+    state = [
+        'current_attributes',
+        'current_paragraph',
+        'current_sections',
+        'accesslevel_names',
+        'line_no',
+        'accesslevels',
+        'components',
+        'component_index',
+    ]
+
+    def __init__(self):
+        self.current_attributes = {} # Data type, etc.
+        self.current_paragraph  = {} # Documentation paragraphs or parameter labels
+        self.current_sections   = [] # Contains pointers to actual section components, used for switching between levels
+        self.accesslevel_names  = [] # Used in parameter access level validation
+        self.line_no            = 0  # Current line number in a CNS source file
+
+        self.accesslevels = [] # A list of access levels
+        self.components   = [] # A tree of components found by the parser
+
+def context_property(name):
+    """\
+    Creates a parser property that forwards to the parse context of the
+    current thread.
+    """
+    def get(self):
+        return getattr(self.local.context, name)
+
+    def set(self, value):
+        setattr(self.local.context, name, value)
+
+    def delete(self):
+        delattr(self.local.context, name)
+
+    return property(get, set, delete)
+
+def with_parse_context(method):
+    """\
+    Decorates a CNSParser method so that it runs with a new parse context.
+    The previous context (if any) is restored afterwards, also when the
+    method raises an exception.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        previous = getattr(self.local, 'context', None)
+        self.local.context = ParseContext()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            if previous is None:
+                del self.local.context
+            else:
+                self.local.context = previous
+
+    return wrapper
+
 class CNSParser(object):
 
-    def __init__(self, source=sys.stdin, verbose=False, warnings=False, fatal_warnings=False):
+    # parse_parallel() parses definition blocks with fewer logical lines
+    # serially: sending the lines to workers and their components back
+    # takes longer than parsing them.
+    parallel_min_lines = 4000
+
+    # Parser state, see ParseContext.
+    current_attributes = context_property('current_attributes')
+    current_paragraph  = context_property('current_paragraph')
+    current_sections   = context_property('current_sections')
+    accesslevel_names  = context_property('accesslevel_names')
+    line_no            = context_property('line_no')
+    accesslevels       = context_property('accesslevels')
+    components         = context_property('components')
+    component_index    = context_property('component_index')
+
+    def __init__(self, source=sys.stdin, verbose=False, warnings=False, fatal_warnings=False, diagnostics=None,
+                 memo=line_memo, multiline_blocks=False):
         """\
         Source must be iteratable, contents are parsed line-by-line.
+        Source is the default template for parse() and write(), which can
+        also be given a different source for each call.
+
+        Warnings are printed to stderr, unless a Diagnostics collector is
+        given (see cnsdiagnostics), which records them instead.
+
+        Memo is the LineMemo for repeated lines, by default the one shared
+        by all parsers, or None to match every line against the patterns.
+
+        If multiline_blocks is set, brace blocks that span multiple lines
+        are read as a single line, see logical_lines(). This changes the
+        components of templates with such blocks, and therefore the
+        component indices in their form data, so it is off by default: form
+        data must be written with the setting of the model it was made for.
         """
-        self.verbose        = verbose
-        self.warnings       = warnings or fatal_warnings
-        self.fatal_warnings = fatal_warnings
-        self.source         = source
+        self.verbose          = verbose
+        self.warnings         = warnings or fatal_warnings
+        self.fatal_warnings   = fatal_warnings
+        self.diagnostics      = diagnostics
+        self.memo             = memo
+        self.multiline_blocks = multiline_blocks
+        self.source           = source
+
+        # Set by parse_start(), see LineMemo.
+        self.handlers_key      = None
+        self.handler_functions = None
+
+        # Holds the parse context of the current thread, see ParseContext.
+        self.local       = threading.local()
+        self.source_lock = threading.Lock()
 
         # Maps regular expressions to handler functions.
         # The contents of named capture groups can be retrieved by the handler
@@ -132,19 +479,28 @@ class CNSParser(object):
             ),
         ]
 
-    def warn(self, text):
+    def warn(self, text, *args, **details):
         """\
         Print a warning if warnings are turned on.
         Throws a ParserException if fatal warnings are turned on.
 
+        Text is formatted with the arguments (if any) by the % operator, only
+        when the warning is shown. Details are the code and the component
+        of the warning, see cnsdiagnostics.Diagnostic.
+
         This method should only be called in parse() or write() context.
         """
         if self.warnings:
+            diagnostic = Diagnostic(details.get('code'), self.line_no, details.get('component'), text, args)
+
             if self.fatal_warnings:
-                raise ParserException('Error on line ' + str(self.line_no) + ': ' + text)
+                raise ParserException('Error on line ' + str(self.line_no) + ': ' + diagnostic.message)
+
+            elif self.diagnostics is not None:
+                self.diagnostics.add(diagnostic)
 
             else:
-                print('Warning on line ' + str(self.line_no) + ':', text, file=sys.stderr)
+                print(str(diagnostic), file=sys.stderr)
 
     def error(self, text):
         """\
@@ -154,12 +510,13 @@ class CNSParser(object):
         """
         raise ParserException('Error on line ' + str(self.line_no) + ': ' + text)
 
-    def printv(self, text):
+    def printv(self, text, *args):
         """\
         Print a message if verbose mode is turned on.
+        Text is formatted with the arguments (if any) like in warn().
         """
         if self.verbose:
-            print('Line ' + str(self.line_no) + ':', text, file=sys.stderr)
+            print('Line ' + str(self.line_no) + ':', text % args if len(args) else text, file=sys.stderr)
 
     def squash_accesslevels(self, inherited, minimum_index, maximum_index, includes, excludes):
         """\
@@ -208,18 +565,18 @@ class CNSParser(object):
             actual_minimum = min([self.accesslevel_names.index(name) for name in levels])
             if minimum_index < actual_minimum:
                 self.warn(
-                    'Specified minimum level \'' + self.accesslevel_names[minimum_index] + '\' '
-                    + 'is lower than the lowest actual access level for this component ('
-                    + self.accesslevel_names[actual_minimum] + ')'
+                    'Specified minimum level \'%s\' is lower than the lowest actual access level for this component (%s)',
+                    self.accesslevel_names[minimum_index], self.accesslevel_names[actual_minimum],
+                    code='level-min'
                 )
 
         if maximum_index is not None:
             actual_maximum = max([self.accesslevel_names.index(name) for name in levels])
             if maximum_index > actual_maximum:
                 self.warn(
-                    'Specified maximum level \'' + self.accesslevel_names[maximum_index] + '\' '
-                    + 'is higher than the highest actual access level for this component ('
-                    + self.accesslevel_names[actual_maximum] + ')'
+                    'Specified maximum level \'%s\' is higher than the highest actual access level for this component (%s)',
+                    self.accesslevel_names[maximum_index], self.accesslevel_names[actual_maximum],
+                    code='level-max'
                 )
 
         return list(levels)
@@ -364,7 +721,7 @@ class CNSParser(object):
         })
         self.accesslevel_names.append(args['name'])
 
-        self.printv('Added accesslevel \'' + args['name'] + '\', labeled \'' + args['label'] + '\'')
+        self.printv('Added accesslevel \'%s\', labeled \'%s\'', args['name'], args['label'])
 
     def handle_parameter(self, args):
         """\
@@ -397,21 +754,23 @@ class CNSParser(object):
             component['label'] = self.current_paragraph
             self.current_paragraph = ""
         else:
-            self.warn('Parameter "' + component['name'] + '" is not labeled')
+            self.warn('Parameter "%s" is not labeled', component['name'], code='unlabeled-parameter', component=component['name'])
 
         self.printv(
-            'Added parameter \'' + component['name']    + '\''
-            + ' datatype = '     + component['datatype']
-            + ' default  = \''   + component['default'] + '\''
+            'Added parameter \'%s\' datatype = %s default  = \'%s\'',
+            component['name'], component['datatype'], component['default']
         )
 
         self.append_component(component)
 
     def handle_hash_attributes(self, args):
         # args.attributes is a string starting with a hash sign that may contain multiple attributes
-        # Extract all settings from this string
-        for setting in re.finditer(r'#(?P<key>[a-zA-Z0-9_-]+)(?:\s*[=:]\s*' + re_string('value') + ')?', args['attributes']):
-            key, value = setting.group('key'), setting.group('value')
+        # Extract all settings from this string, unless call_handlers() did so already.
+        settings = args.get('settings')
+        if settings is None:
+            settings = decode_hash_attributes(args['attributes'])
+
+        for key, value in settings:
 
             if key in set(['level-min', 'level-max', 'level-include', 'level-exclude']):
                 if value not in self.accesslevel_names:
@@ -466,7 +825,7 @@ class CNSParser(object):
             elif key == 'type':
                 self.current_attributes.update({ 'datatype': value })
             else:
-                self.warn('Unknown hash_attributes key "' + key + '" saved as custom attribute')
+                self.warn('Unknown hash_attributes key "%s" saved as custom attribute', key, code='unknown-attribute')
                 # Add it to current_attributes anyway.
                 if 'custom_attributes' not in self.current_attributes:
                     self.current_attributes['custom_attributes'] = dict()
@@ -482,19 +841,19 @@ class CNSParser(object):
                 'datatype': 'choice',
                 'options':  values,
             })
-            self.printv('Saving attributes for next parameter: datatype = choice, options = \'' + args['value'] + '\'')
+            self.printv('Saving attributes for next parameter: datatype = choice, options = \'%s\'', args['value'])
         elif args['key'] == 'table':
             # Rendering and formatting is not our responsibility.
             pass
         else:
-            self.warn('Unknown plus_attributes key "' + args['key'] + '"')
+            self.warn('Unknown plus_attributes key "%s"', args['key'], code='unknown-attribute')
 
     def handle_paragraph(self, args):
         if len(self.current_paragraph):
-            self.printv('Appending to current paragraph: \'' + args['text'] + '\'')
+            self.printv('Appending to current paragraph: \'%s\'', args['text'])
             self.current_paragraph += '\n' + args['text']
         else:
-            self.printv('Creating paragraph or label: \'' + args['text'] + '\'')
+            self.printv('Creating paragraph or label: \'%s\'', args['text'])
             self.current_paragraph = args['text']
 
     def handle_head(self, args):
@@ -533,19 +892,65 @@ class CNSParser(object):
         Hides sections with no visible children in the model description.
         To be called at the end of the parse() function.
         """
-        children_hidden = True
-
-        for component in section['children']:
-            if component['type'] == 'section':
-                self.postprocess_section(component)
-            if (
-                    component['type'] in set(['section', 'parameter'])
-                    and ('hidden' not in component or not component['hidden'])
-                ):
-                children_hidden = False
-                break
+        self.postprocess_sections(ComponentTable([section]))
+
+    def postprocess_sections(self, table):
+        """\
+        Hides sections with no visible children, for all top-level sections in
+        a ComponentTable.
+
+        A section's children are checked in order, child sections are
+        postprocessed before they are checked. Checking stops at the first
+        visible child.
+        """
+        for root in table.children():
+            if table.types[root] != 'section':
+                continue
 
-        section['hidden'] = children_hidden
+            # Stack of (section index, iterator over its remaining children).
+            stack = [(root, table.children(root))]
+
+            # The hidden state of the last postprocessed section, or None if
+            # a section was just entered.
+            child_hidden = None
+
+            while stack:
+                index, children = stack[-1]
+
+                if child_hidden is False:
+                    # The child section we just left is visible.
+                    hidden = False
+                else:
+                    hidden = True
+                    for child in children:
+                        if table.types[child] == 'section':
+                            stack.append((child, table.children(child)))
+                            hidden = None
+                            break
+                        if table.types[child] == 'parameter' and not table[child].get('hidden', False):
+                            hidden = False
+                            break
+
+                    if hidden is None:
+                        # Postprocess the child section first.
+                        child_hidden = None
+                        continue
+
+                table[index]['hidden'] = hidden
+                stack.pop()
+                child_hidden = hidden
+
+    def match_line(self, line):
+        """\
+        Finds the first pattern in self.pattern_handlers that matches the given line.
+        Returns the pattern name, the handler function and the match object,
+        or None if no pattern matched.
+        """
+        for name, pattern, function in self.pattern_handlers:
+            match = compile_pattern(pattern).search(line)
+            if match:
+                return name, function, match
+        return None
 
     def call_handlers(self, line):
         """\
@@ -553,60 +958,168 @@ class CNSParser(object):
         If the function was found and called, returns the name of the matched pattern
         (see the self.pattern_handlers definition).
         Returns None otherwise.
+
+        The handler arguments of repeated lines are taken from the LineMemo
+        of the parser, if it has one.
         """
-        for name, pattern, function in self.pattern_handlers:
-            match = re.search(pattern, line)
-            if match:
-                if function is not None:
-                    # Create an args dictionary based on named capture groups
-                    # in the regex match. Filter out quote captures added with re_string().
-                    args = dict(
-                        (key, value) for (key, value) in match.groupdict().iteritems()
-                            if not re.match('^quote\d+$', key)
-                    )
-                    args['_line'] = line # Pattern handlers may access the exact line through this argument.
+        memo = self.memo if self.handlers_key is not None else None
 
+        if memo is not None:
+            entry = memo.get(self.handlers_key, line)
+            if entry is not None:
+                name, args = entry
+                function = self.handler_functions[name]
+                if function is not None:
+                    args = dict(args)
+                    args['_line'] = line
                     function(args)
                 return name
-        return None
 
-    def parse_start(self):
-        # These properties are used by pattern handler functions.
-        # They are set on the parser object. This avoids having to pass
-        # parser state around as a parameter to every function.
+        matched = self.match_line(line)
+        if matched is None:
+            return None
 
-        self.current_attributes = {} # Data type, etc.
-        self.current_paragraph  = {} # Documentation paragraphs or parameter labels
-        self.current_sections   = [] # Contains pointers to actual section components, used for switching between levels
-        self.accesslevel_names  = [] # Used in parameter access level validation
-        self.line_no            = 0  # Current line number in a CNS source file
+        name, function, match = matched
 
-        self.accesslevels = [] # A list of access levels
-        self.components   = [] # A tree of components found by the parser
+        # Create an args dictionary based on named capture groups
+        # in the regex match. Filter out quote captures added with re_string().
+        args = dict(
+            (key, value) for (key, value) in match.groupdict().iteritems()
+                if not re.match('^quote\d+$', key)
+        )
+        if name == 'hash_attributes':
+            args['settings'] = decode_hash_attributes(args['attributes'])
+
+        if memo is not None and name in memo.patterns:
+            memo.put(self.handlers_key, line, name, dict(args))
+
+        if function is not None:
+            args['_line'] = line # Pattern handlers may access the exact line through this argument.
+
+            function(args)
+        return name
+
+    def stats(self):
+        """\
+        Returns a dictionary with parser statistics: the statistics of the
+        LineMemo of the parser (see LineMemo.stats()), or None if it has none.
+        As memos are shared, these include other parsers using the same memo.
+        """
+        return {
+            'line_memo': self.memo.stats() if self.memo is not None else None,
+        }
+
+    def substitute_parameter_value(self, line, value):
+        """\
+        Replaces the value in a parameter definition line.
+        The new value is enclosed in double quotes if the old value was quoted.
+        """
+        # Escape special characters.
+
+        # Python has some issues with backslashes in regular expressions.
+        # The following converts single backslashes (\) into escaped backslashes (\\).
+        value = re.sub(r'\\', r'\\\\\\\\', value)
+
+        # Escape double quotes
+        value = re.sub(r'"',  r'\"',  value)
+
+        # Is the parameter value in the template enclosed by quotes?
+        if re.search(r'(?<=(?<!\{|=)=)(["' + '\'' + r'])[^;]*?\1(?=;)', line) is not None:
+            # Always output double quotes.
+            return re.sub(r'(?<=(?<!\{|=)=)[^;]*?(?=;)', '"' + value + '"', line)
+        else:
+            return re.sub(r'(?<=(?<!\{|=)=)[^;]*?(?=;)', value, line)
+
+    def substitute_parameter_name(self, line, replace):
+        """\
+        Replaces the name in a parameter definition line with replace(name).
+        This is used to fill in repetition placeholders.
+        """
+        return re.sub(
+            r'(?<=\{===>\})\s*([a-zA-Z0-9_]+)(?==[^;]*?;)',
+            lambda match: ' ' + replace(match.group(1)),
+            line
+        )
+
+    def source_lines(self, lines, line_no=1):
+        """\
+        Iterates over the (first line number, last line number, line) tuples
+        of template lines, joining brace blocks that span multiple lines
+        only if multiline_blocks is set, see logical_lines() and
+        physical_lines().
+        """
+        if self.multiline_blocks:
+            return logical_lines(lines, line_no)
+        return physical_lines(lines, line_no)
+
+    def parse_start(self):
+        """\
+        Resets the parser state used by pattern handler functions.
+        The state is accessed through parser attributes. This avoids having to
+        pass parser state around as a parameter to every function.
+        """
+        self.local.context = ParseContext()
+
+        # Subclasses may change the pattern handlers in their __init__
+        # function, so they are looked up here.
+        handlers = tuple(
+            (name, getattr(pattern, 'pattern', pattern)) for name, pattern, function in self.pattern_handlers
+        )
+        with handlers_keys_lock:
+            self.handlers_key = handlers_keys.setdefault(handlers, len(handlers_keys))
+        self.handler_functions = dict((name, function) for name, pattern, function in self.pattern_handlers)
 
     def parse_end(self):
-        # Clean up. Not necessary, but it's good to leave the parser in its initial state after its done.
-        del self.components
-        del self.accesslevels
-        del self.line_no
-        del self.accesslevel_names
-        del self.current_sections
-        del self.current_paragraph
-        del self.current_attributes
-
-    def parse(self):
+        """\
+        Called when parse() or write() is done.
+        Parser state is discarded together with the parse context of the call,
+        so there is nothing to clean up here. Subclasses may override this.
+        """
+        pass
+
+    def template_lines(self, source=None):
+        """\
+        Returns the lines of the given source, or of the parser's own source,
+        as a list. This allows us to seek within the template.
+
+        The parser's own source is read only once, so that it can be used
+        again by later calls.
+        """
+        if source is not None:
+            return list(source)
+
+        with self.source_lock:
+            if not isinstance(self.source, list):
+                self.source = list(self.source)
+            return self.source
+
+    @with_parse_context
+    def parse(self, source=None, table=False, processes=1, pool=None):
         """\
         Loops through the CNS source file and fills in a model description.
         Returns the accesslevels and components structures.
+
+        Source defaults to the source given to the constructor.
+        If table is True, the components are returned as a ComponentTable
+        instead of a tree.
+
+        If processes is not 1, the definition block is split at top-level
+        sections and parsed by that many worker processes (by default, one
+        per CPU), see parse_parallel(). The result is the same. Pool is a
+        multiprocessing pool to use instead of the shared one.
         """
 
         # Initialize temporary parser state variables.
         self.parse_start()
 
+        # Read lines from a single iterator, so that the loops below continue
+        # where the previous one stopped, even if source is a list.
+        source = iter(self.source if source is None else source)
+
         # Skip until the start of the block parameter definition.
         found_parameter_block = False
 
-        for line in self.source:
+        for line in source:
             self.line_no += 1
             if re.search('- begin block parameter definition -', line) is not None:
                 found_parameter_block = True
@@ -615,12 +1128,35 @@ class CNSParser(object):
         if not found_parameter_block:
             self.error('Could not find the start of the block parameter definition')
 
-        for line in self.source:
-            self.line_no += 1
-            line = line.rstrip()
+        # With multiline_blocks, brace blocks spanning multiple lines are
+        # handled as a single line. Line numbers in warnings refer to the
+        # first line of such a block.
+        if processes == 1:
+            self.parse_definitions(self.source_lines(source, self.line_no + 1))
+        else:
+            self.parse_parallel(list(self.source_lines(source, self.line_no + 1)), processes, pool)
+
+        accesslevels = self.accesslevels
+        components   = self.components
+
+        # Clean up parser state.
+        self.parse_end()
+
+        component_table = ComponentTable(components)
+        self.postprocess_sections(component_table)
+
+        return accesslevels, component_table if table else components
+
+    def parse_definitions(self, lines):
+        """\
+        Calls the pattern handlers for (first line number, last line number,
+        line) tuples from the block parameter definition, as returned by
+        source_lines().
+        """
+        for self.line_no, line_end, line in lines:
             if len(line):
                 if self.call_handlers(line) is None:
-                    self.warn('Could not parse line "' + line + '"')
+                    self.warn('Could not parse line "%s"', line, code='unparsable-line')
                     # Assume that the current paragraph (on the line before this
                     # one) describes this unparsable line, drop it.
                     self.current_paragraph = ''
@@ -631,23 +1167,195 @@ class CNSParser(object):
                     self.current_paragraph = ''
                 continue
 
-        accesslevels = self.accesslevels
-        components   = self.components
+    # Patterns of lines that may come between a parameter definition and the
+    # header of the next top-level section, where the definition block can be
+    # split. Such lines only affect the next component (or nothing at all),
+    # so they are parsed as part of the section that follows them.
+    # None stands for lines that cannot be parsed.
+    section_prefix_patterns = set([
+        'static_parameter',
+        'paragraph',
+        'hash_attributes',
+        'plus_attributes',
+        'linecomment',
+        'blockcomment',
+        None,
+    ])
+
+    def split_definitions(self, lines, chunks):
+        """\
+        Finds the positions where a list of logical lines of the block
+        parameter definition can be split into parts that are parsed
+        separately, see parse_parallel(). Returns the start index of each
+        part, the first part starts at 0.
+
+        The second part starts at the first top-level section header, later
+        parts start after the last parameter definition before a top-level
+        section header. Top-level sections are combined so that there are
+        about the given amount of parts.
+        """
+        section_start = compile_pattern(
+            dict((name, pattern) for name, pattern, function in self.pattern_handlers)['section_start']
+        )
 
-        # Clean up parser state.
-        self.parse_end()
+        # Indices and levels of all section headers.
+        headers = []
+        for index, (line_no, line_end, line) in enumerate(lines):
+            if section_start.search(line) is not None:
+                name, function, match = self.match_line(line)
+                if name == 'section_start':
+                    headers.append((index, len(match.group('indentation'))))
+
+        if not len(headers):
+            return [0]
 
-        for component in components:
-            if component['type'] == 'section':
-                self.postprocess_section(component)
+        # Headers on the lowest level close all open sections.
+        top_level = min(level for index, level in headers)
+        top_level_headers = [index for index, level in headers if level == top_level]
 
-        return accesslevels, components
+        starts = [0, top_level_headers[0]]
+        size   = max(1, (len(lines) - starts[-1]) // chunks)
 
-    def write(self, form_data, aux_file_root):
+        for header in top_level_headers[1:]:
+            if header - starts[-1] < size:
+                continue
+
+            # Walk back to the last parameter definition. At that point, there
+            # are no attributes or labels for a next component.
+            empty_line = False
+            for index in range(header - 1, starts[-1] - 1, -1):
+                line = lines[index][2]
+                if not len(line):
+                    empty_line = True
+                    continue
+
+                matched = self.match_line(line)
+                name = None if matched is None else matched[0]
+
+                if name == 'parameter':
+                    starts.append(index + 1)
+                    break
+
+                if (
+                           name not in self.section_prefix_patterns
+                        or name == 'paragraph' and empty_line
+                    ):
+                    # An empty line after a paragraph adds a paragraph
+                    # component to the previous section, and other lines
+                    # change or depend on the open sections.
+                    break
+
+        return starts
+
+    def parse_parallel(self, lines, processes=None, pool=None):
+        """\
+        Calls the pattern handlers for a list of logical lines of the block
+        parameter definition, like parse_definitions(), using the given
+        amount of worker processes (by default, one per CPU).
+
+        The workers are taken from pool, or from a pool that is shared by
+        all parsers and kept for later calls, see worker_pool(). Lines are
+        parsed serially if there are less than parallel_min_lines of them,
+        or if they cannot be split into enough parts.
+
+        The lines are split at top-level sections, see split_definitions().
+        The first part, which defines the access levels, is parsed here.
+        Other parts are parsed by workers, which get the access levels and
+        the attributes and label for their first component. Their components
+        are appended in order, and their warnings and errors are reported in
+        order, as if the lines were parsed here.
+
+        Workers create a parser of the same class with the same verbose,
+        warnings and multiline_blocks settings. Warnings of workers are recorded in the
+        Diagnostics collector of this parser, if it has one. Subclasses that change the pattern handlers must
+        do so in their __init__ function.
+        """
+        if processes is None:
+            # Imported here, as it takes a noticeable part of the startup time
+            # of the command line tools, which do not parse in parallel.
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+
+        if processes < 2 or len(lines) < self.parallel_min_lines:
+            # Not worth sending to workers.
+            self.parse_definitions(lines)
+            return
+
+        starts = self.split_definitions(lines, processes * 4)
+        chunks = [lines[start:end] for start, end in zip(starts, starts[1:] + [len(lines)])]
+
+        self.parse_definitions(chunks[0])
+
+        if len(chunks) < 3:
+            for chunk in chunks[1:]:
+                self.parse_definitions(chunk)
+            return
+
+        options = {
+            'verbose':          self.verbose,
+            'warnings':         self.warnings,
+            'fatal_warnings':   self.fatal_warnings,
+            'multiline_blocks': self.multiline_blocks,
+        }
+
+        # Only the first section can have attributes or a label from before
+        # its header, the other parts start after a parameter definition.
+        jobs = [
+            (
+                type(self),
+                options,
+                self.diagnostics is not None,
+                chunk,
+                self.accesslevels,
+                self.accesslevel_names,
+                self.current_attributes if index == 0 else {},
+                self.current_paragraph  if index == 0 else '',
+            )
+                for index, chunk in enumerate(chunks[1:])
+        ]
+
+        if pool is None:
+            pool = worker_pool(processes)
+
+        for messages, diagnostics, components, error in pool.imap(parse_chunk, jobs):
+            sys.stderr.write(messages)
+            if diagnostics is not None:
+                self.diagnostics.extend(diagnostics)
+            if error is not None:
+                raise error
+            self.components.extend(components)
+
+    @with_parse_context
+    def parse_chunk(self, lines, accesslevels, accesslevel_names, attributes, paragraph):
+        """\
+        Parses a part of the block parameter definition that starts outside
+        of any section, see parse_parallel(). Attributes and paragraph are the
+        attributes and label for the first component.
+        Returns the components.
+        """
+        self.parse_start()
+
+        self.accesslevels       = accesslevels
+        self.accesslevel_names  = accesslevel_names
+        self.current_attributes = attributes
+        self.current_paragraph  = paragraph
+
+        self.parse_definitions(lines)
+
+        components = self.components
+
+        self.parse_end()
+
+        return components
+
+    @with_parse_context
+    def write(self, form_data, aux_file_root, source=None):
         """\
         Generate a new CNS file based on the supplied CNS source file (used as
         a template) and a form_data structure which describes all instantiated parameters and sections.
         Returns a new CNS file as a list of lines, and a map for renaming auxiliary files.
+
+        Source defaults to the source given to the constructor.
         """
 
         cns          = [] # The CNS output
@@ -655,31 +1363,16 @@ class CNSParser(object):
 
         # First, get the CNS source (file) as an array.
         # This allows us to seek within the file to deal with repetitions.
-        source_array = [line for line in self.source]
-
-        # Replace the source property since we just exhausted it by looping through it.
-        self.source  = source_array
+        source_array = self.template_lines(source)
 
         # Obtain components and accesslevels by parsing the CNS file.
         # This seems redundant since we loop through the CNS file a second time
         # later on, but it simplifies the code.
-        accesslevels, component_tree = self.parse()
-
-        def squash_component_tree(roots):
-            """\
-            Returns a flat list of components.
-            """
-            flat = list()
-            for component in roots:
-                flat.append(component)
-                if component['type'] == 'section':
-                    flat.extend(squash_component_tree(component['children']))
-            return flat
-
+        accesslevels, component_tree = self.parse(source_array)
 
         # Component order in this list will match the component_index numbers
         # supplied in form_data.
-        components = squash_component_tree(component_tree)
+        components = self.flatten_components(component_tree)
         # Note that this list is different from self.components, which is used
         # solely by the parser and in pattern handler functions.
 
@@ -705,7 +1398,7 @@ class CNSParser(object):
         current_paragraph_lines = []
         current_attr_lines      = []
 
-        # The reason we add some properties to the parser object instead of using it as a function-local variable
+        # The reason we add some properties to the parser state instead of using it as a function-local variable
         # is that python's scoping issues do not allow for (non-global) variables from an outer scope to be
         # assigned to in a nested function. We want that flexibility.
         self.component_index = 0
@@ -798,15 +1491,16 @@ class CNSParser(object):
                         section_its[-1]['child_index'] = 0
 
                         self.printv(
-                            'Jumping from line ' + str(self.line_no)
-                            + ' to '             + str(section_its[-1]['parser_state']['line_no'] - 1)
+                            'Jumping from line %d to %d',
+                            self.line_no, section_its[-1]['parser_state']['line_no'] - 1
                         )
 
                         # Restore parser state.
                         self.component_index  = section_its[-1]['component_index']-1
                         self.line_no          = section_its[-1]['parser_state']['line_no'] - 1
-                        self.current_sections = section_its[-1]['parser_state']['current_sections']
-                        self.components       = section_its[-1]['parser_state']['components']
+                        # Copy the saved lists, they are needed again for the next repetition.
+                        self.current_sections = list(section_its[-1]['parser_state']['current_sections'])
+                        self.components       = list(section_its[-1]['parser_state']['components'])
 
                         jumped_for_repetition = True
 
@@ -899,27 +1593,41 @@ class CNSParser(object):
                 'parser_state': {
                     # Save the parser's state so we can easily jump back if we need to repeat this section.
                     'line_no':          self.line_no,
-                    'current_sections': self.current_sections,
-                    'components':       self.components,
+                    'current_sections': list(self.current_sections),
+                    'components':       list(self.components),
                 }
             })
 
             # If this section instantiation doesn't have a single repetition, don't print it at all.
             return (len(section_its[-1]['repetitions']) > 0)
 
+        # With multiline_blocks, brace blocks that span multiple lines are read as a single line, see source_lines().
+        # While such a line is handled, self.line_no is the number of its first physical line.
+        # These describe the line that was read last and the reader it came from.
+        line_start, line_end, lines = None, None, None
+
         while True:
+            if self.line_no == line_start:
+                # We did not jump to another line, continue after the last physical line.
+                self.line_no = line_end
+
             # If at EOF, close or repeat any open sections.
             if self.line_no >= len(source_array):
                 on_section_boundary(at_eof=True)
                 # on_section_boundary() may jump to another line number, check again.
                 if self.line_no >= len(source_array):
                     break
+                # We jumped back for a repetition. A section header that causes
+                # a jump increments the component index below, do the same here.
+                self.component_index += 1
 
-            line          = source_array[self.line_no]
-            self.line_no += 1
+            if self.line_no != line_end:
+                # Start reading at the line we jumped to.
+                lines = self.source_lines(itertools.islice(source_array, self.line_no, None), self.line_no + 1)
 
             # TODO: This kills trailing spaces in our output, check if this is a problem.
-            line = line.rstrip()
+            line_start, line_end, line = next(lines)
+            self.line_no = line_start
 
             if len(line):
                 # Call pattern handler functions like parse() does.
@@ -970,11 +1678,7 @@ class CNSParser(object):
                             cns.extend(current_paragraph_lines)
 
                             # Fill in repetition placeholders in the parameter name.
-                            new_line = re.sub(
-                                r'(?<=\{===>\})\s*([a-zA-Z0-9_]+)(?==[^;]*?;)',
-                                lambda match: ' ' + replace_repetition_placeholders(match.group(1)),
-                                line
-                            )
+                            new_line = self.substitute_parameter_name(line, replace_repetition_placeholders)
 
                             cns.append(new_line)
 
@@ -1097,30 +1801,14 @@ class CNSParser(object):
                                                 else replace_repetition_placeholders(component['default'])
                                         )
 
-                                    # Escape special characters.
-
-                                    # Python has some issues with backslashes in regular expressions.
-                                    # The following converts single backslashes (\) into escaped backslashes (\\).
-                                    repetition = re.sub(r'\\', r'\\\\\\\\', repetition)
-
-                                    # Escape double quotes
-                                    repetition = re.sub(r'"',  r'\"',  repetition)
-
-                                    # Is the parameter value in the template enclosed by quotes?
-                                    if re.search(r'(?<=(?<!\{|=)=)(["' + '\'' + r'])[^;]*?\1(?=;)', new_line) is not None:
-                                        # Always output double quotes.
-                                        new_line = re.sub(r'(?<=(?<!\{|=)=)[^;]*?(?=;)', '"' + repetition + '"', new_line)
-                                    else:
-                                        new_line = re.sub(r'(?<=(?<!\{|=)=)[^;]*?(?=;)', repetition, new_line)
-
-                                    new_line = re.sub(
-                                        r'(?<=\{===>\})\s*([a-zA-Z0-9_]+)(?==[^;]*?;)',
-                                        lambda match: ' ' + (
-                                            replace_repetition_placeholders(match.group(1), self.component_index, repetition_index)
+                                    new_line = self.substitute_parameter_value(new_line, repetition)
+                                    new_line = self.substitute_parameter_name(
+                                        new_line,
+                                        lambda name: (
+                                            replace_repetition_placeholders(name, self.component_index, repetition_index)
                                                 if component['repeat']
-                                                else replace_repetition_placeholders(match.group(1))
-                                        ),
-                                        new_line
+                                                else replace_repetition_placeholders(name)
+                                        )
                                     )
 
                                     cns.append(new_line)
@@ -1154,8 +1842,117 @@ class CNSParser(object):
                 cns.append('')
                 continue
 
-        del self.component_index
-
         self.parse_end()
 
+        if self.multiline_blocks:
+            # Split lines that were joined by logical_lines().
+            cns = [physical_line for line in cns for physical_line in line.split('\n')]
+
         return cns, aux_file_map
+
+    def flatten_components(self, components):
+        """\
+        Returns a flat list of components, in the order of their component indices.
+        """
+        return ComponentTable(components).components
+
+    def rewrite(self, cns, previous_form_data, form_data, aux_file_root, source=None):
+        """\
+        Updates a CNS file that write() generated for previous_form_data so that
+        it matches form_data. Only the lines of parameters whose values changed
+        are regenerated.
+
+        The template is loaded through the template cache (see cnstemplate),
+        so it is parsed and compiled once for all rewrites, see
+        Template.rewrite(). A full write() is done when the form data differ
+        in structure (repetition counts, access level or uploaded files), or
+        when cns does not match previous_form_data.
+
+        Parsers that report diagnostics, use multiline_blocks or are
+        subclassed always do a full write() with their own settings. Changed
+        parameters are then found by comparing the parameter definition lines.
+
+        Returns the new CNS file as a list of lines, a map for renaming auxiliary
+        files (see write()) and a list of the names of all parameter instances
+        whose values changed.
+
+        Source defaults to the source given to the constructor.
+        """
+        source_array = self.template_lines(source)
+
+        if self.multiline_blocks or self.verbose or self.warnings or type(self) is not CNSParser:
+            previous_lines = set(cns)
+            cns, aux_file_map = self.write(form_data, aux_file_root, source_array)
+            changed = []
+            for line in cns:
+                match = re.search(r'\{===>\}\s*([a-zA-Z0-9_]+)\s*=', line)
+                if match is not None and line not in previous_lines:
+                    changed.append(match.group(1))
+            return cns, aux_file_map, changed
+
+        # Imported here, as cnstemplate depends on this module.
+        from cnstemplate import template_cache
+
+        return template_cache.load(''.join(source_array)).rewrite(cns, previous_form_data, form_data, aux_file_root)
+
+    def extract_form_data(self, rendered, level=None):
+        """\
+        Reconstructs the form data for a CNS file that was generated by write()
+        from this parser's source (the template).
+
+        rendered must be iterable, its contents are read line-by-line in a single pass.
+        Level is the access level of the returned form data, it defaults to the
+        last (most complex) access level.
+
+        The rendered lines are aligned with the render program of the template
+        (see cnsrender.Extractor), so repetitions of sections and parameters
+        are detected by their section headers and parameter names with
+        instantiated repeat-index placeholders. The template is loaded through
+        the template cache (see cnstemplate), so it is parsed and compiled
+        once for all files. Parameter instances that are missing in the
+        rendered file get their template default value.
+
+        Returns a form data structure for write(), and a list of names of
+        parameter instances that were not found.
+        """
+        # Imported here, as cnstemplate and cnsrender depend on this module.
+        from cnsrender import Program
+        from cnstemplate import template_cache
+
+        source_array = self.template_lines()
+
+        if self.multiline_blocks or type(self) is not CNSParser:
+            accesslevels, table = self.parse(source_array, table=True)
+            program = Program(source_array, accesslevels, table, self.multiline_blocks)
+        else:
+            template     = template_cache.load(''.join(source_array))
+            accesslevels = template.accesslevels
+            program      = template.compiled()
+
+        if level is None:
+            level = accesslevels[-1]['name']
+
+        return program.extract(rendered, level)
+
+def parse_chunk(job):
+    """\
+    Parses a part of the block parameter definition in a worker process, see
+    CNSParser.parse_parallel(). Returns the warnings and messages printed by
+    the parser, the recorded Diagnostics (if warnings are collected), the
+    components, and the exception raised by the parser, if any.
+    """
+    parser_class, options, collect, lines, accesslevels, accesslevel_names, attributes, paragraph = job
+
+    parser = parser_class(source=[], diagnostics=Diagnostics() if collect else None, **options)
+
+    stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        try:
+            components = parser.parse_chunk(lines, accesslevels, accesslevel_names, attributes, paragraph)
+            error      = None
+        except Exception as e:
+            components, error = [], e
+        diagnostics = parser.diagnostics.entries if collect else None
+        return sys.stderr.getvalue(), diagnostics, components, error
+    finally:
+        sys.stderr = stderr
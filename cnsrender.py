@@ -0,0 +1,974 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import re
+
+from cnsparser import (
+    CNSParser, replace_placeholders, with_parse_context
+)
+from cnsruntime import Fallback
+
+# Render operations {{{
+
+# Operations are tuples, their first item is one of the following kinds.
+TEXT           = 0 # (TEXT, line): A line that is output as-is.
+SUBST          = 1 # (SUBST, line, chain): A line with section placeholders, see Program.
+HIDDEN_PARAM   = 2 # (HIDDEN_PARAM, prefix, line, chain, component_index): A hidden parameter, output with its template value.
+PARAM          = 3 # (PARAM, prefix, line, component_index, chain): A parameter with an instance in form data.
+SECTION        = 4 # (SECTION, node): A section with an instance in form data.
+
+class Node(object):
+    """\
+    A section of a render program, or the root block of the template.
+
+    - index:     The component index of the section, None for the root block
+    - component: The section component, None for the root block
+    - header:    The section header line
+    - chain:     The placeholders that apply within this section, see Program
+    - levels:    The access levels that have access to this section
+    - ops:       The render operations of a single repetition
+    - carry:     Whether repeating this section would carry a pending
+                 paragraph into the next repetition, which the renderer
+                 does not support
+    """
+
+    def __init__(self, index, component, header, chain, level):
+        self.index     = index
+        self.component = component
+        self.header    = header
+        self.chain     = chain
+        self.level     = level
+        self.levels    = frozenset(component['accesslevels']) if component is not None else None
+        self.ops       = []
+        self.carry     = False
+
+class Program(object):
+    """\
+    A template compiled into a tree of render operations.
+
+    CNSParser.write() reads the template line by line and jumps back to the
+    header of a section to render its next repetition. A program describes
+    the same output as nested lists of operations that are repeated as a
+    whole. Labels, attribute lines and paragraphs are resolved to the
+    operations that output them when the program is compiled.
+
+    Placeholders are filled in the same way write() does. A chain is a tuple
+    of (repeat_index, component_index) pairs of the repeatable sections whose
+    placeholders are replaced in a line, from the outermost section inwards.
+
+    The default output of sections that the submitted access level has no
+    access to only depends on the repetition numbers of their ancestors. It
+    is rendered once and reused, as long as the submitted form data has the
+    default shape for the section: the minimum amount of repetitions for
+    repeatable sections, one for other sections.
+
+    Multiline_blocks must be the setting of the CNSParser that parsed the
+    table, see CNSParser.
+    """
+
+    def __init__(self, lines, accesslevels, table, multiline_blocks=False):
+        self.parser = CNSParser(source=lines, multiline_blocks=multiline_blocks)
+        self.table  = table
+        self.root   = Node(None, None, None, (), 0)
+        self.nodes  = dict() # Component index => Node
+
+        # Default output of sections without access, by (component index, outer repetition numbers).
+        self.chunks = dict()
+
+        # Whether any line spans multiple physical lines.
+        self.multiline = False
+
+        # Template lines of parameter definitions, by component index.
+        self.parameter_lines = dict()
+
+        # Parameter definitions with markers for their name and value, by
+        # component index, see Extractor. Created by the first extract().
+        self.definitions = None
+
+        compile_program(self.parser, self, lines)
+
+        # Render the default output of all sections that an access level
+        # with access to the parent cannot see, if the output does not depend
+        # on the repetitions of other sections.
+        all_levels = frozenset(level['name'] for level in accesslevels)
+        for node in self.nodes.values():
+            if len(node.chain) > (1 if node.component['repeat'] else 0):
+                continue
+            parent = table.parents[node.index]
+            parent_levels = table[parent]['accesslevels'] if parent >= 0 else all_levels
+            if len(frozenset(parent_levels) - node.levels):
+                try:
+                    self.chunk(node, {})
+                except Fallback:
+                    # Sections with unsupported repetitions are always rendered by write().
+                    pass
+
+    def chunk(self, node, numbers):
+        """\
+        Returns the default output of a section without access, for the
+        current repetition numbers of its ancestors.
+        """
+        outer = node.chain[:-1] if node.component['repeat'] else node.chain
+        key   = (node.index, tuple(numbers[index] for repeat_index, index in outer))
+
+        lines = self.chunks.get(key)
+        if lines is None:
+            renderer = Renderer(self, {'level': None, 'instances': [], 'files': {}})
+            renderer.numbers.update(numbers)
+            renderer.section(node, self.default_instance(node), False)
+            lines = tuple(renderer.cns)
+            self.chunks[key] = lines
+        return lines
+
+    def default_instance(self, node):
+        """\
+        Returns an instance with the default shape for a section.
+        """
+        component = node.component
+        return {
+            'component_index': node.index,
+            'repetitions': [
+                self.default_instances(node.ops)
+                    for _ in range(component['repeat_min'] if component['repeat'] else 1)
+            ],
+        }
+
+    def default_instances(self, ops):
+        instances = []
+        for op in ops:
+            if op[0] == PARAM:
+                component = self.table[op[3]]
+                instances.append({
+                    'component_index': op[3],
+                    'repetitions':     [''] * (component['repeat_min'] if component['repeat'] else 1),
+                })
+            elif op[0] == SECTION:
+                instances.append(self.default_instance(op[1]))
+        return instances
+
+    def has_default_shape(self, node, instance):
+        """\
+        Checks whether a section instance has the default shape, and passes
+        all checks write() does for it.
+        """
+        component   = node.component
+        repetitions = instance['repetitions']
+
+        if instance['component_index'] != node.index:
+            return False
+        if len(repetitions) != (component['repeat_min'] if component['repeat'] else 1):
+            return False
+        if component['repeat'] and component['repeat_max'] is not None and len(repetitions) > component['repeat_max']:
+            return False
+
+        for instances in repetitions:
+            child_index = 0
+            for op in node.ops:
+                if op[0] == PARAM:
+                    if child_index >= len(instances):
+                        return False
+                    child     = instances[child_index]
+                    parameter = self.table[op[3]]
+                    if child['component_index'] != op[3] or not repetitions_allowed(parameter, child['repetitions']):
+                        return False
+                    child_index += 1
+                elif op[0] == SECTION:
+                    if child_index >= len(instances) or not self.has_default_shape(op[1], instances[child_index]):
+                        return False
+                    child_index += 1
+
+        return True
+
+    def render(self, form_data):
+        """\
+        Renders a CNS file, see CNSParser.write().
+        Raises Fallback if the form data must be rendered by write() instead.
+        """
+        renderer = Renderer(self, form_data)
+        try:
+            renderer.ops(self.root.ops, form_data['instances'], True)
+        except Fallback:
+            raise
+        except Exception:
+            raise Fallback()
+
+        return self.physical_lines(renderer.cns), renderer.aux_file_map
+
+    def render_defaults(self):
+        """\
+        Renders a CNS file with the default shape for all sections and
+        parameters, and the default values of all parameters.
+        Raises Fallback if the file must be rendered by write() instead.
+        """
+        instances = self.default_instances(self.root.ops)
+        renderer  = Renderer(self, {'level': None, 'instances': instances, 'files': {}})
+        try:
+            # Without access, every parameter is rendered with its default value.
+            renderer.ops(self.root.ops, instances, False)
+        except Fallback:
+            raise
+        except Exception:
+            raise Fallback()
+
+        return self.physical_lines(renderer.cns)
+
+    def resolve(self, form_data):
+        """\
+        Returns the parameter values that render() would write, without
+        rendering any text, see Resolver.
+        Raises Fallback if the instances or repetition counts in the form
+        data are not valid. Values are not checked.
+        """
+        resolver = Resolver(self, form_data)
+        try:
+            resolver.ops(self.root.ops, form_data['instances'], True)
+        except Fallback:
+            raise
+        except Exception:
+            raise Fallback()
+        return resolver.values
+
+    def changes(self, previous_form_data, form_data):
+        """\
+        Returns the parameter values that differ in the output of render()
+        for two form datas with the same access level, see ChangeResolver.
+        Raises Fallback if the form datas differ in structure or contain
+        uploaded files.
+        """
+        if form_data['level'] != previous_form_data['level'] or form_data.get('files') or previous_form_data.get('files'):
+            raise Fallback()
+
+        resolver = ChangeResolver(self, form_data['level'])
+        try:
+            resolver.ops(self.root.ops, previous_form_data['instances'], form_data['instances'], True)
+        except Fallback:
+            raise
+        except Exception:
+            raise Fallback()
+        return resolver.changes
+
+    def extract(self, rendered, level):
+        """\
+        Rebuilds the form data that a CNS file was rendered from, see
+        Extractor. Rendered is read line by line, in a single pass.
+
+        Returns the form data with the given access level, and a list of the
+        names of parameter instances that were not found.
+        """
+        if self.definitions is None:
+            parser = self.parser
+            self.definitions = dict(
+                (index, parser.substitute_parameter_name(
+                    parser.substitute_parameter_value(line, value_marker), lambda name: name_marker
+                ))
+                    for index, line in self.parameter_lines.items()
+            )
+
+        extractor = Extractor(self, rendered)
+        instances = extractor.ops(self.root.ops, [])
+        return {
+            'level':     level,
+            'instances': instances,
+            'files':     {},
+        }, extractor.missing
+
+    def physical_lines(self, cns):
+        """\
+        Splits rendered lines that span multiple physical lines.
+        """
+        if self.multiline:
+            return [physical_line for line in cns for physical_line in line.split('\n')]
+        return cns
+
+def repetitions_allowed(component, repetitions):
+    """\
+    Checks a repetition count like write() does.
+    """
+    if component['repeat']:
+        return (
+                (component['repeat_min'] is None or len(repetitions) >= component['repeat_min'])
+            and (component['repeat_max'] is None or len(repetitions) <= component['repeat_max'])
+        )
+    return len(repetitions) == 1
+
+@with_parse_context
+def compile_program(parser, program, lines):
+    """\
+    Fills in the operations of a program, by reading the template the same
+    way CNSParser.write() does.
+    """
+    table = program.table
+    parser.parse_start()
+
+    source = iter(lines)
+    for line in source:
+        parser.line_no += 1
+        line = line.rstrip()
+        program.root.ops.append((TEXT, line))
+        if re.search('- begin block parameter definition -', line) is not None:
+            break
+
+    # Output lines that wait for the next parameter or paragraph end, as operations.
+    paragraph_ops = []
+    attr_ops      = []
+
+    # Open sections, innermost last.
+    nodes = [program.root]
+
+    component_index = 0
+
+    def pending():
+        return len(paragraph_ops) or len(parser.current_paragraph)
+
+    for parser.line_no, line_end, line in parser.source_lines(source, parser.line_no + 1):
+        node = nodes[-1]
+
+        if '\n' in line:
+            program.multiline = True
+
+        if not len(line):
+            if len(parser.current_paragraph):
+                node.ops.extend(paragraph_ops)
+                paragraph_ops = []
+                parser.save_paragraph(parser.current_paragraph)
+                parser.current_paragraph = ''
+                component_index += 1
+            node.ops.append((TEXT, ''))
+            continue
+
+        line_type = parser.call_handlers(line)
+
+        if line_type is None:
+            parser.current_paragraph = ''
+            node.ops.extend(paragraph_ops)
+            paragraph_ops = []
+            node.ops.append((TEXT, line))
+
+        elif line_type == 'section_start':
+            component = table[component_index]
+            level     = parser.current_sections[-1]['level']
+
+            while level <= nodes[-1].level:
+                if nodes[-1].component['repeat'] and pending():
+                    nodes[-1].carry = True
+                nodes.pop()
+            node = nodes[-1]
+
+            attr_ops = []
+
+            if component['hidden']:
+                node.ops.append((SUBST, line, node.chain) if len(node.chain) else (TEXT, line))
+                paragraph_ops = []
+            else:
+                chain = node.chain
+                if component['repeat']:
+                    chain = chain + ((component['repeat_index'], component_index),)
+                child = Node(component_index, component, line, chain, level)
+                if component['repeat'] and pending():
+                    child.carry = True
+                node.ops.append((SECTION, child))
+                program.nodes[component_index] = child
+                nodes.append(child)
+
+            component_index += 1
+
+        elif line_type == 'parameter':
+            component = table[component_index]
+            prefix    = tuple(attr_ops + paragraph_ops)
+
+            if component['hidden']:
+                node.ops.append((HIDDEN_PARAM, prefix, line, node.chain, component_index))
+            else:
+                node.ops.append((PARAM, prefix, line, component_index, node.chain))
+            program.parameter_lines[component_index] = line
+
+            paragraph_ops = []
+            attr_ops      = []
+            component_index += 1
+
+        elif line_type == 'paragraph':
+            paragraph_ops.append((SUBST, line, node.chain) if len(node.chain) else (TEXT, line))
+
+        elif line_type == 'hash_attributes' or line_type == 'plus_attributes':
+            attr_ops.append((TEXT, line))
+
+        else:
+            node.ops.append((TEXT, line))
+
+    # Sections are repeated at end-of-file as well.
+    for node in nodes[1:]:
+        if node.component['repeat'] and pending():
+            node.carry = True
+
+    parser.parse_end()
+
+# }}}
+
+# Renderer {{{
+
+class Renderer(object):
+    """\
+    Renders the operations of a program for form data.
+    Output lines are collected in cns, like CNSParser.write() does.
+    """
+
+    def __init__(self, program, form_data):
+        self.program      = program
+        self.table        = program.table
+        self.form_data    = form_data
+        self.level        = form_data['level']
+        self.cns          = []
+        self.aux_file_map = dict()
+
+        self.substitute_parameter_value = program.parser.substitute_parameter_value
+        self.substitute_parameter_name  = program.parser.substitute_parameter_name
+
+        # The current repetition of each repeatable section, by component index.
+        self.numbers = dict()
+
+        # The amount of instances seen per file parameter, see CNSParser.write().
+        self.file_instance_counts = dict()
+
+    def placeholders(self, chain):
+        numbers = self.numbers
+        return [(repeat_index, numbers[index]) for repeat_index, index in chain]
+
+    def emit(self, op):
+        if op[0] == TEXT:
+            self.cns.append(op[1])
+        else:
+            self.cns.append(replace_placeholders(op[1], self.placeholders(op[2])))
+
+    def ops(self, ops, instances, has_access):
+        """\
+        Renders the operations of a single section repetition.
+        Instances is the list of child instances of the repetition, or None
+        if the section has no repetitions at all.
+        """
+        cns         = self.cns
+        child_index = 0
+
+        for op in ops:
+            kind = op[0]
+
+            if kind == TEXT:
+                cns.append(op[1])
+
+            elif kind == SUBST:
+                cns.append(replace_placeholders(op[1], self.placeholders(op[2])))
+
+            elif kind == PARAM:
+                if instances is not None:
+                    if child_index >= len(instances):
+                        raise Fallback()
+                    self.parameter(op, instances[child_index], has_access)
+                child_index += 1
+
+            elif kind == SECTION:
+                node = op[1]
+                if instances is not None:
+                    if child_index >= len(instances):
+                        raise Fallback()
+                    instance = instances[child_index]
+                    if instance['component_index'] != node.index:
+                        raise Fallback()
+                else:
+                    instance = None
+
+                if (
+                        has_access and instance is not None
+                        and self.level not in node.levels
+                        and self.program.has_default_shape(node, instance)
+                    ):
+                    # Use the prerendered default output.
+                    cns.extend(self.program.chunk(node, self.numbers))
+                else:
+                    self.section(node, instance, has_access)
+                child_index += 1
+
+            elif kind == HIDDEN_PARAM:
+                for prefix_op in op[1]:
+                    self.emit(prefix_op)
+                placeholders = self.placeholders(op[3])
+                cns.append(self.substitute_parameter_name(op[2], lambda name: replace_placeholders(name, placeholders)))
+
+    def section(self, node, instance, has_access):
+        """\
+        Renders all repetitions of a section. Instance is None if the parent
+        section has no repetitions.
+        """
+        component   = node.component
+        repetitions = instance['repetitions'] if instance is not None else []
+
+        if instance is not None and not repetitions_allowed(component, repetitions):
+            raise Fallback()
+        if node.carry and len(repetitions) > 1:
+            raise Fallback()
+
+        has_access = has_access and self.level in node.levels
+
+        if not len(repetitions):
+            self.numbers[node.index] = 0
+            self.ops(node.ops, None, has_access)
+            return
+
+        for repetition, instances in enumerate(repetitions):
+            self.numbers[node.index] = repetition
+            self.emit((SUBST, node.header, node.chain))
+            self.ops(node.ops, instances, has_access)
+
+    def parameter(self, op, instance, has_access):
+        """\
+        Renders all repetitions of a parameter.
+        """
+        prefix, line, component_index = op[1], op[2], op[3]
+        component = self.table[component_index]
+
+        if instance['component_index'] != component_index:
+            raise Fallback()
+        if not repetitions_allowed(component, instance['repetitions']):
+            raise Fallback()
+
+        has_access = has_access and self.level in component['accesslevels']
+
+        is_file = component['datatype'] == 'file'
+        if is_file:
+            local_instance_index = self.file_instance_counts.get(component_index, 0)
+            self.file_instance_counts[component_index] = local_instance_index + 1
+
+        if has_access:
+            repetitions = instance['repetitions']
+        else:
+            repetitions = [None] * (component['repeat_min'] if component['repeat'] else 1)
+
+        chain = self.placeholders(op[4])
+
+        for repetition_index, repetition in enumerate(repetitions):
+            for prefix_op in prefix:
+                self.emit(prefix_op)
+
+            placeholders = chain + [(component['repeat_index'], repetition_index)] if component['repeat'] else chain
+
+            if is_file and has_access:
+                files = self.form_data['files'].get(str(component_index), {}).get(str(local_instance_index), {})
+                if str(repetition_index) in files:
+                    filename_new = replace_placeholders(component['name'], placeholders)
+
+                    # Grab the desired extension from the component's default value.
+                    match = re.search(r'\.(.*)$', component['default'])
+                    if match is not None:
+                        filename_new += '.' + match.group(1)
+
+                    self.aux_file_map[files[str(repetition_index)]['name']] = filename_new
+
+                    if not len(repetition):
+                        raise Fallback()
+                    repetition = filename_new
+
+            if repetition is None:
+                # No access, minimum amount of repetitions.
+                repetition = replace_placeholders(component['default'], placeholders)
+
+            new_line = self.substitute_parameter_value(line, repetition)
+            self.cns.append(self.substitute_parameter_name(new_line, lambda name: replace_placeholders(name, placeholders)))
+
+# }}}
+
+# Resolver {{{
+
+class Resolver(object):
+    """\
+    Walks the operations of a program like a Renderer, but only collects
+    the values of the parameter definitions that would be written.
+
+    Values is a list of (name, component_index, value, submitted) tuples in
+    output order, where name is the instantiated parameter name and value
+    is the value as a string. Submitted is False for the default values of
+    parameters without access and the template values of hidden
+    parameters.
+    """
+
+    def __init__(self, program, form_data):
+        self.program   = program
+        self.table     = program.table
+        self.form_data = form_data
+        self.level     = form_data['level']
+        self.values    = []
+
+        # See Renderer.
+        self.numbers              = dict()
+        self.file_instance_counts = dict()
+
+    def placeholders(self, chain):
+        numbers = self.numbers
+        return [(repeat_index, numbers[index]) for repeat_index, index in chain]
+
+    def ops(self, ops, instances, has_access):
+        child_index = 0
+
+        for op in ops:
+            kind = op[0]
+
+            if kind == PARAM:
+                if instances is not None:
+                    self.parameter(op, instances[child_index], has_access)
+                child_index += 1
+
+            elif kind == SECTION:
+                self.section(op[1], instances[child_index] if instances is not None else None, has_access)
+                child_index += 1
+
+            elif kind == HIDDEN_PARAM:
+                component = self.table[op[4]]
+                self.values.append((
+                    replace_placeholders(component['name'], self.placeholders(op[3])), op[4], component['default'], False
+                ))
+
+        if instances is not None and child_index != len(instances):
+            raise Fallback()
+
+    def section(self, node, instance, has_access):
+        repetitions = instance['repetitions'] if instance is not None else []
+
+        if instance is not None and (
+                instance['component_index'] != node.index or not repetitions_allowed(node.component, repetitions)
+            ):
+            raise Fallback()
+
+        has_access = has_access and self.level in node.levels
+
+        if not len(repetitions):
+            self.numbers[node.index] = 0
+            self.ops(node.ops, None, has_access)
+            return
+
+        for repetition, instances in enumerate(repetitions):
+            self.numbers[node.index] = repetition
+            self.ops(node.ops, instances, has_access)
+
+    def parameter(self, op, instance, has_access):
+        component_index = op[3]
+        component       = self.table[component_index]
+
+        if instance['component_index'] != component_index or not repetitions_allowed(component, instance['repetitions']):
+            raise Fallback()
+
+        has_access = has_access and self.level in component['accesslevels']
+
+        is_file = component['datatype'] == 'file'
+        if is_file:
+            local_instance_index = self.file_instance_counts.get(component_index, 0)
+            self.file_instance_counts[component_index] = local_instance_index + 1
+            files = self.form_data['files'].get(str(component_index), {}).get(str(local_instance_index), {})
+
+        if has_access:
+            repetitions = instance['repetitions']
+        else:
+            repetitions = [None] * (component['repeat_min'] if component['repeat'] else 1)
+
+        chain = self.placeholders(op[4])
+
+        for repetition_index, repetition in enumerate(repetitions):
+            placeholders = chain + [(component['repeat_index'], repetition_index)] if component['repeat'] else chain
+            name         = replace_placeholders(component['name'], placeholders)
+
+            if repetition is None:
+                value = replace_placeholders(component['default'], placeholders)
+            elif is_file and str(repetition_index) in files:
+                # The name the uploaded file is renamed to, see Renderer.
+                value = name
+                match = re.search(r'\.(.*)$', component['default'])
+                if match is not None:
+                    value += '.' + match.group(1)
+            else:
+                value = repetition
+
+            self.values.append((name, component_index, value, repetition is not None))
+
+class ChangeResolver(object):
+    """\
+    Walks the operations of a program for two form datas like a Resolver,
+    but only descends into the instances that differ between them.
+
+    Changes is a list of (name, component_index, previous_value, value)
+    tuples in output order, for the parameter values that the submitted
+    access level has access to and that differ. Form data without uploaded
+    files is assumed, and Fallback is raised for instances or repetition
+    counts that differ.
+    """
+
+    def __init__(self, program, level):
+        self.table   = program.table
+        self.level   = level
+        self.changes = []
+
+        # See Renderer.
+        self.numbers = dict()
+
+    def placeholders(self, chain):
+        numbers = self.numbers
+        return [(repeat_index, numbers[index]) for repeat_index, index in chain]
+
+    def ops(self, ops, previous_instances, instances, has_access):
+        if len(instances) != len(previous_instances):
+            raise Fallback()
+
+        child_index = 0
+
+        for op in ops:
+            kind = op[0]
+
+            if kind == PARAM or kind == SECTION:
+                previous, instance = previous_instances[child_index], instances[child_index]
+                if previous != instance:
+                    if kind == PARAM:
+                        self.parameter(op, previous, instance, has_access)
+                    else:
+                        self.section(op[1], previous, instance, has_access)
+                child_index += 1
+
+        if child_index != len(instances):
+            raise Fallback()
+
+    def section(self, node, previous, instance, has_access):
+        repetitions, previous_repetitions = instance['repetitions'], previous['repetitions']
+
+        if (
+                instance['component_index'] != node.index or previous['component_index'] != node.index
+                or len(repetitions) != len(previous_repetitions)
+            ):
+            raise Fallback()
+
+        has_access = has_access and self.level in node.levels
+
+        for repetition, instances in enumerate(repetitions):
+            if previous_repetitions[repetition] != instances:
+                self.numbers[node.index] = repetition
+                self.ops(node.ops, previous_repetitions[repetition], instances, has_access)
+
+    def parameter(self, op, previous, instance, has_access):
+        component_index = op[3]
+        component       = self.table[component_index]
+
+        repetitions, previous_repetitions = instance['repetitions'], previous['repetitions']
+
+        if (
+                instance['component_index'] != component_index or previous['component_index'] != component_index
+                or len(repetitions) != len(previous_repetitions)
+            ):
+            raise Fallback()
+
+        if not (has_access and self.level in component['accesslevels']):
+            # Default values are written for both.
+            return
+
+        chain = self.placeholders(op[4])
+
+        for repetition_index, value in enumerate(repetitions):
+            if previous_repetitions[repetition_index] != value:
+                placeholders = chain + [(component['repeat_index'], repetition_index)] if component['repeat'] else chain
+                self.changes.append((
+                    replace_placeholders(component['name'], placeholders), component_index,
+                    previous_repetitions[repetition_index], value
+                ))
+
+# }}}
+
+# Extractor {{{
+
+# Stand in for the name and value of a parameter in Program.definitions.
+name_marker  = '\x01'
+value_marker = '\x00'
+
+class Extractor(object):
+    """\
+    Aligns the lines of a rendered CNS file with the operations of a
+    program, and rebuilds the instances of the form data it was rendered
+    from.
+
+    Only section headers and parameter definitions (lines that contain
+    '{==') take part in the alignment, so other lines that were changed by
+    hand are ignored. A repeatable section has a repetition for every
+    header line that is found with the section's repeat placeholders
+    instantiated, and a parameter for every definition with an instantiated
+    name. Sections without parameters are counted by their headers as well.
+
+    Missing parameter instances get their default values, and repeatable
+    components get at least their minimum amount of repetitions. Missing
+    lists the names of parameter instances that were not found.
+    """
+
+    def __init__(self, program, rendered):
+        self.program   = program
+        self.table     = program.table
+        self.multiline = program.multiline
+        self.rendered  = (line.rstrip() for line in rendered if '{==' in line)
+        self.pending   = [] # Lines read ahead
+        self.missing   = []
+
+        self.definitions               = program.definitions
+        self.substitute_parameter_name = program.parser.substitute_parameter_name
+
+        # See Renderer.
+        self.numbers = dict()
+
+    def placeholders(self, chain):
+        numbers = self.numbers
+        return [(repeat_index, numbers[index]) for repeat_index, index in chain]
+
+    def text(self, op):
+        if op[0] == TEXT:
+            return op[1]
+        return replace_placeholders(op[1], self.placeholders(op[2]))
+
+    def peek(self, count):
+        """\
+        Returns the next count aligned lines, or less at the end of the file.
+        """
+        while len(self.pending) < count:
+            line = next(self.rendered, None)
+            if line is None:
+                break
+            self.pending.append(line)
+        return self.pending[:count]
+
+    def expect(self, line):
+        """\
+        Skips a line that write() outputs at this point, if it is found.
+        """
+        if '{==' in line:
+            for physical_line in line.split('\n') if self.multiline else (line,):
+                if '{==' in physical_line and self.peek(1) == [physical_line]:
+                    del self.pending[0]
+
+    def ops(self, ops, instances):
+        """\
+        Aligns the operations of a single section repetition, and appends
+        their instances to the given list. Instances is None for a section
+        without repetitions, whose parameters write() does not output.
+        """
+        for op in ops:
+            kind = op[0]
+
+            if kind == TEXT or kind == SUBST:
+                self.expect(self.text(op))
+
+            elif kind == PARAM:
+                if instances is not None:
+                    instances.append(self.parameter(op))
+
+            elif kind == SECTION:
+                instance = self.section(op[1], instances is not None)
+                if instances is not None:
+                    instances.append(instance)
+
+            elif kind == HIDDEN_PARAM:
+                for prefix_op in op[1]:
+                    self.expect(self.text(prefix_op))
+                placeholders = self.placeholders(op[3])
+                self.expect(self.substitute_parameter_name(op[2], lambda name: replace_placeholders(name, placeholders)))
+
+        return instances
+
+    def section(self, node, has_instance):
+        """\
+        Aligns all repetitions of a section, and returns its instance.
+        """
+        component   = node.component
+        repetitions = []
+
+        if not has_instance:
+            self.numbers[node.index] = 0
+            self.ops(node.ops, None)
+            return None
+
+        if not component['repeat']:
+            self.expect(replace_placeholders(node.header, self.placeholders(node.chain)))
+            repetitions.append(self.ops(node.ops, []))
+        else:
+            while component['repeat_max'] is None or len(repetitions) < component['repeat_max']:
+                self.numbers[node.index] = len(repetitions)
+                header = replace_placeholders(node.header, self.placeholders(node.chain))
+                if self.peek(1) != [header]:
+                    break
+                del self.pending[0]
+                repetitions.append(self.ops(node.ops, []))
+
+            if not len(repetitions):
+                # The output of write() for a section without repetitions.
+                self.numbers[node.index] = 0
+                self.ops(node.ops, None)
+
+            while len(repetitions) < (component['repeat_min'] or 0):
+                repetitions.append(self.program.default_instances(node.ops))
+
+        return {
+            'component_index': node.index,
+            'repetitions':     repetitions,
+        }
+
+    def parameter(self, op):
+        """\
+        Aligns all repetitions of a parameter, and returns its instance.
+        """
+        component_index = op[3]
+        component       = self.table[component_index]
+
+        # Lines that write() outputs before every repetition.
+        prefix = [
+            line for line in (self.text(prefix_op) for prefix_op in op[1])
+                if '{==' in line
+        ]
+        if self.multiline:
+            prefix = [line for lines in prefix for line in lines.split('\n') if '{==' in line]
+
+        if component['repeat']:
+            minimum, maximum = component['repeat_min'] or 0, component['repeat_max']
+        else:
+            minimum, maximum = 1, 1
+
+        chain       = self.placeholders(op[4])
+        repetitions = []
+
+        while maximum is None or len(repetitions) < maximum:
+            placeholders = chain + [(component['repeat_index'], len(repetitions))] if component['repeat'] else chain
+            name         = replace_placeholders(component['name'], placeholders)
+
+            lines = self.peek(len(prefix) + 1)
+            value = self.value(lines[-1], component_index, name) if len(lines) > len(prefix) and lines[:-1] == prefix else None
+
+            if value is not None:
+                del self.pending[:len(lines)]
+                repetitions.append(value)
+            elif len(repetitions) < minimum:
+                self.missing.append(name)
+                repetitions.append(replace_placeholders(component['default'], placeholders))
+            else:
+                break
+
+        return {
+            'component_index': component_index,
+            'repetitions':     repetitions,
+        }
+
+    def value(self, line, component_index, name):
+        """\
+        Returns the value in the definition of a parameter instance, or None
+        if the line is not its definition.
+        """
+        definition = self.definitions[component_index].replace(name_marker, name)
+        if value_marker not in definition:
+            # A definition without a value is written the same for every value.
+            return self.table[component_index]['default'] if line == definition else None
+
+        start, end = definition.split(value_marker, 1)
+        if len(line) < len(start) + len(end) or not line.startswith(start) or not line.endswith(end):
+            return None
+
+        value = line[len(start):len(line) - len(end)]
+        if '\\' in value:
+            # Undo the escaping done by CNSParser.substitute_parameter_value().
+            value = re.sub(r'\\(["\\])', r'\1', value)
+        return value
+
+# }}}
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import copy
+import hashlib
+import json
+import os
+
+from cnscolumnar import is_columnar
+from cnsruntime import file_mode
+
+# Increase when the rendered output or the entry format changes, so
+# entries of older versions are no longer found.
+render_cache_version = 1
+
+def file_token(component_index, instance_index, repetition_index):
+    """\
+    Returns the name that replaces the client's name of an uploaded file in
+    canonical form data, which is the same in both form data formats.
+    """
+    return 'file:%s/%s/%s' % (component_index, instance_index, repetition_index)
+
+def names_file(value, name):
+    """\
+    Checks whether the submitted value of a file parameter is the client's
+    name of its uploaded file, possibly with a path such as C:\\fakepath\\.
+    """
+    return (
+        isinstance(value, (str, type(u''))) and isinstance(name, (str, type(u'')))
+            and (value == name or value.endswith('\\' + name) or value.endswith('/' + name))
+    )
+
+def canonical_form_data(form_data):
+    """\
+    Returns canonical form data, in which the client's names of uploaded
+    files are replaced by their position (see file_token()), and a dict that
+    maps these tokens back to the client's names.
+
+    The submitted values of the file parameters are replaced by the same
+    tokens, as CNSParser.write() does not use them. Values are only replaced
+    if they name the uploaded file (see names_file()), as the value of a
+    parameter that is not a file parameter is used, whatever is in
+    form_data['files'].
+
+    Returns None for the mapping if two uploaded files have the same name,
+    as the auxiliary file map of such form data depends on their order.
+    """
+    form_data = copy.deepcopy(form_data)
+    names     = dict()
+
+    # Lists of (token, file, list holding the submitted value, position of the value).
+    if is_columnar(form_data):
+        files       = []
+        repetitions = form_data.get('repetitions', ())
+        values      = form_data.get('values', ())
+        for component_index, instance_index, repetition_index, file in form_data.get('files', ()):
+            position = None
+            if 0 <= component_index < min(len(repetitions), len(values)):
+                position = sum(repetitions[component_index][:instance_index]) + repetition_index
+            files.append((
+                file_token(component_index, instance_index, repetition_index),
+                file,
+                values[component_index] if position is not None else None,
+                position,
+            ))
+    else:
+        uploads = form_data.get('files', {})
+
+        # The repetition lists of every file parameter instance with uploads,
+        # by component index and local instance index.
+        instances = dict()
+        counts    = dict()
+        pending   = list(reversed(form_data.get('instances', [])))
+        while pending:
+            instance = pending.pop()
+            if not isinstance(instance, dict) or not isinstance(instance.get('repetitions'), list):
+                continue
+            component_key = str(instance.get('component_index'))
+            if component_key in uploads:
+                local_instance_index = counts.get(component_key, 0)
+                counts[component_key] = local_instance_index + 1
+                instances[component_key, str(local_instance_index)] = instance['repetitions']
+            for repetition in reversed(instance['repetitions']):
+                if isinstance(repetition, list):
+                    pending.extend(reversed(repetition))
+
+        files = [
+            (
+                file_token(component_index, instance_index, repetition_index),
+                file,
+                instances.get((component_index, instance_index)),
+                int(repetition_index) if repetition_index.isdigit() else None,
+            )
+                for component_index, instances_ in uploads.items()
+                    for instance_index, repetitions in instances_.items()
+                        for repetition_index, file in repetitions.items()
+        ]
+
+    for token, file, values, position in files:
+        if (
+                   values is not None and position is not None and 0 <= position < len(values)
+                and names_file(values[position], file['name'])
+            ):
+            values[position] = token
+        names[token] = file['name']
+        file['name'] = token
+
+    if len(set(names.values())) != len(names):
+        return form_data, None
+
+    return form_data, names
+
+def form_data_digest(form_data):
+    """\
+    Returns the SHA-1 hex digest of canonical form data, see
+    canonical_form_data(). Key order and whitespace do not matter.
+    """
+    return hashlib.sha1(
+        json.dumps(form_data, sort_keys=True, separators=(',', ':')).encode('utf-8')
+    ).hexdigest()
+
+class RenderCache(object):
+    """\
+    An on-disk cache of rendered CNS files, keyed on the digest of the
+    template contents and of the canonical form data (see
+    canonical_form_data()). Every entry holds the rendered lines and the
+    auxiliary file map, as returned by CNSParser.write().
+
+    The directory can be shared by any number of processes: entries are
+    written atomically and are never modified. When the entries take more
+    than max_bytes, the least recently used entries are removed.
+
+    Hits, misses, stores and evictions are counted per RenderCache object,
+    see stats().
+    """
+
+    def __init__(self, directory, max_bytes=256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.hits      = 0
+        self.misses    = 0
+        self.stores    = 0
+        self.evictions = 0
+
+    def path(self, template_digest, form_data_digest):
+        key = hashlib.sha1(
+            (str(render_cache_version) + ':' + template_digest + ':' + form_data_digest).encode('ascii')
+        ).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, template_digest, form_data):
+        """\
+        Returns the (lines, aux_file_map) pair that was stored for the
+        template and form data, or None.
+        """
+        canonical, names = canonical_form_data(form_data)
+        if names is None:
+            self.misses += 1
+            return None
+
+        path = self.path(template_digest, form_data_digest(canonical))
+        try:
+            with open(path) as fp:
+                entry = json.load(fp)
+            # Mark the entry as recently used.
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+
+        lines     = entry['lines']
+        file_map  = dict((names[token], name) for token, name in entry['files'].items())
+        self.hits += 1
+
+        if str is bytes:
+            # Python 2: json returns unicode strings, the renderers return byte strings.
+            lines    = [line.encode('utf-8') for line in lines]
+            file_map = dict((name, new_name.encode('utf-8')) for name, new_name in file_map.items())
+
+        return lines, file_map
+
+    def put(self, template_digest, form_data, lines, aux_file_map):
+        """\
+        Stores rendered lines and their auxiliary file map, and evicts
+        entries if the cache is too large. Failures, for example in
+        read-only directories, are ignored.
+        """
+        # Imported here, entries are only written after a miss.
+        import tempfile
+
+        canonical, names = canonical_form_data(form_data)
+        if names is None:
+            return
+
+        tokens = dict((name, token) for token, name in names.items())
+        if not set(aux_file_map).issubset(tokens):
+            return
+
+        entry = {
+            'lines': list(lines),
+            'files': dict((tokens[name], new_name) for name, new_name in aux_file_map.items()),
+        }
+
+        path = self.path(template_digest, form_data_digest(canonical))
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.', suffix='.tmp')
+        except (IOError, OSError):
+            return
+
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                json.dump(entry, fp)
+            os.chmod(temp_path, file_mode())
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+
+        self.stores += 1
+        self.evict()
+
+    def write(self, template, form_data, aux_file_root):
+        """\
+        Renders a CNS file like template.write(), unless it is in the cache.
+        Template can be a Template or a TemplateFile (see cnsruntime).
+        """
+        result = self.get(template.digest, form_data)
+        if result is None:
+            result = template.write(form_data, aux_file_root)
+            self.put(template.digest, form_data, result[0], result[1])
+        return result
+
+    def evict(self):
+        """\
+        Removes the least recently used entries until the entries take at
+        most max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.json'):
+                try:
+                    info = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    # Removed by another process.
+                    continue
+                entries.append((info.st_mtime, info.st_size, name))
+
+        size = sum(entry_size for mtime, entry_size, name in entries)
+        for mtime, entry_size, name in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                self.evictions += 1
+            except OSError:
+                pass
+            size -= entry_size
+
+    def stats(self):
+        """\
+        Returns a dictionary with the counters of this object and the hit
+        rate, which is None if nothing was looked up yet.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits':      self.hits,
+            'misses':    self.misses,
+            'hit_rate':  float(self.hits) / lookups if lookups else None,
+            'stores':    self.stores,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import hashlib
+import marshal
+import os
+import re
+
+from cnscolumnar import is_columnar
+
+# The parts of the renderer that are needed to render a template from its
+# bytecode file: the generated render functions only depend on this module,
+# so jsontocns.py does not need to import the parser, the model or the
+# render program compiler for templates that were rendered before.
+
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:
+    # Python 2.
+    import imp
+    MAGIC_NUMBER = imp.get_magic()
+
+# Bytecode files start with this header, followed by the Python bytecode
+# magic number, the SHA-1 digest of the template and the marshalled code.
+# Increase the version when the generated code changes.
+bytecode_header = b'CNSC\x02'
+
+def bytecode_path(cache_dir, digest):
+    """\
+    Returns the path of the bytecode file for a template in a bytecode cache
+    directory, given the digest of the template contents.
+    """
+    return os.path.join(cache_dir, digest + '.cnsc')
+
+def file_mode():
+    """\
+    Returns the mode of new files according to the umask. Files created with
+    tempfile.mkstemp() are only accessible by their owner, and get this mode
+    before they replace a file that others may need to read.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+# Runtime {{{
+
+class Fallback(Exception):
+    """\
+    Raised by the renderer for form data it does not render itself, such as
+    form data with errors. CNSParser.write() should be used instead, which
+    also reports the error.
+    """
+    pass
+
+def replace_placeholders(string, placeholders):
+    """\
+    Replaces repetition index placeholders in a string.
+    Placeholders is a sequence of (repeat_index, repetition) pairs, ordered
+    from the outermost to the innermost component. Repetitions are zero-based,
+    the substituted numbers start at 1.
+    """
+    for repeat_index, repetition in placeholders:
+        string = re.sub(repeat_index, str(repetition + 1), string)
+    return string
+
+def escape(value):
+    """\
+    Escapes a parameter value for a parameter definition line, like
+    CNSParser.substitute_parameter_value() does.
+    """
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+def escape_value(value):
+    """\
+    Escapes a submitted parameter value, see escape().
+    Raises Fallback for values that can not be rendered by generated code.
+    """
+    value = escape(value)
+    if '{===>}' in value:
+        # The value would change the parameter names found in the line.
+        raise Fallback()
+    return value
+
+# }}}
+
+# Generated programs {{{
+
+class RenderState(object):
+    """\
+    The state of a single render call of a generated program.
+    """
+
+    def __init__(self, form_data):
+        self.form_data            = form_data
+        self.level                = form_data['level']
+        self.aux_file_map         = dict()
+        self.file_instance_counts = dict()
+
+class ColumnarRenderState(RenderState):
+    """\
+    The state of a single render call for columnar form data.
+    The columns are read with an iterator per component.
+    """
+
+    def __init__(self, form_data):
+        RenderState.__init__(self, form_data)
+        self.repetitions = list(map(iter, form_data['repetitions']))
+        self.values      = list(map(iter, form_data['values']))
+
+        # Uploaded file names by (component index, local instance index, repetition index).
+        self.file_names = dict(
+            ((component_index, instance_index, repetition_index), file['name'])
+                for component_index, instance_index, repetition_index, file in form_data.get('files', ())
+        )
+
+    def exhausted(self):
+        """\
+        Checks whether all repetitions and values were read.
+        """
+        for column in self.repetitions + self.values:
+            for item in column:
+                return False
+        return True
+
+def load_bytecode(path, digest):
+    """\
+    Returns the code in a bytecode file, or None if the file does not exist
+    or was generated for another template or Python version.
+    """
+    header = bytecode_header + MAGIC_NUMBER + digest.encode('ascii')
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+    except (IOError, OSError):
+        return None
+
+    if not data.startswith(header):
+        return None
+    try:
+        return marshal.loads(data[len(header):])
+    except (ValueError, EOFError, TypeError):
+        return None
+
+def save_bytecode(path, digest, code):
+    """\
+    Writes a bytecode file, and creates its directory if needed. The file is
+    replaced atomically, so concurrent renders never read a partially
+    written file. Failures, for example in read-only directories, are
+    ignored.
+    """
+    # Imported here, bytecode files are only saved when they are out of date.
+    import tempfile
+
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    except (IOError, OSError):
+        return
+
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(bytecode_header + MAGIC_NUMBER + digest.encode('ascii'))
+            fp.write(marshal.dumps(code))
+        os.chmod(temp_path, file_mode())
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+class GeneratedProgram(object):
+    """\
+    A render program compiled into a Python render function.
+
+    The generated code does not refer to the template or its render
+    program, so it can be loaded from a bytecode file without parsing the
+    template.
+    """
+
+    def __init__(self, code):
+        namespace = {
+            'Fallback':             Fallback,
+            'replace_placeholders': replace_placeholders,
+            'escape_value':         escape_value,
+        }
+        exec(code, namespace)
+        self.render_root          = namespace['render_root']
+        self.render_columnar_root = namespace['render_columnar_root']
+        self.multiline            = namespace['multiline']
+
+    def render(self, form_data):
+        """\
+        Renders a CNS file, see CNSParser.write(). Form data can be given in
+        the columnar format as well, see cnscolumnar.
+        Raises Fallback if the form data must be rendered by write() instead.
+        """
+        if is_columnar(form_data):
+            return self.render_columnar(form_data)
+
+        state = RenderState(form_data)
+        cns   = []
+        try:
+            self.render_root(cns, state, form_data['instances'])
+        except Fallback:
+            raise
+        except Exception:
+            raise Fallback()
+
+        return self.physical_lines(cns), state.aux_file_map
+
+    def render_columnar(self, form_data):
+        """\
+        Renders a CNS file for columnar form data.
+        Raises Fallback if the form data must be rendered by write() instead.
+        """
+        cns = []
+        try:
+            state = ColumnarRenderState(form_data)
+            self.render_columnar_root(cns, state)
+            if not state.exhausted():
+                raise Fallback()
+        except Fallback:
+            raise
+        except Exception:
+            raise Fallback()
+
+        return self.physical_lines(cns), state.aux_file_map
+
+    def physical_lines(self, cns):
+        """\
+        Splits rendered lines that span multiple physical lines.
+        """
+        if self.multiline:
+            return [physical_line for line in cns for physical_line in line.split('\n')]
+        return cns
+
+# }}}
+
+# Template files {{{
+
+class TemplateFile(object):
+    """\
+    A template file with its generated render function, see cnscodegen.
+
+    With a bytecode cache directory, the generated code is cached in a
+    bytecode file in that directory, named after the digest of the template
+    contents, see bytecode_path(). When that file exists, the template is
+    only parsed if form data must be rendered by CNSParser.write().
+    Otherwise the template is parsed and compiled when the TemplateFile is
+    created, and the bytecode file is saved. Bytecode files are executed
+    when they are loaded, so the cache directory must only be writable by
+    trusted users.
+
+    Without a cache directory, the template is parsed and rendered like
+    Template.write(), and nothing is written.
+
+    - path:     The path of the template file
+    - contents: The contents of the template file
+    - digest:   SHA-1 hex digest of the contents, like Template.digest
+    - template: The Template, or None if the template was not parsed
+    """
+
+    def __init__(self, path, cache_dir=None):
+        with open(path, 'rb') as fp:
+            contents = fp.read()
+
+        self.path     = path
+        self.contents = contents
+        self.digest   = hashlib.sha1(contents).hexdigest()
+        self.template = None
+        self.program  = None
+
+        code = load_bytecode(bytecode_path(cache_dir, self.digest), self.digest) if cache_dir is not None else None
+        if code is not None:
+            self.program = GeneratedProgram(code)
+        else:
+            # Imported here, the template is only parsed when there is no
+            # bytecode file or form data must be rendered by CNSParser.write().
+            from cnstemplate import template_cache
+            self.template = template_cache.load(contents)
+            if cache_dir is not None:
+                self.program = self.template.generated(bytecode_path(cache_dir, self.digest))
+
+    def write(self, form_data, aux_file_root):
+        """\
+        Renders a CNS file based on the template, like Template.write().
+        """
+        if self.program is not None:
+            try:
+                return self.program.render(form_data)
+            except Fallback:
+                if self.template is None:
+                    from cnstemplate import template_cache
+                    self.template = template_cache.load(self.contents)
+        return self.template.write(form_data, aux_file_root)
+
+# }}}
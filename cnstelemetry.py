@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import contextlib
+import json
+import os
+import stat
+import sys
+import time
+
+from cnscolumnar import is_columnar
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+def cpu_time():
+    """\
+    Returns the user and system CPU time of this process in seconds.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+def peak_rss():
+    """\
+    Returns the peak resident set size of this process in bytes, or None if
+    it is not known on this platform.
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def file_size(*files):
+    """\
+    Returns the total size in bytes of the given output files, counting
+    files with the same name once, or None if one of them is not a regular
+    file (for example, stdout connected to a pipe).
+    """
+    size = 0
+    for fp in dict((fp.name, fp) for fp in files).values():
+        fp.flush()
+        info = os.fstat(fp.fileno())
+        if not stat.S_ISREG(info.st_mode):
+            return None
+        size += info.st_size
+    return size
+
+def form_data_counts(form_data):
+    """\
+    Counts the repetitions in form data, in either format (see cnscolumnar).
+    Returns a dictionary with:
+
+    - section_repetitions:   The total amount of section repetitions
+    - parameter_repetitions: The total amount of parameter repetitions (values)
+    - jump_backs:            The amount of times CNSParser.write() jumps back
+                             in the template to render another repetition of
+                             a section
+    """
+    section_repetitions   = 0
+    parameter_repetitions = 0
+    jump_backs            = 0
+
+    if is_columnar(form_data):
+        for counts, values in zip(form_data['repetitions'], form_data['values']):
+            # Section columns have no values, parameter columns have a value
+            # for every repetition.
+            parameter_repetitions += len(values)
+            if not len(values):
+                section_repetitions += sum(counts)
+                jump_backs          += sum(count - 1 for count in counts if count > 1)
+    else:
+        pending = [form_data['instances']]
+        while pending:
+            for instance in pending.pop():
+                repetitions = instance['repetitions']
+                if len(repetitions) and isinstance(repetitions[0], list):
+                    section_repetitions += len(repetitions)
+                    jump_backs          += len(repetitions) - 1
+                    pending.extend(repetitions)
+                else:
+                    parameter_repetitions += len(repetitions)
+
+    return {
+        'section_repetitions':   section_repetitions,
+        'parameter_repetitions': parameter_repetitions,
+        'jump_backs':            jump_backs,
+    }
+
+class Telemetry(object):
+    """\
+    Collects performance measurements of a single run of a tool, which are
+    saved as a JSON record:
+
+        {"tool": "jsontocns", "wall_time": 0.21, "cpu_time": 0.19,
+         "stages": {"parse": {"wall_time": 0.1, "cpu_time": 0.09}, ...},
+         "peak_rss": 20971520, ...}
+
+    Times are in seconds and include everything since the Telemetry was
+    created. Other entries are set by the tool, see set().
+    """
+
+    def __init__(self, tool):
+        self.start_wall = time.time()
+        self.start_cpu  = cpu_time()
+        self.record     = {
+            'tool':   tool,
+            'stages': {},
+        }
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """\
+        Measures the wall and CPU time of a with block as the given stage.
+        Times of stages that are entered more than once are added up.
+        """
+        start_wall = time.time()
+        start_cpu  = cpu_time()
+        try:
+            yield
+        finally:
+            stage = self.record['stages'].setdefault(name, {'wall_time': 0.0, 'cpu_time': 0.0})
+            stage['wall_time'] += time.time() - start_wall
+            stage['cpu_time']  += cpu_time() - start_cpu
+
+    def set(self, **entries):
+        """\
+        Adds entries to the record.
+        """
+        self.record.update(entries)
+
+    def save(self, path):
+        """\
+        Writes the record to a JSON file, with the total times and the peak
+        resident set size (in bytes, or null if not known) up to now.
+        """
+        self.record['wall_time'] = time.time() - self.start_wall
+        self.record['cpu_time']  = cpu_time() - self.start_cpu
+        self.record['peak_rss']  = peak_rss()
+
+        with open(path, 'w') as fp:
+            json.dump(self.record, fp, sort_keys=True)
+            fp.write('\n')
@@ -0,0 +1,986 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import collections
+import hashlib
+import json
+import re
+import sys
+import threading
+import weakref
+
+from cnscolumnar import from_columnar, is_columnar
+from cnsparser import CNSParser, replace_placeholders
+from cnsmodel import ComponentTable
+from cnsrender import Fallback, Program
+from cnscodegen import generate_code
+from cnsruntime import GeneratedProgram, TemplateFile, load_bytecode, save_bytecode
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Generating the render function of a template takes several times as long
+# as compiling and running its render program, so Template.write() only
+# generates it once the template has been written this many times.
+generate_after = 32
+
+
+class FrozenDict(dict):
+    """\
+    A dictionary that cannot be modified after it has been created.
+
+    This is a dict subclass, so frozen components can still be passed to
+    code that expects model dictionaries, including json.dump().
+    Use dict(frozen) to obtain a modifiable copy.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('FrozenDict objects are immutable')
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear       = _readonly
+    pop         = _readonly
+    popitem     = _readonly
+    setdefault  = _readonly
+    update      = _readonly
+
+    def __reduce__(self):
+        # The default dict reduction calls __setitem__, which would fail for
+        # copy.deepcopy() and pickle.
+        return (FrozenDict, (dict(self),))
+
+    def __hash__(self):
+        return hash(frozenset(self.items()))
+
+def freeze(value):
+    """\
+    Returns an immutable copy of a parser data structure: dictionaries are
+    converted to FrozenDicts and lists to tuples.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+def estimate_size(value):
+    """\
+    Returns the approximate amount of memory in bytes used by a parser data
+    structure, including all contained objects.
+    """
+    size    = 0
+    pending = [value]
+    seen    = set()
+
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+
+        size += sys.getsizeof(value)
+
+        if isinstance(value, dict):
+            pending.extend(value.keys())
+            pending.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            pending.extend(value)
+
+    return size
+
+# Value validators {{{
+#
+# A validator is a function that takes a submitted parameter value and
+# returns it converted to a Python value of the parameter's datatype.
+# It raises a ValueError with a description of the problem if the value is
+# not valid.
+
+integer_pattern = re.compile(r'^[+-]?[0-9]+$')
+float_pattern   = re.compile(r'^[+-]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?$')
+
+def validate_string(value):
+    if not isinstance(value, string_types):
+        raise ValueError('Expected a string value')
+    if '\n' in value or '\r' in value:
+        # This would break up the parameter definition line in the CNS file.
+        raise ValueError('Value may not contain line breaks')
+    return value
+
+def validate_integer(value):
+    if not isinstance(value, string_types) or integer_pattern.match(value) is None:
+        raise ValueError('Expected an integer value')
+    return int(value)
+
+def validate_float(value):
+    if not isinstance(value, string_types) or float_pattern.match(value) is None:
+        raise ValueError('Expected a numeric value')
+    return float(value)
+
+def choice_validator(component):
+    """\
+    Returns a validator that accepts the options of a choice parameter.
+    The default value is always accepted, even if it is not an option.
+    """
+    options = frozenset(component['options']) | frozenset([component['default']])
+    message = 'Expected one of: ' + ', '.join(component['options'])
+
+    def validate_choice(value):
+        if not isinstance(value, string_types) or value not in options:
+            raise ValueError(message)
+        return value
+
+    return validate_choice
+
+# Maps datatypes to functions that create a validator for a parameter component.
+# Parameters with other datatypes are validated as strings.
+datatype_validators = {
+    'string':  lambda component: validate_string,
+    'file':    lambda component: validate_string,
+    'integer': lambda component: validate_integer,
+    'float':   lambda component: validate_float,
+    'choice':  choice_validator,
+}
+
+def compile_validator(component):
+    """\
+    Returns the validator for a parameter component.
+    """
+    factory = datatype_validators.get(component['datatype'])
+    return factory(component) if factory is not None else validate_string
+
+# }}}
+
+class Template(object):
+    """\
+    The immutable result of parsing a CNS template.
+
+    Templates are shared between all callers of load_template(), so their
+    contents must never be modified.
+
+    - digest:       SHA-1 hex digest of the template contents
+    - lines:        A tuple containing the lines of the template (the line table)
+    - accesslevels: The access levels, as returned by CNSParser.parse()
+    - components:   The component tree, as returned by CNSParser.parse()
+    - table:        A ComponentTable for the component tree
+    - size:         Approximate memory usage in bytes
+
+    The template is compiled into a render program (see cnsrender) and a
+    generated render function (see cnscodegen) when it is first written.
+    The output of write_defaults() is kept with the template, so it is
+    cached per template digest by the TemplateCache.
+
+    With a TemplateStore, the lines and components are shared with other
+    templates that contain the same lines and component subtrees.
+    """
+
+    def __init__(self, digest, lines, accesslevels, components, store=None):
+        self.digest       = digest
+        self.accesslevels = freeze(accesslevels)
+
+        if store is not None:
+            self.lines, self.components = store.share(self, lines, components)
+        else:
+            self.lines      = tuple(lines)
+            self.components = freeze(components)
+
+        self.table = ComponentTable(self.components)
+
+        # Data used by check_values(), indexed by component index.
+        # Instantiated children are the components that have an instance in
+        # form data: sections and parameters that are not hidden.
+        self.accesslevel_names = frozenset(level['name'] for level in self.accesslevels)
+        self.component_levels  = tuple(frozenset(component.get('accesslevels', ())) for component in self.table)
+        self.validators        = tuple(
+            compile_validator(component) if component['type'] == 'parameter' else None
+                for component in self.table
+        )
+        self.instantiated_children = dict(
+            (index, tuple(
+                child for child in self.table.children(index)
+                    if self.table.types[child] != 'paragraph' and not self.table[child]['hidden']
+            ))
+                for index in [None] + [
+                    index for index in range(len(self.table)) if self.table.types[index] == 'section'
+                ]
+        )
+
+        self.size = (
+              estimate_size(self.lines)
+            + estimate_size(self.accesslevels)
+            + estimate_size(self.components)
+        )
+
+        self.program           = None
+        self.generated_program = None
+        self.program_lock      = threading.RLock() # Guards program, generated_program and writes
+        self.defaults          = None
+        self.writes            = 0
+
+    def model(self):
+        """\
+        Returns the (accesslevels, components) pair, like CNSParser.parse().
+        """
+        return self.accesslevels, self.components
+
+    def check_values(self, form_data):
+        """\
+        Checks all parameter values and repetition counts in form_data in a
+        single pass.
+
+        Values of parameters the submitted access level has no access to are
+        not checked, as write() uses their default values.
+
+        Returns a dict that maps instantiated parameter names to their values,
+        converted to the parameter's datatype, and a list of
+        (name, message) pairs describing all problems that were found.
+        Name is the instantiated parameter name or section label, or None for
+        problems with the form data as a whole.
+        """
+        values = dict()
+        errors = []
+
+        level = form_data.get('level')
+        if level not in self.accesslevel_names:
+            errors.append((None, 'Unknown access level "' + str(level) + '"'))
+            return values, errors
+
+        def component_name(index, placeholders):
+            component = self.table[index]
+            return replace_placeholders(
+                component['name'] if component['type'] == 'parameter' else component['label'],
+                placeholders
+            )
+
+        # Stack of [iterator over (component index, instance) pairs, placeholders,
+        # whether the level has access to the section] for the section repetitions we are in.
+        stack = []
+
+        # Number of instances seen per file parameter, uploaded files are keyed by
+        # the local instance index (see write()).
+        file_instance_counts = dict()
+
+        def enter(section, instances, placeholders, has_access):
+            """\
+            Starts checking the instances of a section repetition, or of the root block.
+            """
+            children = self.instantiated_children[section]
+
+            if not isinstance(instances, list) or len(instances) != len(children):
+                errors.append((
+                    component_name(section, placeholders) if section is not None else None,
+                    'Expected ' + str(len(children)) + ' component instances but found '
+                        + (str(len(instances)) if isinstance(instances, list) else 'none')
+                ))
+                return
+
+            stack.append([iter(zip(children, instances)), placeholders, has_access])
+
+        enter(None, form_data.get('instances'), (), True)
+
+        while stack:
+            pairs, placeholders, has_access = stack[-1]
+
+            for index, instance in pairs:
+                if not isinstance(instance, dict) or instance.get('component_index') != index:
+                    errors.append((
+                        component_name(index, placeholders),
+                        'Missing or incorrect instance, expected component index ' + str(index)
+                    ))
+                    # The remaining instances of this section can not be matched to components.
+                    stack.pop()
+                    break
+
+                component   = self.table[index]
+                repetitions = instance.get('repetitions')
+
+                if not isinstance(repetitions, list):
+                    errors.append((component_name(index, placeholders), 'Missing repetitions'))
+                    continue
+
+                if component['repeat']:
+                    if component['repeat_min'] is not None and len(repetitions) < component['repeat_min']:
+                        errors.append((
+                            component_name(index, placeholders),
+                            'At least ' + str(component['repeat_min']) + ' repetitions required'
+                        ))
+                    elif component['repeat_max'] is not None and len(repetitions) > component['repeat_max']:
+                        errors.append((
+                            component_name(index, placeholders),
+                            'At most ' + str(component['repeat_max']) + ' repetitions allowed'
+                        ))
+                elif len(repetitions) != 1:
+                    errors.append((component_name(index, placeholders), 'Exactly one repetition required'))
+
+                component_access = has_access and level in self.component_levels[index]
+
+                is_file = component.get('datatype') == 'file'
+                if is_file:
+                    local_instance_index = file_instance_counts.get(index, 0)
+                    file_instance_counts[index] = local_instance_index + 1
+                    files = form_data.get('files', {}).get(str(index), {}).get(str(local_instance_index), {})
+
+                if component['type'] == 'section':
+                    # Check the section's repetitions first, in order, then continue with this section.
+                    depth = len(stack)
+                    for repetition in range(len(repetitions)):
+                        enter(
+                            index,
+                            repetitions[repetition],
+                            placeholders + ((component['repeat_index'], repetition),) if component['repeat'] else placeholders,
+                            component_access,
+                        )
+                    if len(stack) > depth:
+                        # The stack now holds the last repetition on top, reverse the new frames.
+                        stack[depth:] = reversed(stack[depth:])
+                        break
+                    continue
+
+                if not component_access:
+                    continue
+
+                validate = self.validators[index]
+
+                for repetition, value in enumerate(repetitions):
+                    name = component_name(
+                        index,
+                        placeholders + ((component['repeat_index'], repetition),) if component['repeat'] else placeholders
+                    )
+                    if is_file and str(repetition) in files and not len(value):
+                        # write() requires the name of the uploaded file as the value.
+                        errors.append((name, 'Missing the name of the uploaded file'))
+                        continue
+                    try:
+                        values[name] = validate(value)
+                    except ValueError as e:
+                        errors.append((name, str(e)))
+            else:
+                stack.pop()
+
+        return values, errors
+
+    def compiled(self):
+        """\
+        Returns the render program of this template, compiling it if needed.
+        """
+        with self.program_lock:
+            if self.program is None:
+                self.program = Program(self.lines, self.accesslevels, self.table)
+            return self.program
+
+    def generated(self, bytecode_file=None):
+        """\
+        Returns the render program of this template compiled into a Python
+        render function, see cnscodegen, generating it if needed.
+
+        If bytecode_file is given, the generated code is read from that file
+        if it was generated for this template, and saved to it otherwise.
+        """
+        with self.program_lock:
+            # Threads that need the function while it is generated wait for it.
+            if self.generated_program is None:
+                code = load_bytecode(bytecode_file, self.digest) if bytecode_file is not None else None
+                if code is None:
+                    code = generate_code(self.compiled(), self.digest)
+                    if bytecode_file is not None:
+                        save_bytecode(bytecode_file, self.digest, code)
+                self.generated_program = GeneratedProgram(code)
+            return self.generated_program
+
+    def write(self, form_data, aux_file_root, **kwargs):
+        """\
+        Renders a CNS file based on this template, see CNSParser.write().
+
+        Form data can be given in the columnar format as well, see
+        cnscolumnar.
+
+        The file is rendered by the render program of the template, or by
+        its generated render function once that is available, see
+        generate_after. Form data that they do not handle, including form
+        data with errors, is rendered by CNSParser.write() instead, as is
+        every call with keyword arguments. Keyword arguments are passed to
+        the CNSParser constructor.
+        """
+        if not len(kwargs):
+            with self.program_lock:
+                self.writes += 1
+                program = self.generated_program
+                # Only the write that reaches the threshold generates the
+                # function, concurrent writes use the render program meanwhile.
+                generate = program is None and self.writes == generate_after
+            if generate:
+                program = self.generated()
+            try:
+                if program is not None:
+                    return program.render(form_data)
+                if is_columnar(form_data):
+                    form_data = from_columnar(self.table, form_data)
+                return self.compiled().render(form_data)
+            except Fallback:
+                pass
+        if is_columnar(form_data):
+            # CNSParser.write() only reads form data in the tree format.
+            form_data = from_columnar(self.table, form_data)
+        return CNSParser(source=list(self.lines), **kwargs).write(form_data, aux_file_root)
+
+    def rewrite(self, cns, previous_form_data, form_data, aux_file_root):
+        """\
+        Updates a CNS file that write() generated for previous_form_data so
+        that it matches form_data, see CNSParser.rewrite().
+
+        Only the instances that differ between the form datas are compared,
+        and only the lines of parameters whose values changed are rendered
+        again, see Program.changes(). The file is written by write() instead
+        when the form data differ in structure (instances, repetition counts
+        or access level), contain uploaded files, or when cns was not
+        generated from previous_form_data.
+
+        Returns the new CNS file, a map for renaming auxiliary files and a
+        list of the names of all parameter instances whose values changed.
+        """
+        if is_columnar(form_data):
+            form_data = from_columnar(self.table, form_data)
+        if is_columnar(previous_form_data):
+            previous_form_data = from_columnar(self.table, previous_form_data)
+
+        program = self.compiled()
+
+        try:
+            if program.multiline:
+                raise Fallback()
+            changes = program.changes(previous_form_data, form_data)
+        except Fallback:
+            return self.rewrite_all(previous_form_data, form_data, aux_file_root)
+
+        substitute_parameter_value = program.parser.substitute_parameter_value
+        substitute_parameter_name  = program.parser.substitute_parameter_name
+
+        def render(name, component_index, value):
+            line = program.parameter_lines[component_index]
+            return substitute_parameter_name(substitute_parameter_value(line, value), lambda template_name: name)
+
+        # Changes are in output order, so lines are searched for from the
+        # previous change onwards.
+        cns     = list(cns)
+        line_no = -1
+        for name, component_index, previous_value, value in changes:
+            try:
+                line_no = cns.index(render(name, component_index, previous_value), line_no + 1)
+            except ValueError:
+                # This CNS file was not generated from previous_form_data.
+                return self.rewrite_all(previous_form_data, form_data, aux_file_root)
+            cns[line_no] = render(name, component_index, value)
+
+        return cns, {}, [change[0] for change in changes]
+
+    def rewrite_all(self, previous_form_data, form_data, aux_file_root):
+        """\
+        Writes the CNS file for form_data for rewrite(). Changed parameters
+        are found by resolving the values of both form datas.
+        """
+        program = self.compiled()
+
+        try:
+            values = program.resolve(form_data)
+        except Fallback:
+            # Let write() report what is wrong with the form data.
+            values = []
+        try:
+            previous_values = program.resolve(previous_form_data)
+        except Fallback:
+            previous_values = []
+
+        names           = frozenset(entry[0] for entry in values)
+        previous_lookup = dict((entry[0], entry[2]) for entry in previous_values)
+        changed = [
+            name for name, index, value, submitted in values
+                if previous_lookup.get(name) != value
+        ] + [
+            name for name, index, value, submitted in previous_values
+                if name not in names
+        ]
+
+        cns, aux_file_map = self.write(form_data, aux_file_root)
+        return cns, aux_file_map, changed
+
+    def write_defaults(self):
+        """\
+        Renders a CNS file with all parameters at their default values,
+        without form data. Repeatable sections and parameters get their
+        minimum amount of repetitions, repeat_min. The output is the same as
+        that of write() with such form data and an access level that has no
+        access to any component.
+
+        Returns the CNS file as a list of lines. The output is rendered once
+        per template.
+        """
+        if self.defaults is None:
+            program = self.compiled()
+            try:
+                cns = program.render_defaults()
+            except Fallback:
+                form_data = {'level': None, 'instances': program.default_instances(program.root.ops), 'files': {}}
+                cns, file_map = CNSParser(source=list(self.lines)).write(form_data, None)
+            self.defaults = tuple(cns)
+        return list(self.defaults)
+
+    def resolve(self, form_data):
+        """\
+        Returns the values of all parameters as write() would write them, as
+        a dict that maps instantiated parameter names (such as prot_coor_1)
+        to values converted to the parameter's datatype. No text is
+        rendered, see resolve_items() for the values in template order.
+
+        Parameters the submitted access level has no access to get their
+        default values, hidden parameters keep their template values. These
+        are kept as strings if they are not valid for the datatype.
+        File parameters with an uploaded file get the name it is renamed to.
+
+        Form data can be given in the columnar format as well.
+        Raises a ValueError for the first problem in the form data, like
+        check_values() reports it.
+        """
+        return dict(self.resolve_items(form_data))
+
+    def resolve_items(self, form_data):
+        """\
+        Returns the (name, value) pairs of all parameters in the order of
+        the rendered CNS file, see resolve().
+        """
+        if is_columnar(form_data):
+            form_data = from_columnar(self.table, form_data)
+
+        level = form_data.get('level')
+        if level not in self.accesslevel_names:
+            raise ValueError('Unknown access level "' + str(level) + '"')
+
+        try:
+            entries = self.compiled().resolve(form_data)
+        except Fallback:
+            values, errors = self.check_values(form_data)
+            name, message = errors[0] if len(errors) else (None, 'Invalid form data')
+            raise ValueError(message if name is None else name + ': ' + message)
+
+        items      = []
+        validators = self.validators
+        for name, index, value, submitted in entries:
+            try:
+                value = validators[index](value)
+            except ValueError as e:
+                if submitted:
+                    raise ValueError(name + ': ' + str(e))
+            items.append((name, value))
+        return items
+
+class TemplateStore(object):
+    """\
+    Shares identical lines and component subtrees between templates, such
+    as variants of the same template. The memory used by the templates
+    then grows with the amount of distinct content, not with the amount of
+    templates.
+
+    Components are identified by a digest of their contents, which includes
+    their inherited access levels, hidden state and children. A component
+    is only shared if none of the components in its subtree is in the same
+    template already, so every component dict occurs once per template (see
+    ComponentTable.index_of()).
+
+    Shared components, lines and attribute values are kept as long as a
+    template uses them. Lines and attribute values are counted per template,
+    and are released the next time the store is used after the last
+    template that uses them was garbage collected.
+    The store can be shared by multiple threads.
+    """
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.components = weakref.WeakValueDictionary() # Digest => frozen component
+        self.values     = dict()                        # (type, value) => [value, template count]
+        self.owners     = set()                         # TemplateReferences of the templates using the store
+        self.released   = []                            # TemplateReferences of collected templates
+
+        self.templates         = 0
+        self.lines             = 0
+        self.shared_lines      = 0
+        self.component_count   = 0
+        self.shared_components = 0
+        self.template_bytes    = 0
+
+    def share(self, template, lines, components):
+        """\
+        Returns the line table and the frozen component tree of a template,
+        see freeze(), reusing the lines and subtrees of earlier templates.
+        The lines and values are kept until the template is garbage collected.
+        """
+        with self.lock:
+            self.purge()
+
+            # Id => entry of self.values, for every line and value the template uses.
+            entries = dict()
+
+            shared_lines = tuple(self.share_value(line, entries) for line in lines)
+            self.shared_lines += sum(1 for line, shared in zip(lines, shared_lines) if line is not shared)
+
+            digests = dict()
+            for component in components:
+                self.digest(component, digests)
+
+            used = set()
+            shared_components = tuple(
+                self.share_component(component, digests, used, entries) for component in components
+            )
+
+            for entry in entries.values():
+                entry[1] += 1
+
+            # The reference must be kept for its callback to be called, see release().
+            reference = TemplateReference(template, self.release)
+            reference.entries = list(entries.values())
+            self.owners.add(reference)
+
+            self.templates       += 1
+            self.lines           += len(lines)
+            self.component_count += len(used)
+            self.template_bytes  += estimate_size(shared_lines) + estimate_size(shared_components)
+
+            return shared_lines, shared_components
+
+    def share_value(self, value, entries):
+        """\
+        Returns the stored copy of a line or a frozen attribute value, and
+        adds its entry to entries.
+        """
+        value = freeze(value)
+        # Keyed on the type as well, True == 1 but they are not the same value.
+        entry = self.values.setdefault((type(value), value), [value, 0])
+        entries[id(entry)] = entry
+        return entry[0]
+
+    def release(self, reference):
+        """\
+        Called when a template that uses the store is garbage collected.
+        This can happen in any thread, also while the lock is held, so the
+        reference is only queued for purge().
+        """
+        self.released.append(reference)
+
+    def purge(self):
+        """\
+        Forgets the lines and values that are no longer used by any template.
+        Must be called with the lock held.
+        """
+        while self.released:
+            reference = self.released.pop()
+            self.owners.discard(reference)
+            for entry in reference.entries:
+                entry[1] -= 1
+                if not entry[1]:
+                    key = (type(entry[0]), entry[0])
+                    # The entry may have been replaced after clear().
+                    if self.values.get(key) is entry:
+                        del self.values[key]
+
+    def digest(self, component, digests):
+        """\
+        Calculates the digests of a component and its descendants, and saves
+        them in digests by the ids of the component dicts.
+        """
+        contents = dict(component)
+        if 'children' in contents:
+            contents['children'] = [self.digest(child, digests) for child in component['children']]
+
+        digest = hashlib.sha1(json.dumps(contents, sort_keys=True).encode('utf-8')).hexdigest()
+        digests[id(component)] = digest
+        return digest
+
+    def share_component(self, component, digests, used, entries):
+        """\
+        Returns the frozen copy of a component. The ids of all components in
+        the returned subtree are added to used, and the entries of their
+        values to entries.
+        """
+        digest = digests[id(component)]
+        shared = self.components.get(digest)
+        if shared is not None:
+            subtree = list(iter_subtree(shared))
+            if not any(id(descendant) in used for descendant in subtree):
+                used.update(id(descendant) for descendant in subtree)
+                self.shared_components += len(subtree)
+                # Count the values for this template too, they are already frozen.
+                for descendant in subtree:
+                    for key, item in descendant.items():
+                        if key != 'children':
+                            self.share_value(item, entries)
+                return shared
+
+        frozen = FrozenDict(
+            (key, tuple(self.share_component(child, digests, used, entries) for child in item)
+                if key == 'children' else self.share_value(item, entries))
+                    for key, item in component.items()
+        )
+        used.add(id(frozen))
+        if shared is None:
+            self.components[digest] = frozen
+        return frozen
+
+    def clear(self):
+        """\
+        Forgets all stored lines, values and components. Templates that
+        were created already keep sharing theirs. Statistics are kept.
+        """
+        with self.lock:
+            self.purge()
+            self.components.clear()
+            self.values.clear()
+
+    def stats(self):
+        """\
+        Returns a dictionary with sharing statistics:
+
+        - templates:         The amount of templates that were stored
+        - lines:             Their total amount of lines
+        - shared_lines:      The amount of those lines that were shared
+        - components:        Their total amount of components
+        - shared_components: The amount of those components that were shared
+        - template_bytes:    Their total approximate size in bytes, as if
+                             nothing was shared
+        - bytes:             The approximate size in bytes of the distinct
+                             content that is stored now
+        - values:            The amount of distinct lines and attribute
+                             values that are stored now
+        """
+        with self.lock:
+            self.purge()
+            return {
+                'templates':         self.templates,
+                'lines':             self.lines,
+                'shared_lines':      self.shared_lines,
+                'components':        self.component_count,
+                'shared_components': self.shared_components,
+                'template_bytes':    self.template_bytes,
+                'bytes':             estimate_size([
+                                         [entry[0] for entry in self.values.values()], list(self.components.values())
+                                     ]),
+                'values':            len(self.values),
+            }
+
+class TemplateReference(weakref.ref):
+    """\
+    A weak reference to a template that uses a TemplateStore, with the
+    entries of the store's values that the template uses.
+    """
+
+    __slots__ = ('entries',)
+
+def iter_subtree(component):
+    """\
+    Iterates over a component and all its descendants.
+    """
+    pending = [component]
+    while pending:
+        component = pending.pop()
+        yield component
+        pending.extend(component.get('children', ()))
+
+def read_template_source(source):
+    """\
+    Returns the contents of a template, which can be given as a path, as a
+    file object or as the template contents itself.
+
+    Template contents are recognized by the presence of a newline: CNS
+    templates always consist of multiple lines, while file names never
+    contain newlines.
+    """
+    if hasattr(source, 'read'):
+        return source.read()
+
+    if isinstance(source, (bytes, bytearray)) and b'\n' in source:
+        return bytes(source)
+
+    if not isinstance(source, bytes) and '\n' in source:
+        return source
+
+    with open(source, 'rb') as fp:
+        return fp.read()
+
+# Default of TemplateCache.configure() for limits that are left unchanged,
+# as None disables a limit.
+_unchanged = object()
+
+class TemplateCache(object):
+    """\
+    A thread-safe LRU cache of parsed templates, keyed on the SHA-1 digest of
+    the template contents.
+
+    The cache is bounded both by the amount of templates (max_entries) and by
+    their approximate total size in bytes (max_bytes). Either limit can be
+    set to None to disable it. The most recently used template is always
+    kept, even if it is larger than max_bytes by itself.
+
+    When multiple threads request the same uncached template at the same
+    time, only the first one parses it. The others wait for its result.
+
+    With a TemplateStore, parsed templates share their identical lines and
+    sections. Template sizes are counted as if nothing was shared.
+    """
+
+    def __init__(self, max_entries=32, max_bytes=64 << 20, parser_class=CNSParser, store=None):
+        self.max_entries    = max_entries
+        self.max_bytes      = max_bytes
+        self.parser_class   = parser_class
+        self.template_store = store
+
+        self.lock      = threading.Lock()
+        self.templates = collections.OrderedDict() # Digest => Template, least recently used first
+        self.loading   = dict()                    # Digest => (Event, result list) for templates being parsed
+        self.size      = 0
+
+        self.hits      = 0
+        self.misses    = 0
+        self.waits     = 0 # Requests that waited for another thread to parse the template
+        self.evictions = 0
+
+    def parse(self, digest, contents):
+        """\
+        Parses template contents into a Template object.
+        """
+        if not isinstance(contents, str):
+            # Byte strings on Python 3.
+            contents = contents.decode('utf-8')
+
+        lines = contents.splitlines(True)
+        accesslevels, components = self.parser_class(source=iter(lines)).parse()
+
+        return Template(digest, lines, accesslevels, components, self.template_store)
+
+    def load(self, source):
+        """\
+        Returns the Template for the given path, file object or template
+        contents, parsing it only if it is not in the cache.
+        ParserExceptions are raised in every thread that requested the template.
+        """
+        contents = read_template_source(source)
+        digest   = hashlib.sha1(
+            contents if isinstance(contents, bytes) else contents.encode('utf-8')
+        ).hexdigest()
+
+        with self.lock:
+            template = self.templates.get(digest)
+            if template is not None:
+                self.hits += 1
+                del self.templates[digest]
+                self.templates[digest] = template
+                return template
+
+            if digest in self.loading:
+                self.waits += 1
+                event, result = self.loading[digest]
+                owner = False
+            else:
+                self.misses += 1
+                event, result = threading.Event(), []
+                self.loading[digest] = (event, result)
+                owner = True
+
+        if not owner:
+            event.wait()
+            template, exception = result
+            if exception is not None:
+                raise exception
+            return template
+
+        template, exception = None, None
+        try:
+            template = self.parse(digest, contents)
+        except Exception as e:
+            exception = e
+            raise
+        finally:
+            with self.lock:
+                del self.loading[digest]
+                if template is not None:
+                    self.store(template)
+            result[:] = [template, exception]
+            event.set()
+
+        return template
+
+    def store(self, template):
+        """\
+        Adds a template to the cache and evicts templates that exceed the
+        limits. Must be called with the lock held.
+        """
+        self.templates[template.digest] = template
+        self.size += template.size
+        self.evict()
+
+    def evict(self):
+        """\
+        Removes least recently used templates until the cache is within its
+        limits. Must be called with the lock held.
+        """
+        while len(self.templates) > 1 and (
+                   (self.max_entries is not None and len(self.templates) > self.max_entries)
+                or (self.max_bytes   is not None and self.size > self.max_bytes)
+            ):
+            digest, template = self.templates.popitem(last=False)
+            self.size -= template.size
+            self.evictions += 1
+
+    def configure(self, max_entries=_unchanged, max_bytes=_unchanged):
+        """\
+        Changes the cache limits, evicting templates if necessary.
+        Limits that are not given are left unchanged, None disables a limit.
+        """
+        with self.lock:
+            if max_entries is not _unchanged:
+                self.max_entries = max_entries
+            if max_bytes is not _unchanged:
+                self.max_bytes = max_bytes
+            self.evict()
+
+    def clear(self):
+        """\
+        Removes all templates from the cache. Statistics are kept.
+        """
+        with self.lock:
+            self.templates.clear()
+            self.size = 0
+
+    def stats(self):
+        """\
+        Returns a dictionary with cache statistics.
+        """
+        with self.lock:
+            return {
+                'entries':     len(self.templates),
+                'bytes':       self.size,
+                'max_entries': self.max_entries,
+                'max_bytes':   self.max_bytes,
+                'hits':        self.hits,
+                'misses':      self.misses,
+                'waits':       self.waits,
+                'evictions':   self.evictions,
+                'store':       self.template_store.stats() if self.template_store is not None else None,
+            }
+
+# The cache used by load_template().
+template_cache = TemplateCache()
+
+def load_template(source):
+    """\
+    Returns a shared, immutable Template for a CNS template, given as a path,
+    a file object or the template contents itself.
+    Parse results are cached in template_cache, see TemplateCache.
+    """
+    return template_cache.load(source)
+
+def write_template_file(path, form_data, aux_file_root, cache_dir=None):
+    """\
+    Renders a CNS file based on a template file, like Template.write(),
+    using the bytecode file of the template in the bytecode cache directory
+    cache_dir, if given, see TemplateFile.
+    """
+    return TemplateFile(path, cache_dir).write(form_data, aux_file_root)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import argparse
+import json
+import os
+
+from cnsparser import CNSParser
+
+parser = argparse.ArgumentParser(
+    description='Reconstruct form data from CNS files generated by jsontocns.py',
+    epilog=
+        'The template is parsed only once, so many CNS files can be converted '
+        'in a single run. Unless an output file is given, form data is saved '
+        'as formdata.json in the directory of each CNS file.'
+)
+
+parser.add_argument(
+    '-V', '--version',
+    action  = 'version',
+    version = '%(prog)s 0.1'
+)
+parser.add_argument(
+    '-v', '--verbose',
+    dest    = 'verbose',
+    action  = 'store_true',
+    default = False,
+    help    = 'print parsing information to stderr'
+)
+parser.add_argument(
+    '-w', '--warnings',
+    dest    = 'warnings',
+    action  = 'store_true',
+    default = False,
+    help    = 'show warnings for unrecognized input data and missing parameters'
+)
+parser.add_argument(
+    '-W', '--fatal-warnings',
+    dest    = 'fatal_warnings',
+    action  = 'store_true',
+    default = False,
+    help    = 'make unrecognized input data throw a fatal error, implicitly sets -w'
+)
+parser.add_argument(
+    '-t', '--template', metavar='TEMPLATE',
+    dest     = 'template',
+    type     = argparse.FileType('r'),
+    required = True,
+    help     = 'the CNS template file the CNS files were generated from'
+)
+parser.add_argument(
+    '-l', '--level', metavar='LEVEL',
+    dest    = 'level',
+    default = None,
+    help    = 'the access level to save in the form data, defaults to the last access level'
+)
+parser.add_argument(
+    '-o', '--output', metavar='FORM_DATA',
+    dest    = 'output',
+    type    = argparse.FileType('w'),
+    default = None,
+    help    = 'the form data output file, only allowed with a single CNS file'
+)
+parser.add_argument(
+    'sources', metavar='CNS_FILE',
+    nargs   = '+',
+    help    = 'the generated CNS files to read'
+)
+
+args = parser.parse_args()
+
+if args.output is not None and len(args.sources) > 1:
+    parser.error('an output file can only be given for a single CNS file')
+
+# The template is read into a list, as extract_form_data() reads it again after parse().
+parser = CNSParser(
+    source         = args.template.readlines(),
+    verbose        = args.verbose,
+    warnings       = args.warnings,
+    fatal_warnings = args.fatal_warnings,
+)
+
+model = parser.parse()
+
+if args.level is not None and args.level not in [level['name'] for level in model[0]]:
+    print('Unknown access level "' + args.level + '"', file=sys.stderr)
+    sys.exit(1)
+
+for source in args.sources:
+    with open(source) as rendered:
+        form_data, missing = parser.extract_form_data(rendered, level=args.level)
+
+    if len(missing) and args.warnings:
+        print(source + ': Parameters not found, using defaults: ' + ', '.join(missing), file=sys.stderr)
+        if args.fatal_warnings:
+            sys.exit(1)
+
+    if args.output is not None:
+        output = args.output
+    else:
+        output = open(os.path.join(os.path.dirname(source), 'formdata.json'), 'w')
+
+    with output:
+        json.dump(form_data, output)
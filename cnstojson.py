@@ -3,102 +3,199 @@
 from __future__ import print_function
 import sys
 import argparse
-import json
+import os
 
 from cnsparser import CNSParser
+from cnsmodel import ComponentTable, dump_json, dump_binary
+from cnsdiagnostics import Diagnostics
+from cnstelemetry import Telemetry, file_size
 
-parser = argparse.ArgumentParser(
-    description='Convert a run.cns file to a JSON model description',
-    epilog=
-        'If both output files have the same filename or both point to stdout, '
-        'the access levels and model information will be printed as a nested '
-        'array, access levels first.\n'
-
-        'Any additional arguments not listed here will be passed to the '
-        'CNSParser constructor.'
-)
-
-parser.add_argument(
-    '-V', '--version',
-    action  = 'version',
-    version = '%(prog)s 0.1'
-)
-parser.add_argument(
-    '-v', '--verbose',
-    dest    = 'verbose',
-    action  = 'store_true',
-    default = False,
-    help    = 'print parsing information to stderr'
-)
-parser.add_argument(
-    '-w', '--warnings',
-    dest    = 'warnings',
-    action  = 'store_true',
-    default = False,
-    help    = 'show warnings for unrecognized input data'
-)
-parser.add_argument(
-    '-W', '--fatal-warnings',
-    dest    = 'fatal_warnings',
-    action  = 'store_true',
-    default = False,
-    help    = 'make unrecognized input data throw a fatal error, implicitly sets -w'
-)
-parser.add_argument(
-    '-t', '--tidy',
-    dest    = 'tidy',
-    action  = 'store_true',
-    default = False,
-    help    = 'use pretty-printed JSON output'
-)
-parser.add_argument(
-    'source', metavar='INPUT',
-    type    = argparse.FileType('r'),
-    default = sys.stdin,
-    nargs   = '?',
-    help    = 'the run.cns file to parse, defaults to \'-\' for stdin'
-)
-parser.add_argument(
-    '-o', '--model-output', metavar='OUTPUT',
-    dest    = 'model_output',
-    type    = argparse.FileType('w'),
-    default = sys.stdout,
-    help    = 'the model JSON file, defaults to \'-\' for stdout'
-)
-parser.add_argument(
-    '-l', '--accesslevel-output', metavar='OUTPUT',
-    dest    = 'accesslevel_output',
-    type    = argparse.FileType('w'),
-    default = sys.stdout,
-    help    = 'the access level JSON file, defaults to \'-\' for stdout'
-)
-
-args = parser.parse_args()
-
-# Pass arguments as an unpacked dictionary to the CNSParser constructor
-parser = CNSParser(**dict(
-    (key, value) for (key, value) in vars(args).iteritems()
-        # Filter out arguments used only by this program
-        if key not in set(['model_output', 'accesslevel_output', 'tidy'])
-))
-
-accesslevels, components = parser.parse()
-
-if args.accesslevel_output.name == args.model_output.name:
-    print(json.dumps(
-        [accesslevels, components],
-        sort_keys=args.tidy,
-        indent=(4 if args.tidy else None),
-    ), file=args.accesslevel_output)
-else:
-    print(json.dumps(
-        accesslevels,
-        sort_keys=args.tidy,
-        indent=(4 if args.tidy else None),
-    ), file=args.accesslevel_output)
-
-    print(json.dumps(
-        components,
-        sort_keys=args.tidy,
-        indent=(4 if args.tidy else None),
-    ), file=args.model_output)
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Convert a run.cns file to a JSON model description',
+        epilog=
+            'If both output files have the same filename or both point to stdout, '
+            'the access levels and model information will be printed as a nested '
+            'array, access levels first.\n'
+
+            'Any additional arguments not listed here will be passed to the '
+            'CNSParser constructor.'
+    )
+
+    parser.add_argument(
+        '-V', '--version',
+        action  = 'version',
+        version = '%(prog)s 0.1'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        dest    = 'verbose',
+        action  = 'store_true',
+        default = False,
+        help    = 'print parsing information to stderr'
+    )
+    parser.add_argument(
+        '-w', '--warnings',
+        dest    = 'warnings',
+        action  = 'store_true',
+        default = False,
+        help    = 'show warnings for unrecognized input data'
+    )
+    parser.add_argument(
+        '-W', '--fatal-warnings',
+        dest    = 'fatal_warnings',
+        action  = 'store_true',
+        default = False,
+        help    = 'make unrecognized input data throw a fatal error, implicitly sets -w'
+    )
+    parser.add_argument(
+        '--warning-limit', metavar='LIMIT',
+        dest    = 'warning_limit',
+        type    = int,
+        default = 10,
+        help    = 'show at most LIMIT different warnings of each kind, defaults to 10; '
+                  'repeated warnings are shown once'
+    )
+    parser.add_argument(
+        '--diagnostics-file', metavar='DIAGNOSTICS',
+        dest    = 'diagnostics_file',
+        default = None,
+        help    = 'save the warnings as JSON to DIAGNOSTICS, they are only shown if -w is set'
+    )
+    style_group = parser.add_mutually_exclusive_group()
+    style_group.add_argument(
+        '-t', '--tidy',
+        dest    = 'tidy',
+        action  = 'store_true',
+        default = False,
+        help    = 'use pretty-printed JSON output'
+    )
+    style_group.add_argument(
+        '-c', '--compact',
+        dest    = 'compact',
+        action  = 'store_true',
+        default = False,
+        help    = 'use JSON output without any optional whitespace'
+    )
+    parser.add_argument(
+        '--multiline-blocks',
+        dest    = 'multiline_blocks',
+        action  = 'store_true',
+        default = False,
+        help    = 'read brace blocks that span multiple lines as a single line; this changes the component '
+                  'indices of templates with such blocks, so form data must be written with the same setting'
+    )
+    parser.add_argument(
+        '-b', '--binary',
+        dest    = 'binary',
+        action  = 'store_true',
+        default = False,
+        help    = 'write the model in the binary model format, which includes the access levels; '
+                  'the access level JSON file is then only written if -l is given'
+    )
+    parser.add_argument(
+        '-T', '--telemetry',
+        dest    = 'telemetry',
+        action  = 'store_true',
+        default = False,
+        help    = 'write a JSON record with timings and counts of this conversion to telemetry.json '
+                  'in the directory of INPUT'
+    )
+    parser.add_argument(
+        '--telemetry-file', metavar='TELEMETRY',
+        dest    = 'telemetry_file',
+        default = None,
+        help    = 'the telemetry output file, implicitly sets -T'
+    )
+    parser.add_argument(
+        'source', metavar='INPUT',
+        type    = argparse.FileType('r'),
+        default = sys.stdin,
+        nargs   = '?',
+        help    = 'the run.cns file to parse, defaults to \'-\' for stdin'
+    )
+    parser.add_argument(
+        '-o', '--model-output', metavar='OUTPUT',
+        dest    = 'model_output',
+        type    = argparse.FileType('w'),
+        default = sys.stdout,
+        help    = 'the model JSON file, defaults to \'-\' for stdout'
+    )
+    parser.add_argument(
+        '-l', '--accesslevel-output', metavar='OUTPUT',
+        dest    = 'accesslevel_output',
+        type    = argparse.FileType('w'),
+        default = None,
+        help    = 'the access level JSON file, defaults to \'-\' for stdout unless -b is given'
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.accesslevel_output is None and not args.binary:
+        args.accesslevel_output = sys.stdout
+
+    telemetry   = Telemetry('cnstojson')
+    source_name = args.source.name
+    telemetry.set(template=source_name)
+
+    with telemetry.stage('read'):
+        args.source = list(args.source)
+
+    diagnostics = Diagnostics(
+        limit  = args.warning_limit,
+        stream = sys.stderr if args.warnings or args.fatal_warnings else None,
+    )
+
+    # Pass arguments as an unpacked dictionary to the CNSParser constructor
+    parser = CNSParser(diagnostics=diagnostics, **dict(
+        (key, value) for (key, value) in vars(args).iteritems()
+            # Filter out arguments used only by this program
+            if key not in set([
+                'model_output', 'accesslevel_output', 'tidy', 'compact', 'binary', 'telemetry', 'telemetry_file',
+                'warning_limit', 'diagnostics_file',
+            ])
+    ))
+    if args.diagnostics_file is not None:
+        parser.warnings = True
+
+    with telemetry.stage('parse'):
+        accesslevels, components = parser.parse()
+
+    if args.diagnostics_file is not None:
+        diagnostics.save(args.diagnostics_file)
+
+    style = 'tidy' if args.tidy else 'compact' if args.compact else 'default'
+
+    with telemetry.stage('finalise'):
+        if args.binary:
+            # Python 3 text files: Write to the underlying binary file.
+            dump_binary(accesslevels, components, getattr(args.model_output, 'buffer', args.model_output))
+
+            # The binary model includes the access levels, they are only
+            # written as JSON to a separate file given with -l.
+            if args.accesslevel_output is not None and args.accesslevel_output.name != args.model_output.name:
+                dump_json(accesslevels, args.accesslevel_output, style)
+        elif args.accesslevel_output.name == args.model_output.name:
+            dump_json([accesslevels, components], args.accesslevel_output, style)
+        else:
+            dump_json(accesslevels, args.accesslevel_output, style)
+            dump_json(components,   args.model_output,       style)
+
+    if args.telemetry or args.telemetry_file is not None:
+        types = ComponentTable(components).types
+        telemetry.set(
+            template_lines = len(args.source),
+            sections       = types.count('section'),
+            parameters     = types.count('parameter'),
+            output_bytes   = file_size(*[fp for fp in (args.model_output, args.accesslevel_output) if fp is not None]),
+            line_memo      = parser.stats()['line_memo'],
+        )
+        if args.telemetry_file is not None:
+            telemetry.save(args.telemetry_file)
+        else:
+            # Stdin is named '<stdin>', its telemetry is saved in the current directory.
+            telemetry.save(os.path.join(os.path.dirname(source_name), 'telemetry.json'))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import argparse
+import json
+
+from cnscolumnar import from_columnar, is_columnar, to_columnar
+from cnstemplate import load_template
+
+parser = argparse.ArgumentParser(
+    description='Convert form data between the tree and the columnar format',
+    epilog=
+        'Form data in the tree format is converted to the columnar format, '
+        'and columnar form data is converted back to the tree format. '
+        'Both formats are accepted by jsontocns.py.'
+)
+
+parser.add_argument(
+    '-V', '--version',
+    action  = 'version',
+    version = '%(prog)s 0.1'
+)
+parser.add_argument(
+    '-t', '--template', metavar='TEMPLATE',
+    dest     = 'template',
+    type     = argparse.FileType('r'),
+    required = True,
+    help     = 'the CNS template file the form data belongs to'
+)
+parser.add_argument(
+    '-o', '--output', metavar='OUTPUT',
+    dest    = 'output',
+    type    = argparse.FileType('w'),
+    default = sys.stdout,
+    help    = 'the output file, defaults to stdout'
+)
+parser.add_argument(
+    'form_data', metavar='FORM_DATA',
+    type    = argparse.FileType('r'),
+    help    = 'the form data file to convert'
+)
+
+args = parser.parse_args()
+
+table = load_template(args.template).table
+data  = json.load(args.form_data)
+
+try:
+    if is_columnar(data):
+        data = from_columnar(table, data)
+    else:
+        data = to_columnar(table, data)
+except ValueError as e:
+    print(str(e), file=sys.stderr)
+    sys.exit(1)
+
+json.dump(data, args.output)
+args.output.write('\n')
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import argparse
+
+from cnsmodel import dump_json, load_model
+from cnsmodeldiff import diff_models
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Compare two versions of a CNS model',
+        epilog=
+            'Sections and parameters are matched by the labels of their sections '
+            'and their own label or name. Removed, added and moved components are '
+            'listed, as well as changes of their datatype, default value, access '
+            'levels, hidden flag and repetition, and how the component indices of '
+            'form data shift. The exit status is 1 if the models differ.'
+    )
+
+    parser.add_argument(
+        '-V', '--version',
+        action  = 'version',
+        version = '%(prog)s 0.1'
+    )
+    parser.add_argument(
+        '-j', '--json',
+        dest    = 'json',
+        action  = 'store_true',
+        default = False,
+        help    = 'print the differences as a JSON object'
+    )
+    parser.add_argument(
+        'old', metavar='OLD',
+        type    = argparse.FileType('r'),
+        help    = 'the JSON or binary model of the old template'
+    )
+    parser.add_argument(
+        'new', metavar='NEW',
+        type    = argparse.FileType('r'),
+        help    = 'the JSON or binary model of the new template'
+    )
+
+    args = parser.parse_args(argv)
+
+    old_accesslevels, old_components = load_model(args.old)
+    new_accesslevels, new_components = load_model(args.new)
+
+    diff = diff_models(old_components, new_components, old_accesslevels, new_accesslevels)
+
+    if args.json:
+        dump_json(diff.to_dict(), sys.stdout, 'tidy')
+    else:
+        for line in diff.format():
+            print(line)
+
+    return 0 if diff.is_empty() else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,40 +2,40 @@
 
 from __future__ import print_function
 import argparse
-import json
+import re
 import sys
 
+from cnsmodel import iter_model
 
-# component_index_static being an array is a hack to get function-static variables in python.
-def dump(component, depth=0, verbose=False, component_index_static=[0]):
+
+def format_component(component, component_index, depth=0, verbose=False):
     """\
-    Dump a component and its children if its a section.
+    Returns the dump of a single component as a string.
     """
     def indent(depth, string=''):
         return ('|' + ' '*2)*depth + string
 
     if component['type'] == 'parameter':
-        print(indent(depth) + '#' + str(component_index_static[0]) + ' ', end='')
+        text = indent(depth) + '#' + str(component_index) + ' '
         if component['datatype'] == 'choice':
-            print('(' + component['datatype'] + '<' + ','.join(component['options']) + '>) ', end='')
+            text += '(' + component['datatype'] + '<' + ','.join(component['options']) + '>) '
         else:
-            print('(' + component['datatype'] + ') ', end='')
-        print(component['name'] + ' = "' + component['default'] + '"', end='')
+            text += '(' + component['datatype'] + ') '
+        text += component['name'] + ' = "' + component['default'] + '"'
     elif component['type'] == 'section':
-        header_text = '#' + str(component_index_static[0]) + ' ' + component['label']
-        print(indent(depth))
-        print(indent(depth, header_text))
-        print(indent(depth, ('=' if depth == 0 else '-')*len(header_text)), end='')
+        header_text = '#' + str(component_index) + ' ' + component['label']
+        text = (
+              indent(depth) + '\n'
+            + indent(depth, header_text) + '\n'
+            + indent(depth, ('=' if depth == 0 else '-')*len(header_text))
+        )
     elif component['type'] == 'paragraph':
-        print(indent(depth))
-        lines = component['text'].split('\n')
-        for line in lines:
-            print(indent(depth, line))
-        print(indent(depth))
-        component_index_static[0] += 1
-        return
+        text = indent(depth) + '\n'
+        for line in component['text'].split('\n'):
+            text += indent(depth, line) + '\n'
+        return text + indent(depth) + '\n'
     else:
-        return
+        return ''
 
     if 'repeat' in component and component['repeat']:
         if component['repeat_min'] == component['repeat_max']:
@@ -44,40 +44,273 @@ def dump(component, depth=0, verbose=False, component_index_static=[0]):
             repeat_string = 'x ' + str(component['repeat_min']) + '+'
         else:
             repeat_string = 'x ' + str(component['repeat_min']) + '-' + str(component['repeat_max'])
-        print(' ' + repeat_string, end='')
+        text += ' ' + repeat_string
 
     if verbose and 'accesslevels' in component and len(component['accesslevels']):
-        print(' [' + ', '.join(sorted(component['accesslevels'])) + ']', end='')
+        text += ' [' + ', '.join(sorted(component['accesslevels'])) + ']'
 
     if component['hidden']:
-        print(' (hidden)', end='')
-
-    print()
-
-    component_index_static[0] += 1
-
-    if component['type'] == 'section':
-        for child in component['children']:
-            dump(child, depth=depth+1, verbose=verbose)
-
-argparser = argparse.ArgumentParser(description='Dump a CNS model structure')
-argparser.add_argument(
-    'source', metavar='MODEL',
-    type    = argparse.FileType('r'),
-    default = sys.stdin,
-    nargs   = '?',
-    help    = 'A model JSON file'
-)
-argparser.add_argument(
-    '-v', '--verbose',
-    dest    = 'verbose',
-    action  = 'store_true',
-    default = False,
-    help    = 'show access levels for each component'
-)
-args = argparser.parse_args()
-
-model = json.load(args.source)
-
-for component in model:
-    dump(component, verbose=args.verbose)
+        text += ' (hidden)'
+
+    return text + '\n'
+
+def format_counts(counts):
+    return (
+          str(counts[0]) + ' parameters, '
+        + str(counts[1]) + ' sections, '
+        + str(counts[2]) + ' paragraphs'
+    )
+
+class Output(object):
+    """\
+    Collects output text and writes it to a file in large blocks.
+    """
+
+    def __init__(self, fp, block_size=1 << 16):
+        self.fp         = fp
+        self.block_size = block_size
+        self.parts      = []
+        self.size       = 0
+
+    def append(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        self.fp.write(''.join(self.parts))
+        self.parts = []
+        self.size  = 0
+
+def dump(events, output, verbose=False, level=None, datatype=None, name=None, max_depth=None, counts=False):
+    """\
+    Dumps a model, given as a stream of events from iter_model(), to an
+    Output object.
+
+    Components can be filtered by access level, and parameters by datatype
+    and by a regular expression that their name must contain. When
+    parameters are filtered, paragraphs are left out and sections are
+    only shown if they contain a matching parameter.
+    Components deeper than max_depth are not listed.
+    If counts is True, only sections are listed, together with the amount
+    of matching components they contain.
+
+    The dump of a section is written as soon as its header is complete. If
+    the model lists a section's children before its other keys, the output
+    of its children is kept in memory until the section ends.
+    """
+    filter_parameters = datatype is not None or name is not None
+
+    if name is not None:
+        name = re.compile(name)
+
+    def included(component):
+        """\
+        Whether a component passes the filters. Sections are only checked
+        against the access level.
+        """
+        if level is not None and level not in component.get('accesslevels', [level]):
+            return False
+        if component['type'] == 'parameter':
+            return (
+                (datatype is None or component.get('datatype') == datatype)
+                and (name is None or name.search(component['name']) is not None)
+            )
+        return not filter_parameters or component['type'] == 'section'
+
+    def header_complete(component):
+        """\
+        Whether a section has all keys needed to filter and dump it.
+        """
+        keys = ['label', 'hidden', 'repeat']
+        if component.get('repeat'):
+            keys += ['repeat_min', 'repeat_max']
+        if level is not None or verbose:
+            keys += ['accesslevels']
+        return all(key in component for key in keys)
+
+    def header(frame):
+        if counts:
+            return (
+                  ('|' + ' '*2)*frame['depth'] + '#' + str(frame['index']) + ' '
+                + frame['component']['label'] + ': ' + format_counts(frame['counts']) + '\n'
+            )
+        return format_component(frame['component'], frame['index'], frame['depth'], verbose)
+
+    def listed(depth):
+        return max_depth is None or depth <= max_depth
+
+    # The sections we are in, outermost first.
+    # Sections that buffer their output have a list of lines, others write
+    # their output to the nearest buffering section or to the output object.
+    frames = []
+
+    # Component counts of the whole model.
+    totals = [0, 0, 0]
+
+    # The depth of a section whose subtree is skipped, or None.
+    skip_depth = None
+
+    def target(position):
+        """\
+        Returns the object that receives output for the frame at position.
+        """
+        for frame in reversed(frames[:position]):
+            if frame['lines'] is not None:
+                return frame['lines']
+        return output
+
+    def write(position, text):
+        target(position).append(text)
+
+    def reveal():
+        """\
+        Marks all open sections as having visible content, and writes the
+        headers that can be written right away.
+        """
+        for position, frame in enumerate(frames):
+            frame['used'] = True
+            if frame['lines'] is None and not frame['written'] and listed(frame['depth']):
+                write(position, header(frame))
+                frame['written'] = True
+
+    def count(component):
+        counter = ['parameter', 'section', 'paragraph'].index(component['type'])
+        (frames[-1]['counts'] if len(frames) else totals)[counter] += 1
+
+    for event, index, depth, component in events:
+        if skip_depth is not None:
+            if event == 'end' and depth == skip_depth:
+                skip_depth = None
+            continue
+
+        if event == 'start':
+            complete = header_complete(component)
+
+            if complete and not included(component):
+                skip_depth = depth
+                continue
+
+            frames.append({
+                'index':     index,
+                'depth':     depth,
+                'component': component,
+                'lines':     [] if counts or not complete else None,
+                'written':   False,
+                'used':      False,
+                'counts':    [0, 0, 0],
+            })
+
+            if complete and not filter_parameters and not counts:
+                reveal()
+
+        elif event == 'end':
+            frame = frames.pop()
+
+            if not included(component) or (filter_parameters and not frame['used']):
+                continue
+
+            if frame['lines'] is not None:
+                reveal()
+                if listed(depth):
+                    write(len(frames), header(frame))
+                write(len(frames), ''.join(frame['lines']))
+
+            parent_counts = frames[-1]['counts'] if len(frames) else totals
+            for counter, value in enumerate(frame['counts']):
+                parent_counts[counter] += value
+            count(component)
+
+        else:
+            if not included(component):
+                continue
+
+            count(component)
+            reveal()
+
+            if not counts and listed(depth):
+                write(len(frames), format_component(component, index, depth, verbose))
+
+    if counts:
+        output.append('Total: ' + format_counts(totals) + '\n')
+
+def main(argv=None, prog=None):
+    argparser = argparse.ArgumentParser(
+        prog=prog,
+        description='Dump a CNS model structure',
+        epilog=
+            'Models are read incrementally, so large models can be inspected '
+            'without loading them into memory. Binary models are fastest.'
+    )
+    argparser.add_argument(
+        'source', metavar='MODEL',
+        type    = argparse.FileType('r'),
+        default = sys.stdin,
+        nargs   = '?',
+        help    = 'A JSON or binary model file'
+    )
+    argparser.add_argument(
+        '-v', '--verbose',
+        dest    = 'verbose',
+        action  = 'store_true',
+        default = False,
+        help    = 'show access levels for each component'
+    )
+    argparser.add_argument(
+        '-l', '--level', metavar='LEVEL',
+        dest    = 'level',
+        default = None,
+        help    = 'only show components that are accessible at this access level'
+    )
+    argparser.add_argument(
+        '-t', '--datatype', metavar='DATATYPE',
+        dest    = 'datatype',
+        default = None,
+        help    = 'only show parameters with this datatype'
+    )
+    argparser.add_argument(
+        '-n', '--name', metavar='PATTERN',
+        dest    = 'name',
+        default = None,
+        help    = 'only show parameters with a name matching this regular expression'
+    )
+    argparser.add_argument(
+        '-d', '--depth', metavar='DEPTH',
+        dest    = 'depth',
+        type    = int,
+        default = None,
+        help    = 'do not list components nested deeper than DEPTH, top-level components have depth 0'
+    )
+    argparser.add_argument(
+        '-c', '--counts',
+        dest    = 'counts',
+        action  = 'store_true',
+        default = False,
+        help    = 'list sections with the amount of components they contain instead of listing all components'
+    )
+    args = argparser.parse_args(argv)
+
+    accesslevels, events = iter_model(args.source)
+
+    if args.level is not None and accesslevels is not None and args.level not in [level['name'] for level in accesslevels]:
+        print('Unknown access level "' + args.level + '"', file=sys.stderr)
+        return 1
+
+    output = Output(sys.stdout)
+
+    dump(
+        events,
+        output,
+        verbose   = args.verbose,
+        level     = args.level,
+        datatype  = args.datatype,
+        name      = args.name,
+        max_depth = args.depth,
+        counts    = args.counts,
+    )
+
+    output.flush()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,98 +3,310 @@
 from __future__ import print_function
 import sys
 import argparse
+import hashlib
 import json
 import os
 
-from cnsparser import CNSParser
-
-parser = argparse.ArgumentParser(
-    description='Save filled in model data back to a run.cns file',
-)
-
-parser.add_argument(
-    '-V', '--version',
-    action  = 'version',
-    version = '%(prog)s 0.1'
-)
-parser.add_argument(
-    '-v', '--verbose',
-    dest    = 'verbose',
-    action  = 'store_true',
-    default = False,
-    help    = 'print parsing information to stderr'
-)
-parser.add_argument(
-    '-w', '--warnings',
-    dest    = 'warnings',
-    action  = 'store_true',
-    default = False,
-    help    = 'show warnings for unrecognized input data'
-)
-parser.add_argument(
-    '-W', '--fatal-warnings',
-    dest    = 'fatal_warnings',
-    action  = 'store_true',
-    default = False,
-    help    = 'make unrecognized input data throw a fatal error, implicitly sets -w'
-)
-parser.add_argument(
-    '-k', '--keep-aux-filenames',
-    dest    = 'keep_files',
-    action  = 'store_true',
-    default = False,
-    help    = 'create links instead of renaming auxiliary files'
-)
-parser.add_argument(
-    'job_dir', metavar='JOB_DIR',
-    default = '.',
-    nargs   = '?',
-    help    = 'the job directory, defaults to \'.\', the current working directory'
-)
-parser.add_argument(
-    '-t', '--template', metavar='TEMPLATE',
-    dest    = 'template',
-    type    = argparse.FileType('r'),
-    default = None,
-    help    = 'the CNS template file to parse, defaults to \'JOB_DIR/template.cns\''
-)
-parser.add_argument(
-    '-i', '--form-data', metavar='FORM_DATA',
-    dest    = 'form_data',
-    type    = argparse.FileType('r'),
-    default = None,
-    help    = 'the formdata.json file to parse, defaults to \'JOB_DIR/formdata.json\''
-)
-parser.add_argument(
-    '-o', '--cns-output', metavar='CNS_OUTPUT',
-    dest    = 'cns_output',
-    type    = argparse.FileType('w'),
-    default = None,
-    help    = 'the run.cns output file, defaults to \'JOB_DIR/run.cns\''
-)
-
-args = parser.parse_args()
-
-job_dir    = args.job_dir    if args.job_dir    is not None else '.'
-template   = args.template   if args.template   is not None else open(os.path.join(job_dir, 'template.cns'))
-form_data  = args.form_data  if args.form_data  is not None else open(os.path.join(job_dir, 'formdata.json'))
-cns_output = args.cns_output if args.cns_output is not None else open(os.path.join(job_dir, 'run.cns'), 'w')
-
-data = json.load(form_data)
-
-parser = CNSParser(
-    source         = template,
-    verbose        = args.verbose,
-    warnings       = args.warnings,
-    fatal_warnings = args.fatal_warnings,
-)
-
-cns, file_map = parser.write(data, job_dir)
-
-# Rename auxiliary files.
-for component in data['files'].itervalues():
-    for instance in component.itervalues():
-        for file in instance.itervalues():
+from cnscolumnar import from_columnar, is_columnar, iter_files
+from cnsrendercache import RenderCache
+from cnsruntime import TemplateFile
+from cnstelemetry import Telemetry, form_data_counts
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Save filled in model data back to a run.cns file',
+    )
+
+    parser.add_argument(
+        '-V', '--version',
+        action  = 'version',
+        version = '%(prog)s 0.1'
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        dest    = 'verbose',
+        action  = 'store_true',
+        default = False,
+        help    = 'print parsing information to stderr'
+    )
+    parser.add_argument(
+        '-w', '--warnings',
+        dest    = 'warnings',
+        action  = 'store_true',
+        default = False,
+        help    = 'show warnings for unrecognized input data'
+    )
+    parser.add_argument(
+        '-W', '--fatal-warnings',
+        dest    = 'fatal_warnings',
+        action  = 'store_true',
+        default = False,
+        help    = 'make unrecognized input data throw a fatal error, implicitly sets -w'
+    )
+    parser.add_argument(
+        '--warning-limit', metavar='LIMIT',
+        dest    = 'warning_limit',
+        type    = int,
+        default = 10,
+        help    = 'show at most LIMIT different warnings of each kind, defaults to 10; '
+                  'repeated warnings are shown once'
+    )
+    parser.add_argument(
+        '--diagnostics-file', metavar='DIAGNOSTICS',
+        dest    = 'diagnostics_file',
+        default = None,
+        help    = 'save the warnings as JSON to DIAGNOSTICS, they are only shown if -w is set'
+    )
+    parser.add_argument(
+        '--multiline-blocks',
+        dest    = 'multiline_blocks',
+        action  = 'store_true',
+        default = False,
+        help    = 'read brace blocks that span multiple lines as a single line, for form data of a model '
+                  'written by cnstojson.py --multiline-blocks'
+    )
+    parser.add_argument(
+        '-k', '--keep-aux-filenames',
+        dest    = 'keep_files',
+        action  = 'store_true',
+        default = False,
+        help    = 'create links instead of renaming auxiliary files'
+    )
+    parser.add_argument(
+        '-p', '--previous-job', metavar='PREVIOUS_JOB_DIR',
+        dest    = 'previous_job',
+        default = None,
+        help    = 'only regenerate parameters that changed since the run.cns and formdata.json in PREVIOUS_JOB_DIR, '
+                  'and list the names of changed parameters'
+    )
+    parser.add_argument(
+        '-d', '--defaults',
+        dest    = 'defaults',
+        action  = 'store_true',
+        default = False,
+        help    = 'write all parameters with their default values and the minimum amount of repetitions, '
+                  'no form data is read'
+    )
+    parser.add_argument(
+        '-T', '--telemetry',
+        dest    = 'telemetry',
+        action  = 'store_true',
+        default = False,
+        help    = 'write a JSON record with timings and counts of this job to \'JOB_DIR/telemetry.json\''
+    )
+    parser.add_argument(
+        '--telemetry-file', metavar='TELEMETRY',
+        dest    = 'telemetry_file',
+        default = None,
+        help    = 'the telemetry output file, implicitly sets -T'
+    )
+    parser.add_argument(
+        '-c', '--compiled',
+        dest    = 'compiled',
+        action  = 'store_true',
+        default = False,
+        help    = 'render with the compiled render program of the template instead of CNSParser, '
+                  'which still renders form data the program does not handle'
+    )
+    parser.add_argument(
+        '--render-cache', metavar='CACHE_DIR',
+        dest    = 'render_cache',
+        default = None,
+        help    = 'reuse the output of earlier jobs with the same template and form data, '
+                  'saved in CACHE_DIR, which can be shared by multiple jobs at the same time'
+    )
+    parser.add_argument(
+        '--bytecode-cache', metavar='CACHE_DIR',
+        dest    = 'bytecode_cache',
+        default = None,
+        help    = 'with -c, save the generated render function of the template in CACHE_DIR, keyed on the '
+                  'template contents, so later jobs with the same template do not parse it'
+    )
+    parser.add_argument(
+        'job_dir', metavar='JOB_DIR',
+        default = '.',
+        nargs   = '?',
+        help    = 'the job directory, defaults to \'.\', the current working directory'
+    )
+    parser.add_argument(
+        '-t', '--template', metavar='TEMPLATE',
+        dest    = 'template',
+        type    = argparse.FileType('r'),
+        default = None,
+        help    = 'the CNS template file to parse, defaults to \'JOB_DIR/template.cns\''
+    )
+    parser.add_argument(
+        '-i', '--form-data', metavar='FORM_DATA',
+        dest    = 'form_data',
+        type    = argparse.FileType('r'),
+        default = None,
+        help    = 'the formdata.json file to parse, defaults to \'JOB_DIR/formdata.json\''
+    )
+    parser.add_argument(
+        '-o', '--cns-output', metavar='CNS_OUTPUT',
+        dest    = 'cns_output',
+        type    = argparse.FileType('w'),
+        default = None,
+        help    = 'the run.cns output file, defaults to \'JOB_DIR/run.cns\''
+    )
+
+    args = parser.parse_args(argv)
+
+    telemetry = Telemetry('jsontocns')
+
+    if args.defaults and args.previous_job is not None:
+        parser.error('--defaults can not be combined with --previous-job')
+    if args.bytecode_cache is not None and not args.compiled:
+        parser.error('--bytecode-cache requires --compiled')
+
+    job_dir    = args.job_dir    if args.job_dir    is not None else '.'
+
+    def save_telemetry():
+        if args.telemetry_file is not None:
+            telemetry.save(args.telemetry_file)
+        elif args.telemetry:
+            telemetry.save(os.path.join(job_dir, 'telemetry.json'))
+
+    if args.previous_job is not None:
+        # Read these before opening the output file, as it may be the same file.
+        with telemetry.stage('read'):
+            previous_data = json.load(open(os.path.join(args.previous_job, 'formdata.json')))
+            previous_cns  = open(os.path.join(args.previous_job, 'run.cns')).read().split('\n')[:-1]
+
+    template   = args.template   if args.template   is not None else open(os.path.join(job_dir, 'template.cns'))
+    cns_output = args.cns_output if args.cns_output is not None else open(os.path.join(job_dir, 'run.cns'), 'w')
+
+    telemetry.set(template=template.name)
+
+    if args.defaults:
+        with telemetry.stage('parse'):
+            from cnstemplate import load_template
+            loaded_template = load_template(template)
+        with telemetry.stage('render'):
+            cns = loaded_template.write_defaults()
+        with telemetry.stage('finalise'):
+            output = '\n'.join(cns) + '\n'
+            cns_output.write(output)
+            cns_output.flush()
+        telemetry.set(template_lines=len(loaded_template.lines), output_bytes=len(output))
+        save_telemetry()
+        return
+
+    form_data  = args.form_data  if args.form_data  is not None else open(os.path.join(job_dir, 'formdata.json'))
+
+    with telemetry.stage('read'):
+        data = json.load(form_data)
+
+    diagnose = args.verbose or args.warnings or args.fatal_warnings or args.diagnostics_file is not None
+
+    # The template is rendered by CNSParser, unless the compiled render
+    # program is requested. CNSParser is always used for diagnostics, for
+    # rewriting a previous job and for templates with multi-line brace blocks.
+    use_parser = not args.compiled or args.previous_job is not None or args.multiline_blocks or diagnose
+
+    # Output rendered with diagnostics is not cached, as a cached job would not report them.
+    if args.render_cache is not None and args.previous_job is None and not diagnose:
+        render_cache = RenderCache(args.render_cache)
+    else:
+        render_cache = None
+
+    # Render with the generated render function, cached in the bytecode cache, see cnsruntime.
+    use_bytecode = not use_parser and args.bytecode_cache is not None and os.path.isfile(template.name)
+
+    with telemetry.stage('parse'):
+        if not use_bytecode:
+            # Imported here, the parser is not needed to render templates
+            # with an up to date bytecode file, see cnsruntime.
+            from cnsdiagnostics import Diagnostics
+            from cnsparser import CNSParser
+
+        if use_parser:
+            # CNSParser only reads form data in the tree format.
+            if is_columnar(data) or (args.previous_job is not None and is_columnar(previous_data)):
+                if args.multiline_blocks:
+                    table = CNSParser(source=template, multiline_blocks=True).parse(table=True)[1]
+                else:
+                    from cnstemplate import load_template
+                    table = load_template(template).table
+                template.seek(0)
+                if is_columnar(data):
+                    data = from_columnar(table, data)
+                if args.previous_job is not None and is_columnar(previous_data):
+                    previous_data = from_columnar(table, previous_data)
+
+            if render_cache is not None:
+                # The render cache is keyed on the digest of the template contents.
+                contents        = template.read()
+                template_digest = hashlib.sha1(
+                    contents if isinstance(contents, bytes) else contents.encode('utf-8')
+                ).hexdigest()
+                template        = contents.splitlines(True)
+
+            # The template is parsed by write() and rewrite(), in the render stage.
+            diagnostics = Diagnostics(
+                limit  = args.warning_limit,
+                stream = sys.stderr if args.warnings or args.fatal_warnings else None,
+            )
+            parser = CNSParser(
+                source           = template,
+                verbose          = args.verbose,
+                warnings         = args.warnings or args.diagnostics_file is not None,
+                fatal_warnings   = args.fatal_warnings,
+                diagnostics      = diagnostics,
+                multiline_blocks = args.multiline_blocks,
+            )
+        elif use_bytecode:
+            template_file = TemplateFile(template.name, args.bytecode_cache)
+        else:
+            from cnstemplate import load_template
+            loaded_template = load_template(template)
+
+    # Form data is validated while it is rendered.
+    with telemetry.stage('render'):
+        if args.previous_job is not None:
+            cns, file_map, changed = parser.rewrite(previous_cns, previous_data, data, job_dir)
+            for name in changed:
+                print('Changed ' + name)
+        elif use_parser and render_cache is not None:
+            # Only output that was rendered without errors is cached.
+            result = render_cache.get(template_digest, data)
+            if result is None:
+                result = parser.write(data, job_dir)
+                render_cache.put(template_digest, data, result[0], result[1])
+            cns, file_map = result
+        elif use_parser:
+            cns, file_map = parser.write(data, job_dir)
+        else:
+            template_object = template_file if use_bytecode else loaded_template
+            if render_cache is not None:
+                # Only output that was rendered without errors is cached.
+                cns, file_map = render_cache.write(template_object, data, job_dir)
+            else:
+                cns, file_map = template_object.write(data, job_dir)
+
+        if render_cache is not None:
+            telemetry.set(render_cache=render_cache.stats())
+
+    if args.diagnostics_file is not None:
+        diagnostics.save(args.diagnostics_file)
+
+    if use_parser:
+        telemetry.set(template_lines=len(parser.template_lines()))
+    elif use_bytecode:
+        telemetry.set(template_lines=len(template_file.contents.splitlines()))
+    else:
+        telemetry.set(template_lines=len(loaded_template.lines))
+
+    telemetry.set(**form_data_counts(data))
+
+    aux_files_moved   = 0
+    aux_files_linked  = 0
+    aux_files_removed = 0
+
+    with telemetry.stage('finalise'):
+        # Rename auxiliary files.
+        for file in iter_files(data):
             # NOTE: We assume that the data['files'] list was filtered or
             #       generated securely by the form server.
             # TODO: It would be better to pass file information to CNSParser separate
@@ -106,12 +318,28 @@ for component in data['files'].itervalues():
                     print('Linking ' + file_map[file['name']] + ' -> ' + os.path.join(job_dir, file['name']))
                     # Create a hard link.
                     os.link(os.path.join(job_dir, file['name']), os.path.join(job_dir, file_map[file['name']]))
+                    aux_files_linked += 1
             else:
                 if file['name'] in file_map:
                     print('Moving ' + os.path.join(job_dir, file['name']) + ' -> ' + file_map[file['name']])
                     os.rename(os.path.join(job_dir, file['name']), os.path.join(job_dir, file_map[file['name']]))
+                    aux_files_moved += 1
                 else:
                     print('Removing ' + os.path.join(job_dir, file['name']))
                     os.remove(file['name'])
+                    aux_files_removed += 1
+
+        output = '\n'.join(cns) + '\n'
+        cns_output.write(output)
+        cns_output.flush()
+
+    telemetry.set(
+        output_bytes      = len(output),
+        aux_files_moved   = aux_files_moved,
+        aux_files_linked  = aux_files_linked,
+        aux_files_removed = aux_files_removed,
+    )
+    save_telemetry()
 
-cns_output.write('\n'.join(cns) + '\n')
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import argparse
+import json
+import os
+
+from cnsmigrate import FormDataMigration, migrate_files
+from cnstemplate import load_template
+
+def find_jobs(sources, input_name, output_name):
+    """\
+    Yields (source, destination) pairs for the form data files given on the
+    command line. Directories are searched recursively for files named
+    input_name. Migrated files are written next to their source as
+    output_name.
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for directory, directories, files in os.walk(source):
+                directories.sort()
+                if input_name in files:
+                    yield os.path.join(directory, input_name), os.path.join(directory, output_name)
+        else:
+            yield source, os.path.join(os.path.dirname(source), output_name)
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Migrate form data to a new version of its CNS template',
+        epilog=
+            'Values are carried over to the sections and parameters of the new '
+            'template with the same name and section labels, new parameters get '
+            'their default values. Everything that could not be carried over is '
+            'printed on a separate line, prefixed with the form data file and the '
+            'instantiated parameter name or section label. Both templates are '
+            'indexed once, the files are migrated in parallel. The exit status is '
+            '1 if any file could not be migrated.'
+    )
+
+    parser.add_argument(
+        '-V', '--version',
+        action  = 'version',
+        version = '%(prog)s 0.1'
+    )
+    parser.add_argument(
+        '-t', '--old-template', metavar='OLD_TEMPLATE',
+        dest     = 'old_template',
+        type     = argparse.FileType('r'),
+        required = True,
+        help     = 'the CNS template file the form data belongs to'
+    )
+    parser.add_argument(
+        '-T', '--new-template', metavar='NEW_TEMPLATE',
+        dest     = 'new_template',
+        type     = argparse.FileType('r'),
+        required = True,
+        help     = 'the CNS template file to migrate the form data to'
+    )
+    parser.add_argument(
+        '-i', '--input-name', metavar='NAME',
+        dest    = 'input_name',
+        default = 'formdata.json',
+        help    = 'the name of the form data files to look for in directories, defaults to formdata.json'
+    )
+    parser.add_argument(
+        '-o', '--output-name', metavar='NAME',
+        dest    = 'output_name',
+        default = 'formdata.migrated.json',
+        help    = 'the name of the migrated form data files, which are written next to the '
+                  'form data they were migrated from, defaults to formdata.migrated.json; '
+                  'with the name of the form data files, they are replaced'
+    )
+    parser.add_argument(
+        '-p', '--processes', metavar='PROCESSES',
+        dest    = 'processes',
+        type    = int,
+        default = None,
+        help    = 'the amount of worker processes, defaults to the amount of CPUs'
+    )
+    parser.add_argument(
+        '-r', '--report', metavar='REPORT',
+        dest    = 'report',
+        default = None,
+        help    = 'save what was dropped or failed for every form data file as JSON to REPORT'
+    )
+    parser.add_argument(
+        'sources', metavar='FORM_DATA',
+        nargs   = '+',
+        help    = 'form data files, in the tree or the columnar format, or directories to search for them'
+    )
+
+    args = parser.parse_args(argv)
+
+    migration = FormDataMigration(load_template(args.old_template), load_template(args.new_template))
+
+    report   = []
+    failures = 0
+
+    for source, destination, dropped, error in migrate_files(
+            migration,
+            find_jobs(args.sources, args.input_name, args.output_name),
+            args.processes):
+        if error is not None:
+            print(source + ': ' + error)
+            failures += 1
+        for name, message in dropped:
+            print(source + ': ' + (message if name is None else name + ': ' + message))
+
+        report.append({
+            'source':      source,
+            'destination': destination if error is None else None,
+            'error':       error,
+            'dropped':     [{'name': name, 'message': message} for name, message in dropped],
+        })
+
+    if args.report is not None:
+        with open(args.report, 'w') as fp:
+            json.dump(report, fp, sort_keys=True)
+            fp.write('\n')
+
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import argparse
+import collections
+import json
+
+from cnstemplate import load_template
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Print the values of all instantiated parameters for form data',
+        epilog=
+            'The values are printed as a JSON object that maps instantiated '
+            'parameter names (with repetition numbers filled in) to their values, '
+            'in the order of the rendered run.cns file, exactly as jsontocns.py '
+            'would write them. Parameters the access level has no access to have '
+            'their default values. No run.cns file is rendered. '
+            'The exit status is 1 if the form data is not valid.'
+    )
+
+    parser.add_argument(
+        '-V', '--version',
+        action  = 'version',
+        version = '%(prog)s 0.1'
+    )
+    parser.add_argument(
+        '-t', '--template', metavar='TEMPLATE',
+        dest     = 'template',
+        type     = argparse.FileType('r'),
+        required = True,
+        help     = 'the CNS template file the form data belongs to'
+    )
+    parser.add_argument(
+        '-o', '--output', metavar='OUTPUT',
+        dest    = 'output',
+        type    = argparse.FileType('w'),
+        default = sys.stdout,
+        help    = 'the output file, defaults to stdout'
+    )
+    parser.add_argument(
+        'form_data', metavar='FORM_DATA',
+        type    = argparse.FileType('r'),
+        help    = 'the form data file, in the tree or the columnar format'
+    )
+
+    args = parser.parse_args(argv)
+
+    template = load_template(args.template)
+    data     = json.load(args.form_data)
+
+    try:
+        items = template.resolve_items(data)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 1
+
+    json.dump(collections.OrderedDict(items), args.output, indent=1)
+    args.output.write('\n')
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+import sys
+import argparse
+import json
+
+from cnscolumnar import from_columnar, is_columnar
+from cnstemplate import load_template
+
+def main(argv=None, prog=None):
+    parser = argparse.ArgumentParser(
+        prog=prog,
+        description='Check form data against a CNS template',
+        epilog=
+            'Every problem that is found is printed on a separate line, prefixed '
+            'with the instantiated parameter name or section label it belongs to. '
+            'The exit status is 1 if any problems were found.'
+    )
+
+    parser.add_argument(
+        '-V', '--version',
+        action  = 'version',
+        version = '%(prog)s 0.1'
+    )
+    parser.add_argument(
+        '-t', '--template', metavar='TEMPLATE',
+        dest     = 'template',
+        type     = argparse.FileType('r'),
+        required = True,
+        help     = 'the CNS template file the form data belongs to'
+    )
+    parser.add_argument(
+        'form_data', metavar='FORM_DATA',
+        type    = argparse.FileType('r'),
+        help    = 'the form data file to check, in the tree or the columnar format'
+    )
+
+    args = parser.parse_args(argv)
+
+    template = load_template(args.template)
+    data     = json.load(args.form_data)
+
+    if is_columnar(data):
+        try:
+            data = from_columnar(template.table, data)
+        except ValueError as e:
+            print(str(e))
+            return 1
+
+    values, errors = template.check_values(data)
+
+    for name, message in errors:
+        print(message if name is None else name + ': ' + message)
+
+    return 1 if len(errors) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())